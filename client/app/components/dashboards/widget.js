@@ -86,7 +86,7 @@ function DashboardWidgetCtrl($location, $uibModal, $window, Events, currentUser)
     if (force) {
       maxAge = 0;
     }
-    this.queryResult = this.query.getQueryResult(maxAge);
+    this.queryResult = this.query.getQueryResult(maxAge, 'dashboard');
   };
 
   if (this.widget.visualization) {
@@ -33,11 +33,28 @@ export default function init(ngModule) {
     return Auth.loadConfig();
   }
 
-  function loadData($http, $route, $q, Auth) {
+  function loadQueryResult($http, $timeout, queryId) {
+    const url = `api/queries/${queryId}/results.json${location.search}`;
+
+    function load(params) {
+      return $http.get(url, { params }).then((response) => {
+        if (response.status !== 202) {
+          return response.data;
+        }
+
+        // The query is still executing: ask for the result of its job (which is answered without waiting for it).
+        return $timeout(() => load({ job: response.data.job.id }), 3000);
+      });
+    }
+
+    return load();
+  }
+
+  function loadData($http, $route, $q, $timeout, Auth) {
     return session($http, $route, Auth).then(() => {
       const queryId = $route.current.params.queryId;
       const query = $http.get(`api/queries/${queryId}`).then(response => response.data);
-      const queryResult = $http.get(`api/queries/${queryId}/results.json${location.search}`).then(response => response.data);
+      const queryResult = loadQueryResult($http, $timeout, queryId);
       return $q.all([query, queryResult]);
     });
   }
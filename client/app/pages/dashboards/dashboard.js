@@ -114,7 +114,7 @@ function DashboardCtrl(
     this.dashboard.widgets.forEach((widget) => {
       if (widget.visualization) {
         const maxAge = force ? 0 : undefined;
-        const queryResult = widget.getQuery().getQueryResult(maxAge);
+        const queryResult = widget.getQuery().getQueryResult(maxAge, 'dashboard');
         if (!_.isUndefined(queryResult)) {
           promises.push(queryResult.toPromise());
         }
@@ -482,13 +482,16 @@ function QueryResultService($resource, $timeout, $q) {
       return `${queryName.replace(' ', '_') + moment(this.getUpdatedAt()).format('_YYYY_MM_DD')}.${fileType}`;
     }
 
-    static get(dataSourceId, query, maxAge, queryId) {
+    static get(dataSourceId, query, maxAge, queryId, priority) {
       const queryResult = new QueryResult();
 
       const params = { data_source_id: dataSourceId, query, max_age: maxAge };
       if (queryId !== undefined) {
         params.query_id = queryId;
       }
+      if (priority !== undefined) {
+        params.priority = priority;
+      }
 
       QueryResultResource.post(params, (response) => {
         queryResult.update(response);
@@ -259,7 +259,7 @@ function QueryResource($resource, $http, $q, $location, currentUser, QueryResult
     return this.getParameters().isRequired();
   };
 
-  Query.prototype.getQueryResult = function getQueryResult(maxAge) {
+  Query.prototype.getQueryResult = function getQueryResult(maxAge, priority) {
     if (!this.query) {
       return new QueryResultError("Can't execute empty query.");
     }
@@ -303,7 +303,7 @@ function QueryResource($resource, $http, $q, $location, currentUser, QueryResult
         this.queryResult = QueryResult.getById(this.latest_query_data_id);
       }
     } else if (this.data_source_id) {
-      this.queryResult = QueryResult.get(this.data_source_id, queryText, maxAge, this.id);
+      this.queryResult = QueryResult.get(this.data_source_id, queryText, maxAge, this.id, priority);
     } else {
       return new QueryResultError('Please select data source to run this query.');
     }
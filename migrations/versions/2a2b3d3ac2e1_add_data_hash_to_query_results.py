@@ -0,0 +1,25 @@
+"""add data_hash to query_results
+
+Revision ID: 2a2b3d3ac2e1
+Revises: 7671dca4e604
+Create Date: 2026-10-18 21:02:13.520114
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '2a2b3d3ac2e1'
+down_revision = '7671dca4e604'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing results have no hash, so they're never reused for new results.
+    op.add_column('query_results', sa.Column('data_hash', sa.String(length=64), nullable=True))
+
+
+def downgrade():
+    op.drop_column('query_results', 'data_hash')
@@ -0,0 +1,26 @@
+"""add indexes for query results cleanup
+
+Revision ID: 3b1d5e8a7c42
+Revises: 9f4b3c2a1e07
+Create Date: 2026-10-19 13:40:22.871942
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3b1d5e8a7c42'
+down_revision = '9f4b3c2a1e07'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('query_results_retrieved_at_id', 'query_results', ['retrieved_at', 'id'], unique=False)
+    op.create_index(op.f('ix_queries_latest_query_data_id'), 'queries', ['latest_query_data_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_queries_latest_query_data_id'), table_name='queries')
+    op.drop_index('query_results_retrieved_at_id', table_name='query_results')
@@ -0,0 +1,29 @@
+"""add next_run_at to queries
+
+Revision ID: 5ec5c84ba61e
+Revises: d4c798575877
+Create Date: 2026-10-18 23:05:51.204613
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5ec5c84ba61e'
+down_revision = 'd4c798575877'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('queries', sa.Column('next_run_at', sa.DateTime(timezone=True), nullable=True))
+    op.create_index(op.f('ix_queries_next_run_at'), 'queries', ['next_run_at'], unique=False)
+    # The scheduler checks every query that is due on its first run, and sets the actual next run time of the ones
+    # that aren't.
+    op.execute("UPDATE queries SET next_run_at = now() WHERE schedule IS NOT NULL AND latest_query_data_id IS NOT NULL")
+
+
+def downgrade():
+    op.drop_index(op.f('ix_queries_next_run_at'), table_name='queries')
+    op.drop_column('queries', 'next_run_at')
@@ -0,0 +1,52 @@
+"""store query_results.data as bytea (chunked, compressed result format)
+
+Revision ID: 7671dca4e604
+Revises: d1eae8b9893e
+Create Date: 2026-10-18 18:20:41.131209
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+from redash.utils import json_dumps, result_codec
+
+
+# revision identifiers, used by Alembic.
+revision = '7671dca4e604'
+down_revision = 'd1eae8b9893e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # Existing results stay JSON text (now as UTF-8 bytes), which the result codec reads as the legacy format.
+    op.execute("ALTER TABLE query_results ALTER COLUMN data TYPE bytea USING convert_to(data, 'UTF8')")
+
+
+def downgrade():
+    connection = op.get_bind()
+    query_results = sa.table('query_results',
+                             sa.column('id', sa.Integer),
+                             sa.column('data', sa.LargeBinary))
+    magic = sa.literal(result_codec.MAGIC, type_=sa.LargeBinary)
+    encoded = sa.func.substring(query_results.c.data, 1, len(result_codec.MAGIC)) == magic
+
+    last_id = 0
+    while True:
+        batch = connection.execute(
+            sa.select([query_results.c.id, query_results.c.data])
+            .where(sa.and_(encoded, query_results.c.id > last_id))
+            .order_by(query_results.c.id)
+            .limit(100)).fetchall()
+
+        if not batch:
+            break
+
+        for result_id, data in batch:
+            connection.execute(
+                query_results.update()
+                .where(query_results.c.id == result_id)
+                .values(data=json_dumps(result_codec.deserialize(data))))
+            last_id = result_id
+
+    op.execute("ALTER TABLE query_results ALTER COLUMN data TYPE text USING convert_from(data, 'UTF8')")
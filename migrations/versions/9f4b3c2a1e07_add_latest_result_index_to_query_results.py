@@ -0,0 +1,25 @@
+"""add (data_source_id, query_hash, retrieved_at) index to query_results
+
+Revision ID: 9f4b3c2a1e07
+Revises: 5ec5c84ba61e
+Create Date: 2026-10-19 10:12:40.318270
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '9f4b3c2a1e07'
+down_revision = '5ec5c84ba61e'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('query_results_data_source_id_query_hash_retrieved_at', 'query_results',
+                    ['data_source_id', 'query_hash', sa.text('retrieved_at DESC')], unique=False)
+
+
+def downgrade():
+    op.drop_index('query_results_data_source_id_query_hash_retrieved_at', table_name='query_results')
@@ -0,0 +1,81 @@
+"""partition events by month
+
+Revision ID: c6a2e4f0d913
+Revises: 3b1d5e8a7c42
+Create Date: 2026-10-19 16:02:47.120385
+
+"""
+import datetime
+
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'c6a2e4f0d913'
+down_revision = '3b1d5e8a7c42'
+branch_labels = None
+depends_on = None
+
+MONTHS_AHEAD = 3
+
+
+def month_start(value, months=0):
+    month = value.year * 12 + value.month - 1 + months
+    return datetime.date(month // 12, month % 12 + 1, 1)
+
+
+def upgrade():
+    connection = op.get_bind()
+
+    # The existing events become the history partition (attaching it only scans it, no copying), up to the end of the
+    # month of the latest one, and then there's a partition per month.
+    op.execute("UPDATE events SET created_at = now() WHERE created_at IS NULL")
+    op.execute("ALTER TABLE events RENAME TO events_history")
+    # The partition key has to be part of the primary key.
+    op.execute("ALTER TABLE events_history ALTER COLUMN created_at SET NOT NULL, DROP CONSTRAINT events_pkey, "
+               "ADD PRIMARY KEY (id, created_at)")
+    op.execute("""
+        CREATE TABLE events (
+            id integer NOT NULL DEFAULT nextval('events_id_seq'),
+            org_id integer REFERENCES organizations (id),
+            user_id integer REFERENCES users (id),
+            action varchar(255),
+            object_type varchar(255),
+            object_id varchar(255),
+            additional_properties text,
+            created_at timestamp with time zone NOT NULL,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at)
+    """)
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+
+    today = datetime.datetime.utcnow()
+    latest = connection.execute("SELECT max(created_at) AT TIME ZONE 'UTC' FROM events_history").scalar() or today
+    start = month_start(max(latest, today), 1)
+    op.execute("ALTER TABLE events ATTACH PARTITION events_history "
+               "FOR VALUES FROM (MINVALUE) TO ('{} 00:00:00+00')".format(start))
+
+    while start < month_start(today, MONTHS_AHEAD + 1):
+        op.execute("CREATE TABLE {} PARTITION OF events FOR VALUES FROM ('{} 00:00:00+00') TO ('{} 00:00:00+00')"
+                   .format(start.strftime('events_%Y_%m'), start, month_start(start, 1)))
+        start = month_start(start, 1)
+
+
+def downgrade():
+    op.execute("ALTER TABLE events RENAME TO events_partitioned")
+    op.execute("ALTER INDEX events_pkey RENAME TO events_partitioned_pkey")
+    op.execute("""
+        CREATE TABLE events (
+            id integer NOT NULL DEFAULT nextval('events_id_seq') PRIMARY KEY,
+            org_id integer REFERENCES organizations (id),
+            user_id integer REFERENCES users (id),
+            action varchar(255),
+            object_type varchar(255),
+            object_id varchar(255),
+            additional_properties text,
+            created_at timestamp with time zone
+        )
+    """)
+    op.execute("INSERT INTO events SELECT * FROM events_partitioned")
+    op.execute("ALTER SEQUENCE events_id_seq OWNED BY events.id")
+    op.execute("DROP TABLE events_partitioned")
@@ -0,0 +1,30 @@
+"""add storage_key and data_size to query_results
+
+Revision ID: d4c798575877
+Revises: 2a2b3d3ac2e1
+Create Date: 2026-10-18 22:14:37.861204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4c798575877'
+down_revision = '2a2b3d3ac2e1'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('query_results', sa.Column('storage_key', sa.String(length=255), nullable=True))
+    op.add_column('query_results', sa.Column('data_size', sa.Integer(), nullable=True))
+    # Results in the query results storage have no data in the database.
+    op.alter_column('query_results', 'data', nullable=True)
+
+
+def downgrade():
+    # Fails when there are results in the query results storage, as their data can't be kept.
+    op.alter_column('query_results', 'data', nullable=False)
+    op.drop_column('query_results', 'data_size')
+    op.drop_column('query_results', 'storage_key')
@@ -9,7 +9,7 @@ from flask import redirect, request, jsonify, url_for
 from redash import models, settings
 from redash.authentication.org_resolving import current_org
 from redash.authentication import google_oauth, saml_auth, remote_user_auth, ldap_auth
-from redash.tasks import record_event
+from redash.tasks import buffer_event
 
 login_manager = LoginManager()
 logger = logging.getLogger('authentication')
@@ -124,7 +124,7 @@ def log_user_logged_in(app, user):
         'ip': request.remote_addr
     }
 
-    record_event.delay(event)
+    buffer_event(event)
 
 
 @login_manager.unauthorized_handler
@@ -1,9 +1,5 @@
 from sys import exit
 
-import json
-import cStringIO
-import xlsxwriter
-
 from click import BOOL, argument, option, prompt
 from flask.cli import AppGroup
 
@@ -31,25 +27,7 @@ def query_report(query):
 
 
 def query_result_export(query_result, filename):
-    s = cStringIO.StringIO()
-
-    query_data = json.loads(query_result.data)
-    book = xlsxwriter.Workbook(s)
-    sheet = book.add_worksheet("result")
-
-    column_names = []
-    for (c, col) in enumerate(query_data['columns']):
-        sheet.write(0, c, col['name'])
-        column_names.append(col['name'])
-
-    for (r, row) in enumerate(query_data['rows']):
-        for (c, name) in enumerate(column_names):
-            sheet.write(r + 1, c, row.get(name))
-
-    book.close()
-
-    with open(filename, 'w') as f:
-        f.write(s.getvalue())
+    query_result.write_excel(filename)
 
 
 def get_queries(organization):
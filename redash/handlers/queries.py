@@ -263,6 +263,7 @@ class QueryRefreshResource(BaseResource):
         Execute a query, updating the query object with the results.
 
         :param query_id: ID of query to execute
+        :qparam string priority: Priority of the query's job: interactive (default), dashboard, scheduled or backfill
 
         Responds with query task details.
         """
@@ -277,7 +278,8 @@ class QueryRefreshResource(BaseResource):
 
         parameter_values = collect_parameters_from_request(request.args)
 
-        return run_query(query.data_source, parameter_values, query.query_text, query.id)
+        return run_query(query.data_source, parameter_values, query.query_text, query.id,
+                         priority=request.args.get('priority', 'interactive'))
 
 
 # crowdworks-extended
@@ -1,17 +1,16 @@
 import logging
-import json
 import time
 
 import pystache
-from flask import make_response, request
+from flask import Response, make_response, request, stream_with_context
 from flask_login import current_user
 from flask_restful import abort
 from redash import models, settings, utils
-from redash.tasks import QueryTask, record_event
+from redash.tasks import QueryTask, buffer_event
 from redash.permissions import require_permission, not_view_only, has_access, require_access, view_only
 from redash.handlers.base import BaseResource, get_object_or_404
 from redash.utils import collect_query_parameters, collect_parameters_from_request, gen_query_hash
-from redash.tasks.queries import enqueue_query
+from redash.tasks.queries import PRIORITIES, QueryExecutionError, QueryWaitTimeout, enqueue_query, run_query_once
 
 
 def error_response(message):
@@ -19,12 +18,16 @@ def error_response(message):
 
 
 #
-# Run a parameterized query synchronously and return the result
+# Run a parameterized query and wait for the result
 # DISCLAIMER: Temporary solution to support parameters in queries. Should be
 #             removed once we refactor the query results API endpoints and handling
 #             on the client side. Please don't reuse in other API handlers.
 #
-def run_query_sync(data_source, parameter_values, query_text, max_age=0):
+def run_query_sync(data_source, parameter_values, query_text, max_age=0, query_id='adhoc'):
+    """
+    Returns the query's result, or its job (QueryTask) when it didn't finish within settings.QUERY_RESULT_WAIT_TIMEOUT
+    seconds, or None when it failed.
+    """
     query_parameters = set(collect_query_parameters(query_text))
     missing_params = set(query_parameters) - set(parameter_values.keys())
     if missing_params:
@@ -44,22 +47,20 @@ def run_query_sync(data_source, parameter_values, query_text, max_age=0):
         logging.info("Returning cached result for query %s" % query_hash)
         return query_result
 
-    try:
-        started_at = time.time()
-        data, error = data_source.query_runner.run_query(query_text, current_user)
-
-        if error:
-            logging.info('got bak error')
-            logging.info(error)
-            return None
-
-        run_time = time.time() - started_at
-        query_result, updated_query_ids = models.QueryResult.store_result(data_source.org, data_source,
-                                                                              query_hash, query_text, data,
-                                                                              run_time, utils.utcnow())
+    if current_user.is_api_user():
+        user_id, username = None, current_user.name
+    else:
+        user_id, username = current_user.id, current_user.email
 
-        models.db.session.commit()
-        return query_result
+    try:
+        # Executes in a query job (shared with identical queries already executing), instead of in the web worker:
+        return run_query_once(query_text, data_source, user_id, metadata={"Username": username, "Query ID": query_id})
+    except QueryWaitTimeout as e:
+        return QueryTask(job_id=e.job_id)
+    except QueryExecutionError as e:
+        logging.info('got bak error')
+        logging.info(e.message)
+        return None
     except Exception as e:
         if max_age > 0:
             abort(404, message="Unable to get result from the database, and no cached query result found.")
@@ -67,7 +68,10 @@ def run_query_sync(data_source, parameter_values, query_text, max_age=0):
             abort(503, message="Unable to get result from the database.")
         return None
 
-def run_query(data_source, parameter_values, query_text, query_id, max_age=0):
+def run_query(data_source, parameter_values, query_text, query_id, max_age=0, priority='interactive'):
+    if priority not in PRIORITIES:
+        return error_response('Unknown priority: {} (should be one of: {}).'.format(priority, ", ".join(PRIORITIES)))
+
     query_parameters = set(collect_query_parameters(query_text))
     missing_params = set(query_parameters) - set(parameter_values.keys())
     if missing_params:
@@ -92,7 +96,8 @@ def run_query(data_source, parameter_values, query_text, query_id, max_age=0):
     if query_result:
         return {'query_result': query_result.to_dict()}
     else:
-        job = enqueue_query(query_text, data_source, current_user.id, metadata={"Username": current_user.email, "Query ID": query_id})
+        job = enqueue_query(query_text, data_source, current_user.id,
+                            metadata={"Username": current_user.email, "Query ID": query_id}, priority=priority)
         return {'job': job.to_dict()}
 
 
@@ -106,6 +111,8 @@ class QueryResultListResource(BaseResource):
         :qparam number query_id: The query object to update with the result (optional)
         :qparam number max_age: If query results less than `max_age` seconds old are available, return them, otherwise execute the query; if omitted, always execute
         :qparam number data_source_id: ID of data source to query
+        :qparam string priority: Priority of the query's job if it's executed: interactive (default), dashboard,
+                                 scheduled or backfill
         """
         params = request.get_json(force=True)
         parameter_values = collect_parameters_from_request(request.args)
@@ -126,10 +133,8 @@ class QueryResultListResource(BaseResource):
             'object_type': 'data_source',
             'query': query
         })
-        return run_query(data_source, parameter_values, query, query_id, max_age)
-
-
-ONE_YEAR = 60 * 60 * 24 * 365.25
+        return run_query(data_source, parameter_values, query, query_id, max_age,
+                         params.get('priority', 'interactive'))
 
 
 class QueryResultResource(BaseResource):
@@ -163,6 +168,9 @@ class QueryResultResource(BaseResource):
         :param number query_id: The ID of the query whose results should be fetched
         :param number query_result_id: the ID of the query result to fetch
         :param string filetype: Format to return. One of 'json', 'xlsx', or 'csv'. Defaults to 'json'.
+        :qparam number offset: Index of the first row to return (JSON only)
+        :qparam number limit: Maximum number of rows to return (JSON only)
+        :qparam string columns: Comma separated names of the columns to return (JSON only)
 
         :<json number id: Query result ID
         :<json string query: Query that produced this result
@@ -171,6 +179,16 @@ class QueryResultResource(BaseResource):
         :<json number data_source_id: ID of data source that produced this result
         :<json number runtime: Length of execution time in seconds
         :<json string retrieved_at: Query retrieval date/time, in ISO format
+
+        When `offset`, `limit` or `columns` are given, `data` has only the requested rows and columns and
+        `data.row_count` is the total number of rows.
+
+        Results of queries with parameters (when parameters are allowed in embeds) are executed if needed, waiting up
+        to `QUERY_RESULT_WAIT_TIMEOUT` seconds; if that's not enough the response is the query's job (202 status).
+        Asking again with its id (the `job` argument) returns the job's result, its error, or (without waiting for it)
+        the job again while it's executing.
+        Their results are cached by parameter values, for the query's `parameters_cache_max_age` option (or
+        `PARAMETERIZED_RESULTS_CACHE_MAX_AGE`) seconds.
         """
         # TODO:
         # This method handles two cases: retrieving result by id & retrieving result by query id.
@@ -190,8 +208,32 @@ class QueryResultResource(BaseResource):
             query = get_object_or_404(models.Query.get_by_id_and_org, query_id, self.current_org)
 
             if query_result is None and query is not None:
-                if settings.ALLOW_PARAMETERS_IN_EMBEDS and parameter_values:
-                    query_result = run_query_sync(query.data_source, parameter_values, query.to_dict()['query'], max_age=max_age)
+                if settings.ALLOW_PARAMETERS_IN_EMBEDS and parameter_values and 'job' in request.args:
+                    job = QueryTask(job_id=request.args['job']).to_dict()
+                    if job['status'] == 4:
+                        return error_response(job['error'])
+                    if job['status'] != 3:
+                        return {'job': job}, 202
+
+                    query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, job['query_result_id'],
+                                                     self.current_org)
+                    query_text = pystache.render(query.to_dict()['query'], parameter_values)
+                    if (query_result.data_source_id != query.data_source_id or
+                            query_result.query_hash != gen_query_hash(query_text)):
+                        abort(404, message='The job is not of this query.')
+                    models.parameterized_results_cache.set(query, parameter_values, query_result)
+                elif settings.ALLOW_PARAMETERS_IN_EMBEDS and parameter_values:
+                    # Not older than the request's maxAge, when it has one (0 executes the query):
+                    query_result = models.parameterized_results_cache.get(query, parameter_values,
+                                                                          request.args.get('maxAge', type=int))
+                    if query_result is None:
+                        query_result = run_query_sync(query.data_source, parameter_values, query.to_dict()['query'],
+                                                      max_age=max_age, query_id=query.id)
+                        if isinstance(query_result, QueryTask):
+                            # Still executing, the client polls the job:
+                            return {'job': query_result.to_dict()}, 202
+                        if query_result is not None:
+                            models.parameterized_results_cache.set(query, parameter_values, query_result)
                 elif query.latest_query_data_id is not None:
                     query_result = get_object_or_404(models.QueryResult.get_by_id_and_org, query.latest_query_data_id, self.current_org)
                 
@@ -221,10 +263,10 @@ class QueryResultResource(BaseResource):
                     event['object_type'] = 'query_result'
                     event['object_id'] = query_result_id
 
-                record_event.delay(event)
+                buffer_event(event)
 
             if filetype == 'json':
-                response = self.make_json_response(query_result)
+                response = self.make_json_response(query_result, **self.get_slice_args())
             elif filetype == 'xlsx':
                 response = self.make_excel_response(query_result)
             else:
@@ -234,27 +276,51 @@ class QueryResultResource(BaseResource):
                 self.add_cors_headers(response.headers)
 
             if should_cache:
-                response.headers.add_header('Cache-Control', 'private,max-age=%d' % ONE_YEAR)
+                # A stored result is reused (with a new retrieved_at) when its query returns the same data again, so
+                # cached copies are revalidated instead of being kept for a year.
+                response.headers.add_header('Cache-Control', 'private,no-cache')
+                response.set_etag('{}-{}'.format(query_result.id, query_result.retrieved_at.isoformat()))
+                response = response.make_conditional(request)
 
             return response
 
         else:
             abort(404, message='No cached result found for this query.')
 
-    def make_json_response(self, query_result):
-        data = json.dumps({'query_result': query_result.to_dict()}, cls=utils.JSONEncoder)
+    @staticmethod
+    def get_slice_args():
+        offset = request.args.get('offset', 0, type=int)
+        limit = request.args.get('limit', None, type=int)
+        columns = request.args.get('columns')
+
+        if offset < 0 or (limit is not None and limit < 0):
+            abort(400, message='offset and limit must not be negative.')
+
+        if columns is not None:
+            columns = [c for c in columns.split(',') if c]
+
+        return {'offset': offset, 'limit': limit, 'columns': columns}
+
+    @staticmethod
+    def make_json_response(query_result, offset=0, limit=None, columns=None):
+        def generate():
+            yield '{"query_result": '
+            for piece in query_result.iter_json(offset, limit, columns):
+                yield piece
+            yield '}'
+
         headers = {'Content-Type': "application/json"}
-        return make_response(data, 200, headers)
+        return Response(stream_with_context(generate()), 200, headers)
 
     @staticmethod
     def make_csv_response(query_result):
         headers = {'Content-Type': "text/csv; charset=UTF-8"}
-        return make_response(query_result.make_csv_content(), 200, headers)
+        return Response(stream_with_context(query_result.iter_csv_content()), 200, headers)
 
     @staticmethod
     def make_excel_response(query_result):
         headers = {'Content-Type': "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"}
-        return make_response(query_result.make_excel_content(), 200, headers)
+        return Response(stream_with_context(query_result.iter_excel_content()), 200, headers)
 
 
 class JobResource(BaseResource):
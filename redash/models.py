@@ -1,36 +1,43 @@
+import calendar
 import cStringIO
-import csv
 import datetime
 import functools
 import hashlib
 import itertools
 import json
 import logging
+import math
+import re
+import tempfile
 import time
+from contextlib import contextmanager
 
+from dateutil.parser import parse as parse_date
 from funcy import project
 
 import xlsxwriter
 from flask_login import AnonymousUserMixin, UserMixin
 from flask_sqlalchemy import SQLAlchemy
 from passlib.apps import custom_app_context as pwd_context
-from redash import settings, redis_connection, utils
+from redash import settings, redis_connection, statsd_client, utils
 from redash.destinations import (get_configuration_schema_for_destination_type,
                                  get_destination)
 from redash.metrics import database  # noqa: F401
 from redash.permissions import has_access, view_only
 from redash.query_runner import (get_configuration_schema_for_query_runner_type,
                                  get_query_runner)
-from redash.utils import generate_token, json_dumps
+from redash.utils import generate_token, json_dumps, result_codec, result_storage
 from redash.utils.comparators import CaseInsensitiveComparator
 from redash.utils.configuration import ConfigurationContainer
 from sqlalchemy import distinct, or_
 from sqlalchemy.dialects import postgresql
 from sqlalchemy.event import listens_for
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.ext.mutable import Mutable
 from sqlalchemy.inspection import inspect
 from sqlalchemy.orm import backref, joinedload, object_session, subqueryload
 from sqlalchemy.orm.exc import NoResultFound  # noqa: F401
+from sqlalchemy.schema import CreateTable
 from sqlalchemy.types import TypeDecorator
 from functools import reduce
 
@@ -57,8 +64,11 @@ class ScheduledQueriesExecutions(object):
     def __init__(self):
         self.executions = {}
 
-    def refresh(self):
-        self.executions = redis_connection.hgetall(self.KEY_NAME)
+    def refresh(self, query_ids):
+        if query_ids:
+            self.executions = dict(zip(map(str, query_ids), redis_connection.hmget(self.KEY_NAME, query_ids)))
+        else:
+            self.executions = {}
 
     def update(self, query_id):
         redis_connection.hmset(self.KEY_NAME, {
@@ -74,6 +84,116 @@ class ScheduledQueriesExecutions(object):
 
 scheduled_queries_executions = ScheduledQueriesExecutions()
 
+
+class ParameterizedResultsCache(object):
+    """
+    Points at the latest results of parameterized queries, by query and parameter values: executing a query with
+    parameters gives a different query text (and hash) for each set of values, which QueryResult.get_latest can only
+    find by scanning the query's results.
+
+    Entries expire after the query's max age (its `parameters_cache_max_age` option, or
+    settings.PARAMETERIZED_RESULTS_CACHE_MAX_AGE; 0 disables the cache), and the least recently used entries are evicted
+    when there are more than settings.PARAMETERIZED_RESULTS_CACHE_SIZE of them.
+    """
+    KEY_PREFIX = 'parameterized_result'
+    LRU_KEY = 'parameterized_results:lru'
+    EXPIRY_KEY = 'parameterized_results:expiry'
+    STATS_KEY = 'parameterized_results:stats'
+
+    @staticmethod
+    def max_age(query):
+        return int((query.options or {}).get('parameters_cache_max_age', settings.PARAMETERIZED_RESULTS_CACHE_MAX_AGE))
+
+    def _key(self, query, parameter_values):
+        # Only the parameters the query uses, in a stable order:
+        parameters = [(name, unicode(parameter_values.get(name)))
+                      for name in sorted(set(utils.collect_query_parameters(query.query_text)))]
+        digest = hashlib.md5(json.dumps([query.query_hash, query.data_source_id, parameters])).hexdigest()
+        return '{}:{}:{}'.format(self.KEY_PREFIX, query.id, digest)
+
+    def get(self, query, parameter_values, max_age=None):
+        """
+        The cached result, if there's one (and, when `max_age` is given, it's at most `max_age` seconds old).
+        """
+        if self.max_age(query) <= 0 or max_age == 0:
+            return None
+
+        key = self._key(query, parameter_values)
+        query_result_id = redis_connection.get(key)
+        # The result could have been cleaned up since:
+        query_result = QueryResult.query.get(int(query_result_id)) if query_result_id else None
+
+        pipe = redis_connection.pipeline()
+        if query_result is None:
+            pipe.delete(key)
+            self._forget(pipe, [key])
+
+        if query_result and max_age is not None:
+            if (utils.utcnow() - query_result.retrieved_at).total_seconds() > max_age:
+                query_result = None
+
+        if query_result:
+            pipe.zadd(self.LRU_KEY, time.time(), key)
+            pipe.hincrby(self.STATS_KEY, 'hits')
+            statsd_client.incr('parameterized_results_cache.hit')
+        else:
+            pipe.hincrby(self.STATS_KEY, 'misses')
+            statsd_client.incr('parameterized_results_cache.miss')
+        pipe.execute()
+
+        return query_result
+
+    def set(self, query, parameter_values, query_result):
+        # Expires when the result becomes older than the max age:
+        ttl = self.max_age(query) - int((utils.utcnow() - query_result.retrieved_at).total_seconds())
+        if ttl <= 0:
+            return
+
+        key = self._key(query, parameter_values)
+        now = time.time()
+        pipe = redis_connection.pipeline()
+        pipe.set(key, query_result.id, ex=ttl)
+        pipe.zadd(self.LRU_KEY, now, key)
+        pipe.zadd(self.EXPIRY_KEY, now + ttl, key)
+        pipe.execute()
+
+        self._prune(now)
+        excess = redis_connection.zcard(self.LRU_KEY) - settings.PARAMETERIZED_RESULTS_CACHE_SIZE
+        if excess > 0:
+            self._evict(excess)
+
+    def _forget(self, pipe, keys):
+        pipe.zrem(self.LRU_KEY, *keys)
+        pipe.zrem(self.EXPIRY_KEY, *keys)
+
+    def _prune(self, now):
+        """Forget the entries that expired (their keys are gone already)."""
+        keys = redis_connection.zrangebyscore(self.EXPIRY_KEY, '-inf', now)
+        if keys:
+            pipe = redis_connection.pipeline()
+            self._forget(pipe, keys)
+            pipe.execute()
+
+    def _evict(self, count):
+        keys = redis_connection.zrange(self.LRU_KEY, 0, count - 1)
+        if keys:
+            pipe = redis_connection.pipeline()
+            pipe.delete(*keys)
+            self._forget(pipe, keys)
+            pipe.hincrby(self.STATS_KEY, 'evictions', len(keys))
+            pipe.execute()
+
+    def stats(self):
+        stats = redis_connection.hgetall(self.STATS_KEY)
+        return {
+            'size': redis_connection.zcard(self.LRU_KEY),
+            'hits': int(stats.get('hits', 0)),
+            'misses': int(stats.get('misses', 0)),
+            'evictions': int(stats.get('evictions', 0)),
+        }
+
+parameterized_results_cache = ParameterizedResultsCache()
+
 # AccessPermission and Change use a 'generic foreign key' approach to refer to
 # either queries or dashboards.
 # TODO replace this with association tables.
@@ -563,7 +683,8 @@ class DataSource(BelongsToOrgMixin, db.Model):
         return cls.query.filter(cls.id == _id).one()
 
     def delete(self):
-        Query.query.filter(Query.data_source == self).update(dict(data_source_id=None, latest_query_data_id=None))
+        Query.query.filter(Query.data_source == self).update(dict(data_source_id=None, latest_query_data_id=None,
+                                                                  next_run_at=None))
         QueryResult.query.filter(QueryResult.data_source == self).delete()
         res = db.session.delete(self)
         db.session.commit()
@@ -658,26 +779,147 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     data_source = db.relationship(DataSource, backref=backref('query_results'))
     query_hash = Column(db.String(32), index=True)
     query_text = Column('query', db.Text)
-    data = Column(db.Text)
+    # Encoded with redash.utils.result_codec, use the `data` property or `reader()` to access it.
+    _data = Column('data', db.LargeBinary, nullable=True)
+    # SHA-256 of the stored data, to reuse a query's result when it's executed again and returns the same data.
+    data_hash = Column(db.String(64))
+    # Key of the data in the query results storage (redash.utils.result_storage) when it's stored there instead of in
+    # the `data` column, and the size of the stored data.
+    storage_key = Column(db.String(255), nullable=True)
+    data_size = Column(db.Integer, nullable=True)
     runtime = Column(postgresql.DOUBLE_PRECISION)
     retrieved_at = Column(db.DateTime(True))
 
     __tablename__ = 'query_results'
+    __table_args__ = (db.Index('query_results_data_source_id_query_hash_retrieved_at',
+                               'data_source_id', 'query_hash', retrieved_at.desc()),
+                      db.Index('query_results_retrieved_at_id', 'retrieved_at', 'id'))
 
-    def to_dict(self):
-        return {
+    # Rows per sheet in XLSX exports, including the header row.
+    EXCEL_MAX_ROWS = 1048576
+
+    # Data is written to the query results storage before the result referring to it is committed, and deleted once no
+    # result refers to it. Both hold a lock of the key until their transaction ends, so a cleanup never deletes data a
+    # result is being stored with. Written keys are kept track of, so data of results that got rolled back is swept too.
+    STORAGE_WRITES_KEY = 'query_results_storage:writes'
+
+    @property
+    def data(self):
+        with self._open_payload() as payload:
+            return result_codec.deserialize(payload)
+
+    @data.setter
+    def data(self, data):
+        payload = result_codec.serialize(data)
+        self.data_hash = self._hash_data(payload)
+        self.data_size = len(payload) if payload is not None else None
+
+        storage = result_storage.get_result_storage()
+        if storage is not None and payload is not None and len(payload) >= settings.QUERY_RESULTS_STORAGE_THRESHOLD:
+            # Keys are the data's hash, so results with the same data share the stored object.
+            self.storage_key = '{}/{}'.format(self.data_hash[:2], self.data_hash)
+            self._lock_storage_key(self.storage_key)
+            storage.put(self.storage_key, payload)
+            redis_connection.zadd(self.STORAGE_WRITES_KEY, time.time(), self.storage_key)
+            self._data = None
+        else:
+            self.storage_key = None
+            self._data = payload
+
+    @contextmanager
+    def _open_payload(self):
+        if self.storage_key is None:
+            yield self._data
+            return
+
+        storage = result_storage.get_result_storage()
+        if storage is None:
+            raise result_storage.ResultStorageError(
+                "Query result {} is in the query results storage, which isn't configured.".format(self.id))
+
+        payload = storage.open(self.storage_key)
+        try:
+            yield payload
+        finally:
+            payload.close()
+
+    @staticmethod
+    def _lock_storage_key(key):
+        db.session.execute(db.select([db.func.pg_advisory_xact_lock(db.func.hashtext(key))]))
+
+    @staticmethod
+    def _hash_data(payload):
+        if payload is None:
+            return None
+
+        return hashlib.sha256(payload).hexdigest()
+
+    @contextmanager
+    def reader(self):
+        with self._open_payload() as payload:
+            yield result_codec.ResultReader(payload)
+
+    @staticmethod
+    def _slice_meta(reader, columns):
+        meta = dict(reader.meta)
+        if columns is not None:
+            meta['columns'] = [c for c in reader.columns if c['name'] in columns]
+        meta['row_count'] = reader.row_count
+        return meta
+
+    def data_slice(self, offset=0, limit=None, columns=None):
+        """
+        The result with only rows [offset, offset + limit) and (if given) only the named columns. `row_count` is the
+        total number of rows in the result.
+        """
+        with self.reader() as reader:
+            data = self._slice_meta(reader, columns)
+            data['rows'] = list(reader.iter_rows(offset, limit, columns))
+        return data
+
+    def to_dict(self, offset=0, limit=None, columns=None, with_data=True):
+        d = {
             'id': self.id,
             'query_hash': self.query_hash,
             'query': self.query_text,
-            'data': json.loads(self.data),
             'data_source_id': self.data_source_id,
             'runtime': self.runtime,
             'retrieved_at': self.retrieved_at
         }
 
+        if with_data:
+            if offset or limit is not None or columns is not None:
+                d['data'] = self.data_slice(offset, limit, columns)
+            else:
+                d['data'] = self.data
+
+        return d
+
+    def iter_json(self, offset=0, limit=None, columns=None):
+        """
+        Yield the JSON text of to_dict() in pieces. The result data is written from the stored payload a batch of rows
+        at a time, instead of being decoded as a whole and serialized again. Complete results stored as JSON (from
+        before the chunked format) are copied as is, without decoding them.
+        """
+        with self._open_payload() as payload:
+            try:
+                reader = result_codec.ResultReader(payload)
+                if offset or limit is not None or columns is not None:
+                    meta = self._slice_meta(reader, columns)
+                else:
+                    meta = None
+            except result_codec.ResultFormatError:
+                yield json_dumps(self.to_dict(offset, limit, columns))
+                return
+
+            yield json_dumps(self.to_dict(with_data=False))[:-1] + ', "data": '
+            for piece in reader.iter_json(meta, offset, limit, columns):
+                yield piece
+            yield '}'
+
     @classmethod
     def unused(cls, days=7):
-        age_threshold = datetime.datetime.now() - datetime.timedelta(days=days)
+        age_threshold = utils.utcnow() - datetime.timedelta(days=days)
 
         unused_results = (db.session.query(QueryResult.id).filter(
             Query.id == None, QueryResult.retrieved_at < age_threshold)
@@ -685,45 +927,120 @@ class QueryResult(db.Model, BelongsToOrgMixin):
 
         return unused_results
 
+    @classmethod
+    def delete_unused(cls, retrieved_before, after=None, limit=100):
+        """
+        Delete the unused results (that no query links to) among the next `limit` results retrieved before
+        `retrieved_before`, in (retrieved_at, id) order from after the `after` key.
+
+        Returns the key of the last result gone through (None when there are no more), and the storage keys of the
+        deleted results (None for results stored in the database).
+        """
+        batch = db.session.query(cls.retrieved_at, cls.id).filter(cls.retrieved_at < retrieved_before)
+        if after is not None:
+            batch = batch.filter(db.tuple_(cls.retrieved_at, cls.id) > db.tuple_(*after))
+        batch = batch.order_by(cls.retrieved_at, cls.id).limit(limit).all()
+        if not batch:
+            return None, []
+
+        ids = [result_id for _, result_id in batch]
+        used_ids = db.session.query(Query.latest_query_data_id).filter(Query.latest_query_data_id.in_(ids))
+        table = cls.__table__
+        deleted = db.session.execute(
+            table.delete()
+            .where(table.c.id.in_(ids))
+            .where(~table.c.id.in_(used_ids))
+            .returning(table.c.storage_key)).fetchall()
+
+        return tuple(batch[-1]), [storage_key for storage_key, in deleted]
+
+    @classmethod
+    def delete_unreferenced_data(cls, storage_keys):
+        """
+        Delete the stored data of the given keys from the query results storage, except for keys that results still
+        refer to (results with the same data share it). Returns the number of deleted keys.
+
+        The keys stay locked until the transaction ends, so results with the same data wait for it to be stored again.
+        """
+        storage = result_storage.get_result_storage()
+        if storage is None:
+            return 0
+
+        # In the same order everywhere, so concurrent cleanups don't deadlock:
+        storage_keys = sorted(set(storage_keys))
+        for key in storage_keys:
+            cls._lock_storage_key(key)
+
+        referenced = set(key for key, in db.session.query(cls.storage_key).filter(cls.storage_key.in_(storage_keys)))
+        unreferenced = set(storage_keys) - referenced
+        for key in unreferenced:
+            storage.delete(key)
+
+        return len(unreferenced)
+
+    @classmethod
+    def sweep_stored_data(cls, written_before, limit=1000):
+        """
+        Delete the data written to the query results storage before the `written_before` timestamp that no result
+        refers to -- as the transaction storing the result was rolled back. Returns the number of deleted keys.
+        """
+        storage_keys = redis_connection.zrangebyscore(cls.STORAGE_WRITES_KEY, '-inf', written_before,
+                                                      start=0, num=limit)
+        if not storage_keys:
+            return 0
+
+        # Data that results refer to is deleted with them (see delete_unused), it needs no tracking anymore either way.
+        deleted = cls.delete_unreferenced_data(storage_keys)
+        redis_connection.zrem(cls.STORAGE_WRITES_KEY, *storage_keys)
+        return deleted
+
     @classmethod
     def get_latest(cls, data_source, query, max_age=0):
         query_hash = utils.gen_query_hash(query)
 
-        if max_age == -1:
-            q = db.session.query(QueryResult).filter(
-                cls.query_hash == query_hash,
-                cls.data_source == data_source).order_by(
-                    QueryResult.retrieved_at.desc())
-        else:
-            q = db.session.query(QueryResult).filter(
-                QueryResult.query_hash == query_hash,
-                QueryResult.data_source == data_source,
-                db.func.timezone('utc', QueryResult.retrieved_at) +
-                datetime.timedelta(seconds=max_age) >=
-                db.func.timezone('utc', db.func.now())
-                ).order_by(QueryResult.retrieved_at.desc())
+        # Matches the (data_source_id, query_hash, retrieved_at DESC) index, so it reads a single index entry regardless
+        # of the number of results the query has.
+        q = db.session.query(QueryResult).filter(
+            cls.data_source_id == data_source.id,
+            cls.query_hash == query_hash)
 
-        return q.first()
+        if max_age != -1:
+            # retrieved_at is compared as is (to a constant), so the index is used for this condition too:
+            q = q.filter(cls.retrieved_at >= db.func.now() - datetime.timedelta(seconds=max_age))
+
+        return q.order_by(cls.retrieved_at.desc()).first()
 
     @classmethod
     def store_result(cls, org, data_source, query_hash, query, data, run_time, retrieved_at):
-        query_result = cls(org=org,
-                           query_hash=query_hash,
-                           query_text=query,
-                           runtime=run_time,
-                           data_source=data_source,
-                           retrieved_at=retrieved_at,
-                           data=data)
+        payload = result_codec.serialize(data)
+        data_hash = cls._hash_data(payload)
+
+        # When the query returned the same data as a previous execution, the stored result is reused and only its
+        # retrieval time (and runtime) are updated.
+        query_result = None
+        if data_hash is not None:
+            query_result = cls.query.filter(
+                cls.query_hash == query_hash,
+                cls.data_source == data_source,
+                cls.data_hash == data_hash).order_by(cls.retrieved_at.desc()).first()
+
+        if query_result:
+            query_result.retrieved_at = retrieved_at
+            query_result.runtime = run_time
+            logging.info("Reused query (%s) data with the same hash; id=%s", query_hash, query_result.id)
+        else:
+            query_result = cls(org=org,
+                               query_hash=query_hash,
+                               query_text=query,
+                               runtime=run_time,
+                               data_source=data_source,
+                               retrieved_at=retrieved_at,
+                               data=payload)
+            logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
         db.session.add(query_result)
-        logging.info("Inserted query (%s) data; id=%s", query_hash, query_result.id)
-        # TODO: Investigate how big an impact this select-before-update makes.
-        queries = db.session.query(Query).filter(
-            Query.query_hash == query_hash,
-            Query.data_source == data_source)
-        for q in queries:
-            q.latest_query_data = query_result
-            db.session.add(q)
-        query_ids = [q.id for q in queries]
+        db.session.flush()
+
+        query_ids = Query.set_latest_query_data(data_source, query_hash, query_result)
         logging.info("Updated %s queries with result (%s).", len(query_ids), query_hash)
 
         return query_result, query_ids
@@ -735,46 +1052,109 @@ class QueryResult(db.Model, BelongsToOrgMixin):
     def groups(self):
         return self.data_source.groups
 
-    def make_csv_content(self):
+    def iter_csv_content(self, batch_size=1000):
+        """Yield the CSV file of the result in pieces of `batch_size` rows, decoding the rows as they're written."""
         s = cStringIO.StringIO()
 
-        query_data = json.loads(self.data)
-        writer = csv.DictWriter(s, extrasaction="ignore", fieldnames=[col['name'] for col in query_data['columns']])
-        writer.writer = utils.UnicodeWriter(s)
-        writer.writeheader()
-        for row in query_data['rows']:
-            writer.writerow(row)
+        with self.reader() as reader:
+            column_names = [col['name'] for col in reader.columns]
+            writer = utils.UnicodeWriter(s)
+            writer.writerow(column_names)
+            for i, row in enumerate(reader.iter_rows(), 1):
+                writer.writerow([row.get(name, '') for name in column_names])
+                if i % batch_size == 0:
+                    yield s.getvalue()
+                    s.seek(0)
+                    s.truncate()
+
+        if s.tell():
+            yield s.getvalue()
+
+    def make_csv_content(self):
+        return ''.join(self.iter_csv_content())
+
+    def write_excel(self, f):
+        """
+        Write the result as an XLSX workbook to `f` (a file name or a file object). Rows are written through
+        xlsxwriter's temporary files (constant_memory), and results longer than Excel's row limit continue on
+        additional sheets.
+        """
+        with self.reader() as reader:
+            book = xlsxwriter.Workbook(f, {'constant_memory': True})
+            column_names = [col['name'] for col in reader.columns]
+            rows_per_sheet = self.EXCEL_MAX_ROWS - 1
+
+            sheet = None
+            for (i, row) in enumerate(reader.iter_rows()):
+                r = i % rows_per_sheet
+                if r == 0:
+                    sheet = self._add_excel_sheet(book, column_names)
+
+                values = []
+                for name in column_names:
+                    v = row.get(name)
+                    if isinstance(v, (list, dict)):
+                        v = json_dumps(v)
+                    values.append(v)
+                sheet.write_row(r + 1, 0, values)
+
+        if sheet is None:
+            self._add_excel_sheet(book, column_names)
+
+        book.close()
+
+    @staticmethod
+    def _add_excel_sheet(book, column_names):
+        if book.worksheets():
+            sheet = book.add_worksheet("result {}".format(len(book.worksheets()) + 1))
+        else:
+            sheet = book.add_worksheet("result")
+
+        sheet.write_row(0, 0, column_names)
+        return sheet
 
-        return s.getvalue()
+    def iter_excel_content(self, block_size=64 * 1024):
+        """Yield the XLSX workbook of the result in blocks, from a temporary file it's spooled to."""
+        with tempfile.TemporaryFile() as f:
+            self.write_excel(f)
+            f.seek(0)
+            for block in iter(lambda: f.read(block_size), ''):
+                yield block
 
     def make_excel_content(self):
-        s = cStringIO.StringIO()
+        return ''.join(self.iter_excel_content())
 
-        query_data = json.loads(self.data)
-        book = xlsxwriter.Workbook(s, {'constant_memory': True})
-        sheet = book.add_worksheet("result")
 
-        column_names = []
-        for (c, col) in enumerate(query_data['columns']):
-            sheet.write(0, c, col['name'])
-            column_names.append(col['name'])
+def schedule_jitter(schedule, seed):
+    """
+    The offset (in seconds) of runs of a query with the given schedule from the scheduled time, within
+    settings.SCHEDULE_JITTER_WINDOW. `seed` is a hex digest identifying the query (its query hash).
+    """
+    fraction = (int(seed[:8], 16) % 10000) / 10000.0
 
-        for (r, row) in enumerate(query_data['rows']):
-            for (c, name) in enumerate(column_names):
-                v = row.get(name)
-                if isinstance(v, list):
-                    v = str(v).encode('utf-8')
-                sheet.write(r + 1, c, v)
+    if schedule.isdigit():
+        return fraction * min(settings.SCHEDULE_JITTER_WINDOW, int(schedule))
 
-        book.close()
+    return fraction * min(settings.SCHEDULE_JITTER_WINDOW, 3600 * 6)
 
-        return s.getvalue()
 
+def _next_interval_run(previous_iteration, ttl, offset):
+    # Runs are at fixed times, every ttl seconds (since the epoch) plus the query's offset, so however late each run
+    # happens the query still runs once per ttl on average. The next one is the first of these over half an interval
+    # after the previous run (which might have been a little late, or early).
+    previous = calendar.timegm(previous_iteration.utctimetuple()) + previous_iteration.microsecond / 1e6
+    next_run = offset + ttl * (math.floor((previous + ttl / 2.0 - offset) / ttl) + 1)
+    return previous_iteration + datetime.timedelta(seconds=next_run - previous)
 
-def should_schedule_next(previous_iteration, now, schedule, failures):
+
+def next_scheduled_run(previous_iteration, schedule, failures, jitter_seed=None):
+    jitter = jitter_seed and settings.SCHEDULE_JITTER_WINDOW
     if schedule.isdigit():
         ttl = int(schedule)
-        next_iteration = previous_iteration + datetime.timedelta(seconds=ttl)
+        if jitter:
+            next_iteration = _next_interval_run(previous_iteration, ttl, schedule_jitter(schedule, jitter_seed))
+        else:
+            next_iteration = previous_iteration + datetime.timedelta(seconds=ttl)
     else:
         hour, minute = schedule.split(':')
         hour, minute = int(hour), int(minute)
@@ -788,9 +1168,15 @@ def should_schedule_next(previous_iteration, now, schedule, failures):
             previous_iteration = normalized_previous_iteration - datetime.timedelta(days=1)
 
         next_iteration = (previous_iteration + datetime.timedelta(days=1)).replace(hour=hour, minute=minute)
+        if jitter:
+            next_iteration += datetime.timedelta(seconds=schedule_jitter(schedule, jitter_seed))
     if failures:
         next_iteration += datetime.timedelta(minutes=2**failures)
-    return now > next_iteration
+    return next_iteration
+
+
+def should_schedule_next(previous_iteration, now, schedule, failures):
+    return now > next_scheduled_run(previous_iteration, schedule, failures)
 
 
 class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
@@ -800,7 +1186,7 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     org = db.relationship(Organization, backref="queries")
     data_source_id = Column(db.Integer, db.ForeignKey("data_sources.id"), nullable=True)
     data_source = db.relationship(DataSource, backref='queries')
-    latest_query_data_id = Column(db.Integer, db.ForeignKey("query_results.id"), nullable=True)
+    latest_query_data_id = Column(db.Integer, db.ForeignKey("query_results.id"), nullable=True, index=True)
     latest_query_data = db.relationship(QueryResult)
     name = Column(db.String(255))
     description = Column(db.String(4096), nullable=True)
@@ -816,6 +1202,9 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     is_draft = Column(db.Boolean, default=True, index=True)
     schedule = Column(db.String(10), nullable=True)
     schedule_failures = Column(db.Integer, default=0)
+    # When the query is due to be refreshed next, kept up to date when its schedule, schedule failures or latest result
+    # change. The scheduler only looks at queries that are due according to it.
+    next_run_at = Column(db.DateTime(True), nullable=True, index=True)
     visualizations = db.relationship("Visualization", cascade="all, delete-orphan")
     options = Column(MutableDict.as_mutable(PseudoJSON), default={})
 
@@ -915,28 +1304,69 @@ class Query(ChangeTrackingMixin, TimestampMixin, BelongsToOrgMixin, db.Model):
     def by_user(cls, user):
         return cls.all_queries(user.group_ids, user.id).filter(Query.user == user)
 
+    @classmethod
+    def set_latest_query_data(cls, data_source, query_hash, query_result):
+        """
+        Point all the queries with the given hash on the data source at the result, and return their ids.
+
+        Updates them with a single statement instead of loading & flushing each one. Like an ORM update of
+        latest_query_data it leaves their version as is, bumps updated_at (the column's onupdate), and sets the next run
+        time of the scheduled ones.
+        """
+        queries = cls.__table__
+        updated = db.session.execute(
+            queries.update()
+            .where(queries.c.query_hash == query_hash)
+            .where(queries.c.data_source_id == data_source.id)
+            .values(latest_query_data_id=query_result.id)
+            .returning(queries.c.id, queries.c.schedule, queries.c.schedule_failures)).fetchall()
+
+        next_runs = [{'query_id': query_id,
+                      'query_next_run_at': query_next_run_at(query_hash, schedule, schedule_failures, query_result)}
+                     for query_id, schedule, schedule_failures in updated if schedule]
+        if next_runs:
+            db.session.execute(
+                queries.update()
+                .where(queries.c.id == db.bindparam('query_id'))
+                .values(next_run_at=db.bindparam('query_next_run_at')),
+                next_runs)
+
+        # Queries already loaded in the session reload the updated columns when they're next accessed:
+        query_ids = [query_id for query_id, _, _ in updated]
+        for query_id in query_ids:
+            query = db.session.identity_map.get(db.session.identity_key(cls, query_id))
+            if query is not None:
+                db.session.expire(query, ['latest_query_data', 'latest_query_data_id', 'next_run_at', 'updated_at'])
+
+        return query_ids
+
     @classmethod
     def outdated_queries(cls):
+        now = utils.utcnow()
         queries = (db.session.query(Query)
                    .options(joinedload(Query.latest_query_data).load_only('retrieved_at'))
-                   .filter(Query.schedule != None)
-                   .order_by(Query.id))
+                   .filter(Query.schedule != None, Query.next_run_at <= now)
+                   .order_by(Query.id)).all()
 
-        now = utils.utcnow()
         outdated_queries = {}
-        scheduled_queries_executions.refresh()
+        scheduled_queries_executions.refresh([query.id for query in queries])
 
         for query in queries:
-            if query.latest_query_data:
+            retrieved_at = scheduled_queries_executions.get(query.id)
+            if retrieved_at is None and query.latest_query_data:
                 retrieved_at = query.latest_query_data.retrieved_at
-            else:
-                retrieved_at = now
 
-            retrieved_at = scheduled_queries_executions.get(query.id) or retrieved_at
+            if retrieved_at is None:
+                query.next_run_at = None
+                continue
 
-            if should_schedule_next(retrieved_at, now, query.schedule, query.schedule_failures):
+            next_run_at = next_scheduled_run(retrieved_at, query.schedule, query.schedule_failures, query.query_hash)
+            if now > next_run_at:
                 key = "{}:{}".format(query.query_hash, query.data_source_id)
                 outdated_queries[key] = query
+            else:
+                # Already enqueued since its latest result: it's due again a full period after that.
+                query.next_run_at = next_run_at
 
         return outdated_queries.values()
 
@@ -1039,6 +1469,29 @@ def query_last_modified_by(target, val, oldval, initiator):
     target.last_modified_by_id = val
 
 
+def query_next_run_at(query_hash, schedule, schedule_failures, latest_query_data):
+    # Queries that weren't executed yet aren't scheduled.
+    if not schedule or latest_query_data is None or latest_query_data.retrieved_at is None:
+        return None
+
+    return next_scheduled_run(latest_query_data.retrieved_at, unicode(schedule), schedule_failures, query_hash)
+
+
+@listens_for(Query.schedule, 'set')
+def query_schedule_changed(target, val, oldval, initiator):
+    target.next_run_at = query_next_run_at(target.query_hash, val, target.schedule_failures, target.latest_query_data)
+
+
+@listens_for(Query.schedule_failures, 'set')
+def query_schedule_failures_changed(target, val, oldval, initiator):
+    target.next_run_at = query_next_run_at(target.query_hash, target.schedule, val, target.latest_query_data)
+
+
+@listens_for(Query.latest_query_data, 'set')
+def query_latest_query_data_changed(target, val, oldval, initiator):
+    target.next_run_at = query_next_run_at(target.query_hash, target.schedule, target.schedule_failures, val)
+
+
 class AccessPermission(GFKBase, db.Model):
     id = Column(db.Integer, primary_key=True)
     # 'object' defined in GFKBase
@@ -1199,9 +1652,11 @@ class Alert(TimestampMixin, db.Model):
         return d
 
     def value(self):
-        data = json.loads(self.query_rel.latest_query_data.data)
-        if data['rows']:
-            value = data['rows'][0][self.options['column']]
+        # Only the first row is needed, so the rest of the result isn't decoded.
+        with self.query_rel.latest_query_data.reader() as reader:
+            rows = list(reader.iter_rows(limit=1))
+        if rows:
+            value = rows[0][self.options['column']]
             op = self.options['op']
 
             if op == 'greater than' and value > self.options['value']:
@@ -1213,7 +1668,7 @@ class Alert(TimestampMixin, db.Model):
             else:
                 new_state = self.OK_STATE
         # todo: safe guard for empty
-        return data['rows'][0][self.options['column']]
+        return rows[0][self.options['column']]
 
     def evaluate(self):
         value = self.value()
@@ -1464,8 +1919,30 @@ class Widget(TimestampMixin, db.Model):
         return db.session.query(cls).join(Dashboard).filter(cls.id == widget_id, Dashboard.org == org).one()
 
 
+@compiles(CreateTable, 'postgresql')
+def _create_partitioned_table(create, compiler, **kw):
+    """
+    Creates tables with a `partition_by` info entry as partitioned tables.
+    """
+    statement = compiler.visit_create_table(create, **kw)
+    partition_by = create.element.info.get('partition_by')
+    if partition_by:
+        statement = u"{} PARTITION BY {}\n\n".format(statement.rstrip(), partition_by)
+    return statement
+
+
+def month_start(value, months=0):
+    month = value.year * 12 + value.month - 1 + months
+    return datetime.datetime(month // 12, month % 12 + 1, 1, tzinfo=value.tzinfo)
+
+
 class Event(db.Model):
-    id = Column(db.Integer, primary_key=True)
+    """
+    Events are range partitioned by month on created_at: events_history has all the events up to when the table got
+    partitioned, and then there is an events_YYYY_MM partition for each month. Partitions are created ahead of time
+    (see create_partitions), and retention drops whole partitions (see drop_partitions).
+    """
+    id = Column(db.Integer, primary_key=True, autoincrement=True)
     org_id = Column(db.Integer, db.ForeignKey("organizations.id"))
     org = db.relationship(Organization, backref="events")
     user_id = Column(db.Integer, db.ForeignKey("users.id"), nullable=True)
@@ -1474,9 +1951,11 @@ class Event(db.Model):
     object_type = Column(db.String(255))
     object_id = Column(db.String(255), nullable=True)
     additional_properties = Column(MutableDict.as_mutable(PseudoJSON), nullable=True, default={})
-    created_at = Column(db.DateTime(True), default=db.func.now())
+    created_at = Column(db.DateTime(True), primary_key=True, default=db.func.now())
 
     __tablename__ = 'events'
+    __table_args__ = {'info': {'partition_by': 'RANGE (created_at)'}}
+    __mapper_args__ = {'primary_key': [id]}
 
     def __unicode__(self):
         return u"%s,%s,%s,%s" % (self.user_id, self.action, self.object_type, self.object_id)
@@ -1492,8 +1971,8 @@ class Event(db.Model):
             'created_at': self.created_at.isoformat()
         }
 
-    @classmethod
-    def record(cls, event):
+    @staticmethod
+    def values(event):
         org_id = event.pop('org_id')
         user_id = event.pop('user_id', None)
         action = event.pop('action')
@@ -1502,13 +1981,96 @@ class Event(db.Model):
 
         created_at = datetime.datetime.utcfromtimestamp(event.pop('timestamp'))
 
-        event = cls(org_id=org_id, user_id=user_id, action=action,
+        return dict(org_id=org_id, user_id=user_id, action=action,
                     object_type=object_type, object_id=object_id,
                     additional_properties=event,
                     created_at=created_at)
+
+    @classmethod
+    def record(cls, event):
+        event = cls(**cls.values(event))
         db.session.add(event)
         return event
 
+    @classmethod
+    def record_many(cls, events):
+        """
+        Records the given events with a single INSERT. Returns them as (transient) Event objects.
+        """
+        rows = [cls.values(event) for event in events]
+        if rows:
+            db.session.execute(cls.__table__.insert().values(rows))
+        return [cls(**row) for row in rows]
+
+    @classmethod
+    def partitions(cls, connection=None):
+        """
+        Returns the partitions of the events table as (name, from, to) tuples, ordered by their range. The first
+        partition's from is None (it has the events from the beginning).
+        """
+        connection = connection or db.session
+        bounds = connection.execute("""
+            SELECT partition.relname, pg_get_expr(partition.relpartbound, partition.oid)
+            FROM pg_inherits JOIN pg_class partition ON partition.oid = pg_inherits.inhrelid
+            WHERE pg_inherits.inhparent = 'events'::regclass
+        """)
+
+        partitions = []
+        for name, bound in bounds:
+            lower, upper = [None if value == 'MINVALUE' else parse_date(value.strip("'"))
+                            for value in re.findall(r"\(([^)]+)\)", bound)]
+            partitions.append((name, lower, upper))
+        return sorted(partitions, key=lambda partition: partition[2])
+
+    @classmethod
+    def create_partitions(cls, months_ahead=None, connection=None):
+        """
+        Makes sure there are partitions for this month and the next `months_ahead` months (default:
+        settings.EVENTS_PARTITIONS_AHEAD), so events never wait on one being created. Returns the created partitions'
+        names.
+        """
+        connection = connection or db.session
+        if months_ahead is None:
+            months_ahead = settings.EVENTS_PARTITIONS_AHEAD
+
+        partitions = cls.partitions(connection)
+        if partitions:
+            start = partitions[-1][2]
+        else:
+            # A new table: the history partition takes whatever came before this month.
+            start = month_start(utils.utcnow())
+            connection.execute("CREATE TABLE events_history PARTITION OF events "
+                               "FOR VALUES FROM (MINVALUE) TO ('{}')".format(start.isoformat()))
+
+        created = []
+        end = month_start(utils.utcnow(), months_ahead + 1)
+        while start < end:
+            name = start.strftime('events_%Y_%m')
+            connection.execute("CREATE TABLE {} PARTITION OF events FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, start.isoformat(), month_start(start, 1).isoformat()))
+            created.append(name)
+            start = month_start(start, 1)
+        return created
+
+    @classmethod
+    def drop_partitions(cls, before, connection=None):
+        """
+        Drops the partitions that only have events from before `before`, which is O(1) for any number of events
+        unlike deleting them. Returns the dropped partitions' names.
+        """
+        connection = connection or db.session
+        dropped = []
+        for name, _, upper in cls.partitions(connection):
+            if upper <= before:
+                connection.execute("DROP TABLE {}".format(name))
+                dropped.append(name)
+        return dropped
+
+
+@listens_for(Event.__table__, 'after_create')
+def create_event_partitions(target, connection, **kw):
+    Event.create_partitions(connection=connection)
+
 
 class ApiKey(TimestampMixin, GFKBase, db.Model):
     id = Column(db.Integer, primary_key=True)
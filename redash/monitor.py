@@ -12,6 +12,7 @@ def get_status():
         status['unused_query_results_count'] = models.QueryResult.unused().count()
     status['dashboards_count'] = models.Dashboard.query.count()
     status['widgets_count'] = models.Widget.query.count()
+    status['parameterized_results_cache'] = models.parameterized_results_cache.stats()
 
     status['workers'] = []
 
@@ -1,15 +1,19 @@
 import sys
 import logging
 import json
+from copy import deepcopy
 
 from collections import OrderedDict
 from redash import settings
+from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
 __all__ = [
     'BaseQueryRunner',
     'InterruptException',
+    'QueryRunnerError',
+    'limit_result',
     'BaseSQLQueryRunner',
     'TYPE_DATETIME',
     'TYPE_BOOLEAN',
@@ -45,6 +49,51 @@ class InterruptException(Exception):
     pass
 
 
+class QueryRunnerError(Exception):
+    """Raised by run_query_iter() with the error message run_query() would have returned."""
+    pass
+
+
+def _estimate_row_size(row):
+    return sum(len(value) if isinstance(value, basestring) else 8 for value in row.itervalues())
+
+
+def limit_result(batches, max_rows=None, max_bytes=None):
+    """
+    Pass through batches of rows until `max_rows` rows or (roughly, by the length of their values) `max_bytes` bytes
+    were returned, then stop consuming `batches` and yield `{'truncated': True}`. Zero or None means no limit.
+    """
+    row_count = 0
+    byte_count = 0
+
+    for rows in batches:
+        if isinstance(rows, dict):
+            yield rows
+            continue
+
+        if max_rows and row_count + len(rows) > max_rows:
+            rows = rows[:max_rows - row_count]
+            truncated = True
+        else:
+            truncated = False
+
+        if max_bytes:
+            for i, row in enumerate(rows):
+                byte_count += _estimate_row_size(row)
+                if byte_count > max_bytes:
+                    rows = rows[:i]
+                    truncated = True
+                    break
+
+        row_count += len(rows)
+        if rows:
+            yield rows
+
+        if truncated:
+            yield {'truncated': True}
+            return
+
+
 class BaseQueryRunner(object):
     noop_query = None
 
@@ -83,6 +132,61 @@ class BaseQueryRunner(object):
     def run_query(self, query, user):
         raise NotImplementedError()
 
+    @property
+    def fetch_size(self):
+        return settings.QUERY_RUNNER_FETCH_SIZE
+
+    @property
+    def max_result_rows(self):
+        return int(self.configuration.get('max_result_rows') or settings.QUERY_RESULTS_MAX_ROWS)
+
+    @property
+    def max_result_bytes(self):
+        return int(self.configuration.get('max_result_bytes') or settings.QUERY_RESULTS_MAX_BYTES)
+
+    @property
+    def max_concurrent_queries(self):
+        return int(self.configuration.get('max_concurrent_queries') or settings.DATA_SOURCE_MAX_CONCURRENT_QUERIES)
+
+    def run_query_iter(self, query, user):
+        """
+        Run the query and yield the result incrementally: first the result without its rows (a dict with `columns` and
+        any other keys), then lists of rows. A dict yielded after the rows updates the result's keys (for example
+        `{'truncated': True}`, see limit_result()). Failures are raised as QueryRunnerError.
+
+        This default implementation adapts run_query(), so the whole result is still loaded at once. Query runners that
+        can fetch rows in batches override it (and implement run_query() with _run_query_from_iter()).
+        """
+        json_data, error = self.run_query(query, user)
+        if error is not None:
+            raise QueryRunnerError(error)
+
+        if json_data is None:
+            raise QueryRunnerError("No data was returned.")
+
+        data = json.loads(json_data)
+        rows = data.pop('rows', [])
+        yield data
+        yield rows
+
+    def _run_query_from_iter(self, query, user):
+        try:
+            results = self.run_query_iter(query, user)
+            data = next(results)
+            data['rows'] = []
+            for part in results:
+                if isinstance(part, dict):
+                    data.update(part)
+                else:
+                    data['rows'].extend(part)
+            json_data = json.dumps(data, cls=JSONEncoder)
+            error = None
+        except QueryRunnerError as e:
+            json_data = None
+            error = e.message
+
+        return json_data, error
+
     def fetch_columns(self, columns):
         column_names = []
         duplicates_counter = 1
@@ -116,7 +220,7 @@ class BaseQueryRunner(object):
         return {
             'name': cls.name(),
             'type': cls.type(),
-            'configuration_schema': cls.configuration_schema()
+            'configuration_schema': _with_data_source_limits(cls.configuration_schema())
         }
 
 
@@ -143,6 +247,28 @@ class BaseSQLQueryRunner(BaseQueryRunner):
 
 query_runners = {}
 
+# Options every data source has, in addition to its query runner's configuration:
+DATA_SOURCE_LIMITS_PROPERTIES = {
+    'max_result_rows': {
+        'type': 'number',
+        'title': 'Maximum Result Rows (empty for the global limit)'
+    },
+    'max_result_bytes': {
+        'type': 'number',
+        'title': 'Maximum Result Size in Bytes (empty for the global limit)'
+    },
+    'max_concurrent_queries': {
+        'type': 'number',
+        'title': 'Maximum Concurrent Queries (empty for the global limit)'
+    }
+}
+
+
+def _with_data_source_limits(schema):
+    schema = deepcopy(schema)
+    schema.setdefault('properties', {}).update(DATA_SOURCE_LIMITS_PROPERTIES)
+    return schema
+
 
 def register(query_runner_class):
     global query_runners
@@ -167,7 +293,7 @@ def get_configuration_schema_for_query_runner_type(query_runner_type):
     if query_runner_class is None:
         return None
 
-    return query_runner_class.configuration_schema()
+    return _with_data_source_limits(query_runner_class.configuration_schema())
 
 
 def import_query_runners(query_runner_imports):
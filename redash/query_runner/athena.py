@@ -4,7 +4,6 @@ import os
 
 from redash.query_runner import *
 from redash.settings import parse_boolean
-from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 ANNOTATE_QUERY = parse_boolean(os.environ.get('ATHENA_ANNOTATE_QUERY', 'true'))
@@ -162,6 +161,9 @@ class Athena(BaseQueryRunner):
         return schema.values()
 
     def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def run_query_iter(self, query, user):
         cursor = pyathena.connect(
             s3_staging_dir=self.configuration['s3_staging_dir'],
             region_name=self.configuration['region'],
@@ -176,22 +178,22 @@ class Athena(BaseQueryRunner):
             cursor.execute(query)
             column_tuples = [(i[0], _TYPE_MAPPINGS.get(i[1], None)) for i in cursor.description]
             columns = self.fetch_columns(column_tuples)
-            rows = [dict(zip(([c['name'] for c in columns]), r)) for i, r in enumerate(cursor.fetchall())]
-            data = {'columns': columns, 'rows': rows}
-            json_data = json.dumps(data, cls=JSONEncoder)
-            error = None
+            yield {'columns': columns}
+
+            column_names = [c['name'] for c in columns]
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield [dict(zip(column_names, r)) for r in rows]
         except KeyboardInterrupt:
             if cursor.query_id:
                 cursor.cancel()
-            error = "Query cancelled by user."
-            json_data = None
+            raise QueryRunnerError("Query cancelled by user.")
         except Exception as ex:
             if cursor.query_id:
                 cursor.cancel()
-            error = ex.message
-            json_data = None
-
-        return json_data, error
+            raise QueryRunnerError(ex.message)
 
 
 register(Athena)
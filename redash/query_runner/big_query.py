@@ -1,7 +1,6 @@
 import datetime
 import json
 import logging
-import sys
 import time
 from base64 import b64decode
 
@@ -10,7 +9,6 @@ import requests
 
 from redash import settings
 from redash.query_runner import *
-from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -160,7 +158,8 @@ class BigQuery(BaseQueryRunner):
         response = jobs.query(projectId=self._get_project_id(), body=job_data).execute()
         return int(response["totalBytesProcessed"])
 
-    def _get_query_result(self, jobs, query):
+    def _iter_query_result(self, jobs, query):
+        """Yields the result's metadata and then a batch of rows for every page BigQuery returns."""
         project_id = self._get_project_id()
         job_data = {
             "configuration": {
@@ -189,27 +188,20 @@ class BigQuery(BaseQueryRunner):
 
         logger.debug("bigquery replied: %s", query_reply)
 
-        rows = []
+        fields = query_reply["schema"]["fields"]
+        columns = [{'name': f["name"],
+                    'friendly_name': f["name"],
+                    'type': types_map.get(f['type'], "string")} for f in fields]
+
+        yield {"columns": columns}
 
         while ("rows" in query_reply) and current_row < query_reply['totalRows']:
-            for row in query_reply["rows"]:
-                rows.append(transform_row(row, query_reply["schema"]["fields"]))
+            yield [transform_row(row, fields) for row in query_reply["rows"]]
 
             current_row += len(query_reply['rows'])
             query_reply = jobs.getQueryResults(projectId=project_id, jobId=query_reply['jobReference']['jobId'],
                                                startIndex=current_row).execute()
 
-        columns = [{'name': f["name"],
-                    'friendly_name': f["name"],
-                    'type': types_map.get(f['type'], "string")} for f in query_reply["schema"]["fields"]]
-
-        data = {
-            "columns": columns,
-            "rows": rows
-        }
-
-        return data
-
     def get_schema(self, get_stats=False):
         if not self.configuration.get('loadSchema', False):
             return []
@@ -229,6 +221,9 @@ class BigQuery(BaseQueryRunner):
         return schema
 
     def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def run_query_iter(self, query, user):
         logger.debug("BigQuery got query: %s", query)
 
         bigquery_service = self._get_bigquery_service()
@@ -239,25 +234,17 @@ class BigQuery(BaseQueryRunner):
                 limitMB = self.configuration["totalMBytesProcessedLimit"]
                 processedMB = self._get_total_bytes_processed(jobs, query) / 1000.0 / 1000.0
                 if limitMB < processedMB:
-                    return None, "Larger than %d MBytes will be processed (%f MBytes)" % (limitMB, processedMB)
-
-            data = self._get_query_result(jobs, query)
-            error = None
+                    raise QueryRunnerError("Larger than %d MBytes will be processed (%f MBytes)" %
+                                           (limitMB, processedMB))
 
-            json_data = json.dumps(data, cls=JSONEncoder)
+            for part in self._iter_query_result(jobs, query):
+                yield part
         except apiclient.errors.HttpError as e:
-            json_data = None
             if e.resp.status == 400:
-                error = json.loads(e.content)['error']['message']
-            else:
-                error = e.content
+                raise QueryRunnerError(json.loads(e.content)['error']['message'])
+            raise QueryRunnerError(e.content)
         except KeyboardInterrupt:
-            error = "Query cancelled by user."
-            json_data = None
-        except Exception:
-            raise sys.exc_info()[1], None, sys.exc_info()[2]
-
-        return json_data, error
+            raise QueryRunnerError("Query cancelled by user.")
 
 
 class BigQueryGCE(BigQuery):
@@ -1,10 +1,10 @@
 import json
 import logging
 import os
+from itertools import chain
 
 from redash.query_runner import *
 from redash.settings import parse_boolean
-from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 types_map = {
@@ -55,6 +55,10 @@ class Mysql(BaseSQLQueryRunner):
                 'port': {
                     'type': 'number',
                     'default': 3306,
+                },
+                'stream_results': {
+                    'type': 'boolean',
+                    'title': 'Stream Results (unbuffered cursor)'
                 }
             },
             "order": ['host', 'port', 'user', 'passwd', 'db'],
@@ -127,8 +131,37 @@ class Mysql(BaseSQLQueryRunner):
         return schema.values()
 
     def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def _fetch_buffered(self, cursor):
+        # Only the last result set is returned:
+        data = cursor.fetchall()
+        while cursor.nextset():
+            data = cursor.fetchall()
+
+        for i in range(0, len(data), self.fetch_size):
+            yield data[i:i + self.fetch_size]
+
+    def _fetch_unbuffered(self, cursor):
+        # Rows are read from the server as they're fetched, so the result set to return has to be chosen before reading
+        # it: it's the first one that has rows (instead of the last one, as in buffered mode).
+        while cursor.description is None and cursor.nextset():
+            pass
+
+        if cursor.description is None:
+            return
+
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+            yield rows
+
+    def run_query_iter(self, query, user):
         import MySQLdb
+        import MySQLdb.cursors
 
+        stream_results = self.configuration.get('stream_results', False)
         connection = None
         try:
             connection = MySQLdb.connect(host=self.configuration.get('host', ''),
@@ -139,41 +172,41 @@ class Mysql(BaseSQLQueryRunner):
                                          charset='utf8', use_unicode=True,
                                          ssl=self._get_ssl_parameters(),
                                          connect_timeout=60)
-            cursor = connection.cursor()
+            if stream_results:
+                cursor = connection.cursor(MySQLdb.cursors.SSCursor)
+            else:
+                cursor = connection.cursor()
+
             logger.debug("MySQL running query: %s", query)
             cursor.execute(query)
 
-            data = cursor.fetchall()
-
-            while cursor.nextset():
-                data = cursor.fetchall()
+            if stream_results:
+                batches = self._fetch_unbuffered(cursor)
+            else:
+                batches = self._fetch_buffered(cursor)
+            first_batch = next(batches, [])
 
             # TODO - very similar to pg.py
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in data]
+            if cursor.description is None:
+                raise QueryRunnerError("No data was returned.")
 
-                data = {'columns': columns, 'rows': rows}
-                json_data = json.dumps(data, cls=JSONEncoder)
-                error = None
-            else:
-                json_data = None
-                error = "No data was returned."
+            columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
+            yield {'columns': columns}
 
-            cursor.close()
+            column_names = tuple(c['name'] for c in columns)
+            for batch in chain([first_batch], batches):
+                if batch:
+                    yield [dict(zip(column_names, row)) for row in batch]
         except MySQLdb.Error as e:
-            json_data = None
-            error = e.args[1]
+            raise QueryRunnerError(e.args[1])
         except KeyboardInterrupt:
-            cursor.close()
-            error = "Query cancelled by user."
-            json_data = None
+            raise QueryRunnerError("Query cancelled by user.")
         finally:
+            # When the executor stops reading early (result size limits), closing an unbuffered cursor would read the
+            # rest of the result, closing the connection discards it.
             if connection:
                 connection.close()
 
-        return json_data, error
-
     def _get_ssl_parameters(self):
         ssl_params = {}
 
@@ -221,6 +254,10 @@ class RDSMySQL(Mysql):
                     'type': 'number',
                     'default': 3306,
                 },
+                'stream_results': {
+                    'type': 'boolean',
+                    'title': 'Stream Results (unbuffered cursor)'
+                },
                 'use_ssl': {
                     'type': 'boolean',
                     'title': 'Use SSL'
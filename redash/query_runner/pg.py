@@ -2,11 +2,14 @@ import os
 import json
 import logging
 import select
+from itertools import chain
 
 import psycopg2
+import sqlparse
+from psycopg2 import errorcodes
+from psycopg2.extensions import TRANSACTION_STATUS_INERROR, TRANSACTION_STATUS_INTRANS
 
 from redash.query_runner import *
-from redash.utils import JSONEncoder
 
 logger = logging.getLogger(__name__)
 
@@ -45,6 +48,34 @@ def _wait(conn, timeout=None):
             raise psycopg2.OperationalError("select.error received")
 
 
+def _single_select(query):
+    """
+    Returns the query's statement (without comments or the trailing semicolon) when it's a single read-only SELECT,
+    WITH or VALUES statement, which a cursor can be declared for, and None otherwise.
+    """
+    statements = []
+    for statement in sqlparse.parse(query):
+        tokens = [token for token in statement.flatten()
+                  if not token.is_whitespace() and token.ttype not in sqlparse.tokens.Comment and token.value != ';']
+        if tokens:
+            statements.append((statement, tokens))
+
+    if len(statements) != 1:
+        return None
+
+    statement, tokens = statements[0]
+    if tokens[0].value.upper() not in ('SELECT', 'WITH', 'VALUES'):
+        return None
+
+    # Data-modifying CTEs (WITH ... INSERT) and SELECT ... INTO:
+    if any(token.value.upper() in ('INSERT', 'UPDATE', 'DELETE', 'INTO') and token.ttype in sqlparse.tokens.Keyword
+           for token in tokens):
+        return None
+
+    text = u''.join(u' ' if token.ttype in sqlparse.tokens.Comment else token.value for token in statement.flatten())
+    return text.strip().rstrip(';')
+
+
 class PostgreSQL(BaseSQLQueryRunner):
     noop_query = "SELECT 1"
 
@@ -75,6 +106,14 @@ class PostgreSQL(BaseSQLQueryRunner):
                    "type": "string",
                    "title": "SSL Mode",
                    "default": "prefer"
+                },
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Use Server-Side Cursor (fetch rows in batches)"
+                },
+                "fetch_size": {
+                    "type": "number",
+                    "title": "Rows per Batch (Server-Side Cursor)"
                 }
             },
             "order": ['host', 'port', 'user', 'password'],
@@ -142,41 +181,108 @@ class PostgreSQL(BaseSQLQueryRunner):
 
         return connection
 
+    @property
+    def fetch_size(self):
+        return int(self.configuration.get('fetch_size') or super(PostgreSQL, self).fetch_size)
+
+    def _fetch_client_side(self, connection, cursor, query):
+        cursor.execute(query)
+        _wait(connection)
+
+        if cursor.description is None:
+            return
+
+        while True:
+            rows = cursor.fetchmany(self.fetch_size)
+            if not rows:
+                break
+            yield rows
+
+    def _fetch_server_side(self, connection, cursor, query):
+        # Named cursors aren't available on asynchronous connections, so declare the cursor ourselves. This keeps the
+        # result on the server, and only fetch_size rows at a time are transferred to (and buffered by) libpq.
+        # DECLARE only takes a single SELECT (or VALUES) statement, anything else runs as is.
+        statement = _single_select(query)
+        if statement is None:
+            for rows in self._fetch_client_side(connection, cursor, query):
+                yield rows
+            return
+
+        cursor.execute("BEGIN")
+        _wait(connection)
+
+        try:
+            cursor.execute(u"DECLARE redash_cursor NO SCROLL CURSOR FOR {}".format(statement))
+            _wait(connection)
+        except psycopg2.ProgrammingError as e:
+            if e.pgcode not in (errorcodes.SYNTAX_ERROR, errorcodes.FEATURE_NOT_SUPPORTED):
+                raise
+
+            # Failed before the query was executed, so it's safe to run it again as is.
+            cursor.execute("ROLLBACK")
+            _wait(connection)
+            for rows in self._fetch_client_side(connection, cursor, query):
+                yield rows
+            return
+
+        # Ends the transaction, on a cursor of its own to keep the result's description:
+        control_cursor = connection.cursor()
+        try:
+            while True:
+                cursor.execute("FETCH FORWARD {:d} FROM redash_cursor".format(self.fetch_size))
+                _wait(connection)
+
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                yield rows
+
+            control_cursor.execute("COMMIT")
+            _wait(connection)
+        finally:
+            # Failed or stopped early (the connection is still idle in the transaction):
+            if connection.get_transaction_status() in (TRANSACTION_STATUS_INTRANS, TRANSACTION_STATUS_INERROR):
+                control_cursor.execute("ROLLBACK")
+                _wait(connection)
+
     def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def run_query_iter(self, query, user):
         connection = self._get_connection()
         _wait(connection, timeout=10)
 
         cursor = connection.cursor()
 
         try:
-            cursor.execute(query)
-            _wait(connection)
+            if self.configuration.get('server_side_cursor', False):
+                batches = self._fetch_server_side(connection, cursor, query)
+            else:
+                batches = self._fetch_client_side(connection, cursor, query)
 
-            if cursor.description is not None:
-                columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
-                rows = [dict(zip((c['name'] for c in columns), row)) for row in cursor]
+            # The query is executed when the first batch is fetched:
+            first_batch = next(batches, [])
 
-                data = {'columns': columns, 'rows': rows}
-                error = None
-                json_data = json.dumps(data, cls=JSONEncoder)
-            else:
-                error = 'Query completed but it returned no data.'
-                json_data = None
+            if cursor.description is None:
+                raise QueryRunnerError('Query completed but it returned no data.')
+
+            columns = self.fetch_columns([(i[0], types_map.get(i[1], None)) for i in cursor.description])
+            yield {'columns': columns}
+
+            column_names = tuple(c['name'] for c in columns)
+            for rows in chain([first_batch], batches):
+                if rows:
+                    yield [dict(zip(column_names, row)) for row in rows]
         except (select.error, OSError) as e:
-            error = "Query interrupted. Please retry."
-            json_data = None
+            raise QueryRunnerError("Query interrupted. Please retry.")
         except psycopg2.DatabaseError as e:
-            error = e.message
-            json_data = None
+            raise QueryRunnerError(e.message)
         except (KeyboardInterrupt, InterruptException):
             connection.cancel()
-            error = "Query cancelled by user."
-            json_data = None
+            raise QueryRunnerError("Query cancelled by user.")
         finally:
             connection.close()
 
-        return json_data, error
-
 
 class Redshift(PostgreSQL):
     @classmethod
@@ -218,6 +324,14 @@ class Redshift(PostgreSQL):
                 "dbname": {
                     "type": "string",
                     "title": "Database Name"
+                },
+                "server_side_cursor": {
+                    "type": "boolean",
+                    "title": "Use Server-Side Cursor (fetch rows in batches)"
+                },
+                "fetch_size": {
+                    "type": "number",
+                    "title": "Rows per Batch (Server-Side Cursor)"
                 }
             },
             "order": ['host', 'port', 'user', 'password'],
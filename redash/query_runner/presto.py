@@ -1,6 +1,5 @@
 import json
 
-from redash.utils import JSONEncoder
 from redash.query_runner import *
 
 import logging
@@ -95,6 +94,9 @@ class Presto(BaseQueryRunner):
         return schema.values()
 
     def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def run_query_iter(self, query, user):
         connection = presto.connect(
                 host=self.configuration.get('host', ''),
                 port=self.configuration.get('port', 8080),
@@ -109,25 +111,27 @@ class Presto(BaseQueryRunner):
             cursor.execute(query)
             column_tuples = [(i[0], PRESTO_TYPES_MAPPING.get(i[1], None)) for i in cursor.description]
             columns = self.fetch_columns(column_tuples)
-            rows = [dict(zip(([c['name'] for c in columns]), r)) for i, r in enumerate(cursor.fetchall())]
-            data = {'columns': columns, 'rows': rows}
-            json_data = json.dumps(data, cls=JSONEncoder)
-            error = None
+            yield {'columns': columns}
+
+            column_names = [c['name'] for c in columns]
+            while True:
+                rows = cursor.fetchmany(self.fetch_size)
+                if not rows:
+                    break
+                yield [dict(zip(column_names, r)) for r in rows]
         except DatabaseError as db:
-            json_data = None
             default_message = 'Unspecified DatabaseError: {0}'.format(db.message)
             message = db.message.get('failureInfo', {'message', None}).get('message')
-            error = default_message if message is None else message
+            raise QueryRunnerError(default_message if message is None else message)
         except (KeyboardInterrupt, InterruptException) as e:
             cursor.cancel()
-            error = "Query cancelled by user."
-            json_data = None
+            raise QueryRunnerError("Query cancelled by user.")
+        except QueryRunnerError:
+            raise
         except Exception as ex:
-            json_data = None
             error = ex.message
             if not isinstance(error, basestring):
                 error = unicode(error)
-
-        return json_data, error
+            raise QueryRunnerError(error)
 
 register(Presto)
@@ -208,10 +208,11 @@ class Python(BaseQueryRunner):
         if query.latest_query_data is None:
             raise Exception("Query does not have results yet.")
 
-        if query.latest_query_data.data is None:
+        data = query.latest_query_data.data
+        if data is None:
             raise Exception("Query does not have results yet.")
 
-        return json.loads(query.latest_query_data.data)
+        return data
 
     def test_connection(self):
         pass
@@ -88,6 +88,69 @@ CELERY_TASK_RESULT_EXPIRES = int(os.environ.get('REDASH_CELERY_TASK_RESULT_EXPIR
 QUERY_RESULTS_CLEANUP_ENABLED = parse_boolean(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_ENABLED", "true"))
 QUERY_RESULTS_CLEANUP_COUNT = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_COUNT", "100"))
 QUERY_RESULTS_CLEANUP_MAX_AGE = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_MAX_AGE", "7"))
+# Each run goes through the results in batches, from QUERY_RESULTS_CLEANUP_COUNT up to QUERY_RESULTS_CLEANUP_MAX_BATCH
+# results: batches grow while deleting them takes less than half of QUERY_RESULTS_CLEANUP_BATCH_LATENCY seconds, and
+# shrink when it takes longer. A run stops when it went through all the old results, or after
+# QUERY_RESULTS_CLEANUP_TIME_BUDGET seconds (the next run continues from there).
+QUERY_RESULTS_CLEANUP_MAX_BATCH = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_MAX_BATCH", "10000"))
+QUERY_RESULTS_CLEANUP_BATCH_LATENCY = float(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_BATCH_LATENCY", "0.5"))
+QUERY_RESULTS_CLEANUP_TIME_BUDGET = int(os.environ.get("REDASH_QUERY_RESULTS_CLEANUP_TIME_BUDGET", "60"))
+
+# Storage format of query results: compression used for the stored chunks ("zlib", "lz4" or "none") and the number of
+# rows per chunk.
+QUERY_RESULTS_COMPRESSION = os.environ.get("REDASH_QUERY_RESULTS_COMPRESSION", "zlib")
+QUERY_RESULTS_CHUNK_SIZE = int(os.environ.get("REDASH_QUERY_RESULTS_CHUNK_SIZE", "10000"))
+
+# Number of rows query runners that support streaming (run_query_iter) fetch from the data source at a time.
+QUERY_RUNNER_FETCH_SIZE = int(os.environ.get("REDASH_QUERY_RUNNER_FETCH_SIZE", "5000"))
+# Query execution stops reading a result after this many rows/bytes and stores it marked as truncated (0 = no limit).
+# Data sources can override these with their max_result_rows/max_result_bytes options.
+QUERY_RESULTS_MAX_ROWS = int(os.environ.get("REDASH_QUERY_RESULTS_MAX_ROWS", "0"))
+QUERY_RESULTS_MAX_BYTES = int(os.environ.get("REDASH_QUERY_RESULTS_MAX_BYTES", "0"))
+# Maximum number of queries executing at once on each data source (0 = no limit), data sources can override it with
+# their max_concurrent_queries option. Queries over the limit wait for a free slot, in the order they were enqueued,
+# checking again every DATA_SOURCE_SLOT_RETRY_INTERVAL seconds without holding a worker. A slot that wasn't released
+# (the worker running the query died) is freed after DATA_SOURCE_SLOT_TIMEOUT seconds, which should be longer than the
+# longest running queries.
+DATA_SOURCE_MAX_CONCURRENT_QUERIES = int(os.environ.get("REDASH_DATA_SOURCE_MAX_CONCURRENT_QUERIES", "0"))
+DATA_SOURCE_SLOT_RETRY_INTERVAL = int(os.environ.get("REDASH_DATA_SOURCE_SLOT_RETRY_INTERVAL", "5"))
+DATA_SOURCE_SLOT_TIMEOUT = int(os.environ.get("REDASH_DATA_SOURCE_SLOT_TIMEOUT", str(3600 * 2)))
+# Fair-share dispatching of query jobs, per Celery queue: "queue:capacity,..." (e.g. "queries:20,scheduled_queries:10").
+# The jobs of a listed queue are held back and sent to it while less than its capacity of them are waiting in it or
+# executing, interleaving organizations' and users' jobs instead of sending them in the order they were enqueued.
+# Queues joined with "+" share their capacity (e.g. "queries+scheduled_queries:20", for workers consuming both), so
+# that higher priority jobs are sent first: each priority level below interactive (dashboard refresh, scheduled,
+# backfill/export) puts a job QUERY_PRIORITY_AGING seconds further back in line, so jobs waiting longer than that are
+# still sent before newer higher priority ones.
+# Each job moves its organization and user back by QUERY_DISPATCH_SHARE_QUANTUM seconds (divided by the organization's
+# query_share_weight setting, for organizations), separately for each priority level. A dispatched job whose end wasn't
+# noticed is forgotten after QUERY_DISPATCH_TIMEOUT seconds. Jobs of queues that aren't listed are sent to them
+# directly.
+QUERY_DISPATCH_CAPACITY = dict((queue_name, int(capacity)) for queue_name, capacity in
+                               (item.rsplit(':', 1) for item in
+                                array_from_string(os.environ.get("REDASH_QUERY_DISPATCH_CAPACITY", ""))))
+QUERY_DISPATCH_SHARE_QUANTUM = int(os.environ.get("REDASH_QUERY_DISPATCH_SHARE_QUANTUM", "60"))
+QUERY_DISPATCH_TIMEOUT = int(os.environ.get("REDASH_QUERY_DISPATCH_TIMEOUT", str(3600 * 2)))
+QUERY_PRIORITY_AGING = int(os.environ.get("REDASH_QUERY_PRIORITY_AGING", "300"))
+
+# Storage for large query results, outside of the database: "file" (a directory shared by all servers & workers) or
+# "s3" (any S3 compatible store, with an optional endpoint URL). Results of at least QUERY_RESULTS_STORAGE_THRESHOLD
+# bytes (encoded) are stored there. Leave empty to keep all results in the database.
+QUERY_RESULTS_STORAGE = os.environ.get("REDASH_QUERY_RESULTS_STORAGE", "")
+QUERY_RESULTS_STORAGE_THRESHOLD = int(os.environ.get("REDASH_QUERY_RESULTS_STORAGE_THRESHOLD", str(1024 * 1024)))
+QUERY_RESULTS_STORAGE_PATH = os.environ.get("REDASH_QUERY_RESULTS_STORAGE_PATH", "/var/lib/redash/query_results")
+QUERY_RESULTS_S3_BUCKET = os.environ.get("REDASH_QUERY_RESULTS_S3_BUCKET", "")
+QUERY_RESULTS_S3_PREFIX = os.environ.get("REDASH_QUERY_RESULTS_S3_PREFIX", "query_results/")
+QUERY_RESULTS_S3_ENDPOINT_URL = os.environ.get("REDASH_QUERY_RESULTS_S3_ENDPOINT_URL", "")
+
+# Spreads the runs of scheduled queries over this many seconds, so queries with the same schedule don't all run at once:
+# each query is offset by a fixed amount within the window, derived from its text. Queries scheduled at a time of day
+# run up to this late, and queries refreshed every N seconds run at fixed times N seconds apart, offset by up to this
+# (or N) seconds. 0 disables it.
+SCHEDULE_JITTER_WINDOW = int(os.environ.get("REDASH_SCHEDULE_JITTER_WINDOW", "0"))
+# Maximum number of scheduled queries enqueued for a data source on each refresh (every 30 seconds), the most overdue
+# first. The rest wait for the following refreshes. 0 means no limit.
+SCHEDULED_QUERIES_PER_DATA_SOURCE = int(os.environ.get("REDASH_SCHEDULED_QUERIES_PER_DATA_SOURCE", "0"))
 
 SCHEMAS_REFRESH_SCHEDULE = int(os.environ.get("REDASH_SCHEMAS_REFRESH_SCHEDULE", 30))
 
@@ -196,6 +259,15 @@ STATIC_ASSETS_PATHS = [fix_assets_path(path) for path in os.environ.get("REDASH_
 STATIC_ASSETS_PATHS.append(fix_assets_path('./static/'))
 
 JOB_EXPIRY_TIME = int(os.environ.get("REDASH_JOB_EXPIRY_TIME", 3600 * 12))
+# Requests that need a query's result right away (parameterized embeds) execute it through a query job, and wait up to
+# QUERY_RESULT_WAIT_TIMEOUT seconds for it before responding with the job to poll instead. Identical queries already
+# executing on the data source are shared.
+QUERY_RESULT_WAIT_TIMEOUT = int(os.environ.get("REDASH_QUERY_RESULT_WAIT_TIMEOUT", "30"))
+# Results of parameterized queries are cached by query & parameter values for PARAMETERIZED_RESULTS_CACHE_MAX_AGE
+# seconds (0 = not cached), which queries can override with their parameters_cache_max_age option. At most
+# PARAMETERIZED_RESULTS_CACHE_SIZE entries are kept, evicting the least recently used ones.
+PARAMETERIZED_RESULTS_CACHE_MAX_AGE = int(os.environ.get("REDASH_PARAMETERIZED_RESULTS_CACHE_MAX_AGE", "0"))
+PARAMETERIZED_RESULTS_CACHE_SIZE = int(os.environ.get("REDASH_PARAMETERIZED_RESULTS_CACHE_SIZE", "10000"))
 COOKIE_SECRET = os.environ.get("REDASH_COOKIE_SECRET", "c292a0a3aa32397cdb050e233733900f")
 SESSION_COOKIE_SECURE = parse_boolean(os.environ.get("REDASH_SESSION_COOKIE_SECURE") or str(ENFORCE_HTTPS))
 
@@ -286,6 +358,18 @@ additional_destinations = array_from_string(os.environ.get("REDASH_ADDITIONAL_DE
 DESTINATIONS = distinct(enabled_destinations + additional_destinations)
 
 EVENT_REPORTING_WEBHOOKS = array_from_string(os.environ.get("REDASH_EVENT_REPORTING_WEBHOOKS", ""))
+# How many events to post to the webhooks per request: a single one is posted as is, more as a list of them.
+EVENT_REPORTING_WEBHOOKS_BATCH_SIZE = int(os.environ.get("REDASH_EVENT_REPORTING_WEBHOOKS_BATCH_SIZE", "1"))
+
+# Events are buffered in Redis and recorded every EVENTS_DRAIN_INTERVAL seconds, up to EVENTS_DRAIN_BATCH_SIZE per
+# INSERT.
+EVENTS_DRAIN_INTERVAL = int(os.environ.get("REDASH_EVENTS_DRAIN_INTERVAL", "5"))
+EVENTS_DRAIN_BATCH_SIZE = int(os.environ.get("REDASH_EVENTS_DRAIN_BATCH_SIZE", "1000"))
+
+# The events table has a partition per month, created this many months ahead. Events older than
+# EVENTS_RETENTION_MONTHS months get dropped a month's partition at a time (0 keeps them forever).
+EVENTS_PARTITIONS_AHEAD = int(os.environ.get("REDASH_EVENTS_PARTITIONS_AHEAD", "3"))
+EVENTS_RETENTION_MONTHS = int(os.environ.get("REDASH_EVENTS_RETENTION_MONTHS", "0"))
 
 # Support for Sentry (http://getsentry.com/). Just set your Sentry DSN to enable it:
 SENTRY_DSN = os.environ.get("REDASH_SENTRY_DSN", "")
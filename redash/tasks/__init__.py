@@ -1,4 +1,4 @@
-from .general import record_event, version_check, send_mail
+from .general import record_event, buffer_event, drain_events, version_check, send_mail, manage_event_partitions
 from .queries import QueryTask, refresh_queries, refresh_schemas, cleanup_tasks, cleanup_query_results, execute_query
 from .alerts import check_alerts_for_query
 
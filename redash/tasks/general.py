@@ -1,31 +1,173 @@
+import json
+
 import requests
 
 from celery.utils.log import get_task_logger
+from sqlalchemy.exc import OperationalError
 from flask_mail import Message
-from redash import mail, models, settings
+from redash import mail, models, redis_connection, settings
+from redash.utils import json_dumps, utcnow
 from redash.version_check import run_version_check
 from redash.worker import celery
 
 logger = get_task_logger(__name__)
 
 
+EVENTS_BUFFER_KEY = 'events:buffer'
+# The batch drain_events is recording, kept until it's committed so that it isn't lost if the drain doesn't finish:
+EVENTS_PROCESSING_KEY = 'events:processing'
+# Events that couldn't be recorded (the latest EVENTS_DEAD_LETTER_SIZE of them), for inspection:
+EVENTS_DEAD_LETTER_KEY = 'events:dead_letter'
+EVENTS_DEAD_LETTER_SIZE = 10000
+EVENTS_DRAIN_LOCK_KEY = 'events:drain_lock'
+EVENTS_DRAIN_LOCK_TIMEOUT = 600
+
+# Shared by the webhook posts of a worker process, so they reuse connections.
+webhooks_session = requests.Session()
+
+
+def buffer_event(raw_event):
+    """
+    Adds the event to the buffer drain_events records events from, instead of sending a task per event.
+    """
+    redis_connection.rpush(EVENTS_BUFFER_KEY, json_dumps(raw_event))
+
+
+# Moves up to ARGV[1] events from the head of the buffer (KEYS[1]) to the processing list (KEYS[2]). Returns them.
+_take_buffered_events = redis_connection.register_script("""
+local events = redis.call('lrange', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+for _, event in ipairs(events) do
+    redis.call('rpush', KEYS[2], event)
+end
+redis.call('ltrim', KEYS[1], #events, -1)
+return events
+""")
+
+
+def take_buffered_events(count):
+    """
+    The batch of events to record: the one left in the processing list by a drain that didn't finish, or else the
+    next `count` buffered events, moved to the processing list.
+    """
+    raw_events = redis_connection.lrange(EVENTS_PROCESSING_KEY, 0, -1)
+    if raw_events:
+        return raw_events
+
+    return _take_buffered_events(keys=[EVENTS_BUFFER_KEY, EVENTS_PROCESSING_KEY], args=[count])
+
+
+def record_buffered_events(raw_events):
+    """
+    Records the events with a single INSERT, or one at a time if that fails, putting the ones that can't be recorded
+    in the dead letter list. Raises when the database can't be reached.
+    """
+    try:
+        events = models.Event.record_many([json.loads(raw_event) for raw_event in raw_events])
+        models.db.session.commit()
+        return events
+    except OperationalError:
+        models.db.session.rollback()
+        raise
+    except Exception:
+        models.db.session.rollback()
+        logger.exception("Failed recording %d events at once, recording them one at a time.", len(raw_events))
+
+    events = []
+    for raw_event in raw_events:
+        try:
+            events.extend(models.Event.record_many([json.loads(raw_event)]))
+            models.db.session.commit()
+        except OperationalError:
+            models.db.session.rollback()
+            raise
+        except Exception:
+            models.db.session.rollback()
+            logger.exception("Failed recording event: %s", raw_event)
+            pipe = redis_connection.pipeline()
+            pipe.rpush(EVENTS_DEAD_LETTER_KEY, raw_event)
+            pipe.ltrim(EVENTS_DEAD_LETTER_KEY, -EVENTS_DEAD_LETTER_SIZE, -1)
+            pipe.execute()
+
+    return events
+
+
 @celery.task(name="redash.tasks.record_event")
 def record_event(raw_event):
+    # Events are buffered (see buffer_event) and recorded by drain_events; this is for the tasks that are still queued.
     event = models.Event.record(raw_event)
     models.db.session.commit()
+    forward_events([event.to_dict()])
+
+
+@celery.task(name="redash.tasks.drain_events")
+def drain_events():
+    """
+    Records the buffered events, settings.EVENTS_DRAIN_BATCH_SIZE at a time with a single INSERT each, and forwards
+    them to the webhooks (with a single task for each batch).
+
+    Each batch stays in the processing list until it's recorded, so a batch that isn't (when the database can't be
+    reached, or the drain is interrupted) is the first one recorded by the next drain.
+    """
+    if not redis_connection.set(EVENTS_DRAIN_LOCK_KEY, 1, nx=True, ex=EVENTS_DRAIN_LOCK_TIMEOUT):
+        logger.info("Events are already being drained.")
+        return
+
+    try:
+        while True:
+            raw_events = take_buffered_events(settings.EVENTS_DRAIN_BATCH_SIZE)
+            if not raw_events:
+                break
+
+            events = record_buffered_events(raw_events)
+            redis_connection.delete(EVENTS_PROCESSING_KEY)
+
+            logger.info("Recorded %d events", len(events))
+            if settings.EVENT_REPORTING_WEBHOOKS and events:
+                forward_events.delay([event.to_dict() for event in events])
+
+            if len(raw_events) < settings.EVENTS_DRAIN_BATCH_SIZE:
+                break
+    finally:
+        redis_connection.delete(EVENTS_DRAIN_LOCK_KEY)
+
+
+@celery.task(name="redash.tasks.forward_events")
+def forward_events(events):
+    """
+    Posts the events to each of settings.EVENT_REPORTING_WEBHOOKS, settings.EVENT_REPORTING_WEBHOOKS_BATCH_SIZE events
+    per request. A single event is posted as is, a batch as a list of them.
+    """
+    data = [{
+        "schema": "iglu:io.redash.webhooks/event/jsonschema/1-0-0",
+        "data": event
+    } for event in events]
+    batch_size = settings.EVENT_REPORTING_WEBHOOKS_BATCH_SIZE
 
     for hook in settings.EVENT_REPORTING_WEBHOOKS:
-        logger.debug("Forwarding event to: %s", hook)
-        try:
-            data = {
-                "schema": "iglu:io.redash.webhooks/event/jsonschema/1-0-0",
-                "data": event.to_dict()
-            }
-            response = requests.post(hook, json=data)
-            if response.status_code != 200:
-                logger.error("Failed posting to %s: %s", hook, response.content)
-        except Exception:
-            logger.exception("Failed posting to %s", hook)
+        logger.debug("Forwarding %d events to: %s", len(events), hook)
+        for i in range(0, len(data), batch_size):
+            try:
+                batch = data[i:i + batch_size]
+                response = webhooks_session.post(hook, json=batch if batch_size > 1 else batch[0])
+                if response.status_code != 200:
+                    logger.error("Failed posting to %s: %s", hook, response.content)
+            except Exception:
+                logger.exception("Failed posting to %s", hook)
+
+
+@celery.task(name="redash.tasks.manage_event_partitions")
+def manage_event_partitions():
+    """
+    Creates the events partitions of the coming months and drops the ones past settings.EVENTS_RETENTION_MONTHS.
+    """
+    created = models.Event.create_partitions()
+    dropped = []
+    if settings.EVENTS_RETENTION_MONTHS:
+        before = models.month_start(utcnow(), -settings.EVENTS_RETENTION_MONTHS)
+        dropped = models.Event.drop_partitions(before)
+    models.db.session.commit()
+
+    logger.info("Created events partitions: %s, dropped: %s", created, dropped)
 
 
 @celery.task(name="redash.tasks.version_check")
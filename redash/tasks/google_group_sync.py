@@ -108,7 +108,7 @@ def get_google_group_members(service, group_key, domains):
 
 
 def add_member(log_prefix, org, email, group):
-    from redash.tasks import record_event
+    from redash.tasks import buffer_event
 
     try:
         user = models.User.get_by_email_and_org(email, org)
@@ -118,7 +118,7 @@ def add_member(log_prefix, org, email, group):
         models.db.session.add(user)
         models.db.session.commit()
 
-        record_event.delay({
+        buffer_event({
             'org_id': org.id,
             'action': 'create',
             'timestamp': int(time.time()),
@@ -130,7 +130,7 @@ def add_member(log_prefix, org, email, group):
     user.group_ids.append(group.id)
     models.db.session.commit()
 
-    record_event.delay({
+    buffer_event({
         'org_id': org.id,
         'action': 'add_member',
         'timestamp': int(time.time()),
@@ -143,13 +143,13 @@ def add_member(log_prefix, org, email, group):
 
 
 def del_member(log_prefix, org, email, group):
-    from redash.tasks import record_event
+    from redash.tasks import buffer_event
 
     user = models.User.get_by_email_and_org(email, org)
     user.group_ids.remove(group.id)
     models.db.session.commit()
 
-    record_event.delay({
+    buffer_event({
         'org_id': org.id,
         'action': 'remove_member',
         'timestamp': int(time.time()),
@@ -54,7 +54,7 @@ def export_google_spreadsheet(query_id):
 
 def _update_spreadsheet_data(query_id, query, query_result):
 
-    query_data = json.loads(query_result.data)
+    query_data = query_result.data
     columns = query_data['columns']
     rows = query_data['rows']
     payload = []
@@ -1,17 +1,23 @@
+import datetime
 import json
 import logging
 import signal
 import time
+from collections import Counter
 
 import pystache
 import redis
+from dateutil.parser import parse as parse_date
 
-from celery.exceptions import SoftTimeLimitExceeded, TimeLimitExceeded
+from celery import states
+from celery.exceptions import Retry, SoftTimeLimitExceeded, TimeLimitExceeded
+from celery.exceptions import TimeoutError as CeleryTimeoutError
 from celery.result import AsyncResult
+from celery.utils import uuid
 from celery.utils.log import get_task_logger
 from redash import models, redis_connection, settings, statsd_client, utils
-from redash.query_runner import InterruptException
-from redash.utils import gen_query_hash
+from redash.query_runner import InterruptException, QueryRunnerError, limit_result
+from redash.utils import gen_query_hash, result_codec
 from redash.worker import celery
 from redash.tasks.alerts import check_alerts_for_query
 
@@ -39,10 +45,12 @@ class QueryTaskTracker(object):
         self.data = data
 
     @classmethod
-    def create(cls, task_id, state, query_hash, data_source_id, scheduled, metadata):
+    def create(cls, task_id, state, query_hash, data_source_id, scheduled, metadata, queue_name=None, priority=None):
         data = dict(task_id=task_id, state=state,
                     query_hash=query_hash, data_source_id=data_source_id,
                     scheduled=scheduled,
+                    queue_name=queue_name,
+                    priority=priority,
                     username=metadata.get('Username', 'unknown'),
                     query_id=metadata.get('Query ID', 'unknown'),
                     retries=0,
@@ -158,10 +166,302 @@ class QueryTaskTracker(object):
         return item in self.data
 
 
+# Tries to take a slot of a data source's semaphore for a job, see DataSourceSemaphore.acquire().
+# KEYS: slot holders (job id -> expiry), waiting jobs (job id -> request time), waiting jobs' last attempt
+# ARGV: job id, limit, request time, now, slot timeout, stale waiters timeout
+_acquire_data_source_slot = redis_connection.register_script("""
+local holders, waiting, seen = KEYS[1], KEYS[2], KEYS[3]
+local job_id, limit, requested_at = ARGV[1], tonumber(ARGV[2]), tonumber(ARGV[3])
+local now, timeout, stale_timeout = tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])
+
+redis.call('zremrangebyscore', holders, '-inf', now)
+for _, stale in ipairs(redis.call('zrangebyscore', seen, '-inf', now - stale_timeout)) do
+    redis.call('zrem', waiting, stale)
+    redis.call('zrem', seen, stale)
+end
+
+if not redis.call('zscore', holders, job_id) then
+    redis.call('zadd', waiting, requested_at, job_id)
+    redis.call('zadd', seen, now, job_id)
+
+    local free = limit - redis.call('zcard', holders)
+    if free <= 0 or redis.call('zrank', waiting, job_id) >= free then
+        return 0
+    end
+
+    redis.call('zrem', waiting, job_id)
+    redis.call('zrem', seen, job_id)
+end
+
+redis.call('zadd', holders, now + timeout, job_id)
+return 1
+""")
+
+
+class DataSourceSemaphore(object):
+    """
+    Limits the number of queries executing at once on a data source. Jobs that don't get a slot keep their place in
+    line (by the time they were enqueued) as long as they ask again within `stale_timeout` seconds.
+    """
+    stale_timeout = 60
+
+    def __init__(self, data_source_id, limit=None):
+        self.data_source_id = data_source_id
+        self.limit = limit
+
+    def _keys(self):
+        key = 'data_source:{}:slots'.format(self.data_source_id)
+        return [key, key + ':waiting', key + ':seen']
+
+    def acquire(self, job_id, requested_at):
+        """Take a slot for the job. Returns False when the job has to wait for one."""
+        args = [job_id, self.limit, requested_at, time.time(), settings.DATA_SOURCE_SLOT_TIMEOUT,
+                self.stale_timeout]
+        return bool(_acquire_data_source_slot(keys=self._keys(), args=args))
+
+    def release(self, job_id):
+        pipe = redis_connection.pipeline()
+        for key in self._keys():
+            pipe.zrem(key, job_id)
+        pipe.execute()
+
+    def waiting_position(self, job_id):
+        """The number of jobs ahead of the given one in line for a slot, or None when it isn't waiting."""
+        return redis_connection.zrank(self._keys()[1], job_id)
+
+
+# Priority levels of query jobs, highest first.
+PRIORITIES = ('interactive', 'dashboard', 'scheduled', 'backfill')
+
+
+def default_priority(scheduled_query):
+    return 'scheduled' if scheduled_query else 'interactive'
+
+
+# Adds a job to a dispatcher's pending jobs, see QueryDispatcher.add().
+# KEYS: pending jobs (job id -> place in line), shares' virtual finish times, jobs' task arguments, the pending jobs of
+#       the job's organization share (job id -> virtual start time in its user share), jobs' organization share keys
+# ARGV: job id, task arguments, now, priority delay, organization share & cost, user share & cost
+_add_dispatcher_job = redis_connection.register_script("""
+local pending, shares, jobs, org_jobs, lanes = KEYS[1], KEYS[2], KEYS[3], KEYS[4], KEYS[5]
+local now, delay = tonumber(ARGV[3]), tonumber(ARGV[4])
+local org_share, org_cost = ARGV[5], tonumber(ARGV[6])
+local user_share, user_cost = ARGV[7], tonumber(ARGV[8])
+
+local user_start = math.max(now, tonumber(redis.call('hget', shares, user_share) or '0'))
+redis.call('hset', shares, user_share, user_start + user_cost)
+
+-- The organization's jobs are in line in the order of their start time in their user's share: the job takes the
+-- place of the first of them starting after it, and those move back by one job of the organization.
+redis.call('zremrangebyscore', org_jobs, '-inf', '(' .. now)
+local org_finish = math.max(now, tonumber(redis.call('hget', shares, org_share) or '0'))
+local start = org_finish
+for _, job_id in ipairs(redis.call('zrangebyscore', org_jobs, '(' .. user_start, '+inf')) do
+    local place = redis.call('zscore', pending, job_id)
+    if place then
+        start = math.min(start, tonumber(place) - delay)
+        redis.call('zincrby', pending, org_cost, job_id)
+    else
+        redis.call('zrem', org_jobs, job_id)
+    end
+end
+redis.call('hset', shares, org_share, org_finish + org_cost)
+
+redis.call('zadd', org_jobs, user_start, ARGV[1])
+redis.call('hset', lanes, ARGV[1], org_jobs)
+redis.call('zadd', pending, start + delay, ARGV[1])
+redis.call('hset', jobs, ARGV[1], ARGV[2])
+return tostring(start)
+""")
+
+# Takes the pending jobs that fit in a dispatcher's capacity, see QueryDispatcher.dispatch().
+# KEYS: pending jobs, dispatched jobs (job id -> expiry), jobs' task arguments, jobs' organization share keys
+# ARGV: capacity, now, dispatched jobs timeout
+# Returns the id and task arguments of each job, flattened.
+_take_dispatcher_jobs = redis_connection.register_script("""
+local pending, dispatched, jobs, lanes = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local capacity, now, timeout = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+
+redis.call('zremrangebyscore', dispatched, '-inf', now)
+local free = capacity - redis.call('zcard', dispatched)
+local taken = {}
+if free <= 0 then
+    return taken
+end
+
+for _, job_id in ipairs(redis.call('zrange', pending, 0, free - 1)) do
+    redis.call('zrem', pending, job_id)
+    redis.call('zadd', dispatched, now + timeout, job_id)
+    table.insert(taken, job_id)
+    table.insert(taken, redis.call('hget', jobs, job_id) or '')
+    redis.call('hdel', jobs, job_id)
+    local org_jobs = redis.call('hget', lanes, job_id)
+    if org_jobs then
+        redis.call('zrem', org_jobs, job_id)
+        redis.call('hdel', lanes, job_id)
+    end
+end
+return taken
+""")
+
+
+class QueryDispatcher(object):
+    """
+    Holds back the jobs of one or more Celery queues, and sends them to their queue as long as less than `capacity` of
+    its jobs are waiting in the queues or executing (settings.QUERY_DISPATCH_CAPACITY).
+
+    Jobs are sent in fair-share (start-time fair queueing) order instead of the order they were enqueued in, first
+    between organizations and then between the users of each organization. Each organization and user has a virtual
+    finish time, which each of its jobs moves forward by settings.QUERY_DISPATCH_SHARE_QUANTUM seconds (divided by the
+    organization's `query_share_weight` setting for organizations). A job starts in its user's share at the latest of
+    the time it was enqueued and the user's finish time, and the organization's jobs take its places in line in the
+    order of those start times. So an organization enqueuing many jobs at once gets one of them sent in turn with other
+    organizations' jobs, and within it, a user enqueuing many jobs gets one sent in turn with other users' jobs.
+
+    Each priority level (see PRIORITIES) has its own finish times, so a burst of scheduled jobs doesn't move back its
+    organization's interactive jobs, and lower priority jobs are placed settings.QUERY_PRIORITY_AGING seconds further
+    back in line for each level. Jobs are never preempted, and a waiting job ages: it's sent before higher priority
+    jobs enqueued long enough after it, so a burst of high priority jobs delays lower priority ones but doesn't starve
+    them.
+    """
+    jobs_key = 'query_dispatcher:jobs'
+
+    def __init__(self, name, capacity):
+        self.name = name
+        self.capacity = capacity
+
+    @classmethod
+    def for_queue(cls, queue_name):
+        """The dispatcher of the queue, or None when the queue's jobs are sent to it directly."""
+        for dispatcher in cls.all():
+            if queue_name in dispatcher.queue_names:
+                return dispatcher
+
+        return None
+
+    @classmethod
+    def all(cls):
+        return [cls(name, capacity) for name, capacity in settings.QUERY_DISPATCH_CAPACITY.iteritems() if capacity]
+
+    @property
+    def queue_names(self):
+        return self.name.split('+')
+
+    @staticmethod
+    def shares(data_source, user_id, scheduled_query):
+        """The (share, cost) of the organization and user a job is accounted to."""
+        org = data_source.org
+        weight = float(org.settings.get('query_share_weight', 1) or 1)
+        if scheduled_query:
+            user_share = 'scheduled:{}'.format(org.id)
+        else:
+            user_share = 'user:{}'.format(user_id)
+
+        return [('org:{}'.format(org.id), settings.QUERY_DISPATCH_SHARE_QUANTUM / weight),
+                (user_share, settings.QUERY_DISPATCH_SHARE_QUANTUM)]
+
+    def _key(self, name):
+        return 'query_dispatcher:{}:{}'.format(self.name, name)
+
+    def add(self, job_id, queue_name, args, time_limit, shares, priority='interactive', connection=None):
+        """
+        Add a job for the queue with the given execute_query arguments, accounted to the given organization and user
+        (share, cost) pairs.
+        """
+        (org_share, org_cost), (user_share, user_cost) = shares
+        delay = PRIORITIES.index(priority) * settings.QUERY_PRIORITY_AGING
+        job = utils.json_dumps({'queue': queue_name, 'args': args, 'time_limit': time_limit})
+        script_args = [job_id, job, time.time(), delay, '{}:{}'.format(priority, org_share), org_cost,
+                       '{}:{}'.format(priority, user_share), user_cost]
+
+        keys = [self._key('pending'), self._key('shares'), self.jobs_key,
+                self._key('org_jobs:{}:{}'.format(priority, org_share)), self._key('lanes')]
+        _add_dispatcher_job(keys=keys, args=script_args, client=connection or redis_connection)
+
+    def dispatch(self):
+        """Send the jobs that fit in the capacity to their queues. Returns the number of jobs sent."""
+        taken = _take_dispatcher_jobs(keys=[self._key('pending'), self._key('dispatched'), self.jobs_key,
+                                            self._key('lanes')],
+                                      args=[self.capacity, time.time(), settings.QUERY_DISPATCH_TIMEOUT])
+        jobs = zip(taken[::2], taken[1::2])
+
+        with celery.producer_or_acquire() as producer:
+            for n, (job_id, job) in enumerate(jobs):
+                if not job:
+                    self.release(job_id)
+                    continue
+
+                job = json.loads(job)
+                try:
+                    execute_query.apply_async(args=job['args'],
+                                              queue=job['queue'],
+                                              time_limit=job['time_limit'],
+                                              task_id=job_id,
+                                              producer=producer)
+                except Exception:
+                    logging.exception("[Dispatcher] Failed sending jobs of %s.", self.name)
+                    self._put_back(jobs[n:])
+                    return n
+
+        return len(jobs)
+
+    def _put_back(self, jobs):
+        pipe = redis_connection.pipeline()
+        for job_id, job in jobs:
+            pipe.zrem(self._key('dispatched'), job_id)
+            # At the head of the line, as they were already taken from it:
+            pipe.zadd(self._key('pending'), 0, job_id)
+            pipe.hset(self.jobs_key, job_id, job)
+        pipe.execute()
+
+    def release(self, job_id):
+        """Remove a job (finished, or cancelled before it was sent), making room for another one."""
+        pipe = redis_connection.pipeline()
+        pipe.zrem(self._key('pending'), job_id)
+        pipe.zrem(self._key('dispatched'), job_id)
+        pipe.hdel(self.jobs_key, job_id)
+        pipe.hdel(self._key('lanes'), job_id)
+        pipe.execute()
+
+    def waiting_position(self, job_id):
+        """The number of jobs ahead of the given one, or None when it isn't waiting to be sent."""
+        return redis_connection.zrank(self._key('pending'), job_id)
+
+
+def _send_job(job_id, query, data_source, user_id, scheduled_query, metadata, priority, connection, producer=None):
+    """
+    Send an execute_query job to its queue, or to the queue's dispatcher (using the given Redis connection). Returns the
+    queue name.
+    """
+    queue_name, time_limit = _queue_options(data_source, scheduled_query)
+    args = (query, data_source.id, metadata, user_id, scheduled_query.id if scheduled_query else None)
+
+    dispatcher = QueryDispatcher.for_queue(queue_name)
+    if dispatcher:
+        dispatcher.add(job_id, queue_name, args, time_limit,
+                       QueryDispatcher.shares(data_source, user_id, scheduled_query), priority, connection)
+    else:
+        execute_query.apply_async(args=args, queue=queue_name, time_limit=time_limit, task_id=job_id,
+                                  producer=producer)
+
+    return queue_name
+
+
+def _waiting_position(tracker):
+    dispatcher = QueryDispatcher.for_queue(tracker.data.get('queue_name'))
+    position = dispatcher.waiting_position(tracker.task_id) if dispatcher else None
+    if position is None:
+        position = DataSourceSemaphore(tracker.data_source_id).waiting_position(tracker.task_id)
+
+    return position
+
+
 class QueryTask(object):
     # TODO: this is mapping to the old Job class statuses. Need to update the client side and remove this
     STATUSES = {
         'PENDING': 1,
+        # Waiting for a slot of its data source (DataSourceSemaphore):
+        'RETRY': 1,
         'STARTED': 2,
         'SUCCESS': 3,
         'FAILURE': 4,
@@ -204,12 +504,21 @@ class QueryTask(object):
         else:
             query_result_id = None
 
+        tracker = QueryTaskTracker.get_by_task_id(self._async_result.id)
+        # Jobs ahead of this one, when it's waiting for its turn (to be sent to its queue or for a data source slot):
+        if status == 1 and tracker:
+            waiting_position = _waiting_position(tracker)
+        else:
+            waiting_position = None
+
         return {
             'id': self._async_result.id,
             'updated_at': updated_at,
             'status': status,
             'error': error,
             'query_result_id': query_result_id,
+            'waiting_position': waiting_position,
+            'priority': tracker.data.get('priority') if tracker else None,
         }
 
     @property
@@ -227,8 +536,138 @@ class QueryTask(object):
         return self._async_result.revoke(terminate=True, signal='SIGINT')
 
 
-def enqueue_query(query, data_source, user_id, scheduled_query=None, metadata={}):
+# Sets the lock of each job in KEYS to its new job id, if the lock is still in the state it was read in: not set
+# (expected id is empty) or held by the same (finished) job. ARGV is the lock expiry time, followed by the expected &
+# new job id of each lock. Returns 1 for each acquired lock, and 0 for locks taken by another job meanwhile.
+_acquire_job_locks = redis_connection.register_script("""
+local acquired = {}
+for i, key in ipairs(KEYS) do
+    local current = redis.call('get', key)
+    local expected = ARGV[i * 2]
+    if (not current and expected == '') or current == expected then
+        redis.call('set', key, ARGV[i * 2 + 1], 'ex', ARGV[1])
+        acquired[i] = 1
+    else
+        acquired[i] = 0
+    end
+end
+return acquired
+""")
+
+
+def _queue_options(data_source, scheduled_query):
+    if scheduled_query:
+        return data_source.scheduled_queue_name, None
+
+    return data_source.queue_name, settings.ADHOC_QUERY_TIME_LIMIT
+
+
+def _ready_job_ids(job_ids):
+    """
+    The ids of the given jobs that are done, read from the results backend in one request when it supports it.
+    """
+    if not job_ids:
+        return set()
+
+    backend = celery.backend
+    try:
+        values = backend.mget([backend.get_key_for_task(job_id) for job_id in job_ids])
+    except (AttributeError, NotImplementedError):
+        return set(job_id for job_id in job_ids if QueryTask(job_id=job_id).ready())
+
+    return set(job_id for job_id, value in zip(job_ids, values)
+               if value and backend.decode_result(value)['status'] in states.READY_STATES)
+
+
+def enqueue_queries(queries):
+    """
+    Enqueue many queries at once, like enqueue_query() does for each (with their default priority). `queries` is a list
+    of (query, data_source, user_id, scheduled_query, metadata) tuples.
+
+    Instead of a few Redis round trips per query, the existing jobs' locks and states are read, the locks are taken
+    and the trackers are saved with one request each, and the jobs are published on a single broker connection.
+    Returns the job of each query (None for queries that failed to be enqueued).
+    """
+    jobs = [None] * len(queries)
+    if not queries:
+        return jobs
+
+    lock_ids = [_job_lock_id(gen_query_hash(query), data_source.id)
+                for query, data_source, user_id, scheduled_query, metadata in queries]
+
+    existing_job_ids = {}
+    for lock_id, job_id in zip(lock_ids, redis_connection.mget(lock_ids)):
+        if job_id:
+            existing_job_ids[lock_id] = job_id
+
+    ready_job_ids = _ready_job_ids(list(set(existing_job_ids.values())))
+
+    # Queries with a running job get that job, the others get a new one (once for queries listed more than once):
+    new_jobs = {}
+    for i, lock_id in enumerate(lock_ids):
+        job_id = existing_job_ids.get(lock_id)
+        if job_id and job_id not in ready_job_ids:
+            jobs[i] = QueryTask(job_id=job_id)
+        elif lock_id not in new_jobs:
+            new_jobs[lock_id] = (i, job_id or '', uuid())
+
+    if not new_jobs:
+        return jobs
+
+    new_lock_ids = new_jobs.keys()
+    args = [settings.JOB_EXPIRY_TIME]
+    for lock_id in new_lock_ids:
+        _, expected_job_id, job_id = new_jobs[lock_id]
+        args.extend([expected_job_id, job_id])
+    acquired = _acquire_job_locks(keys=new_lock_ids, args=args)
+
+    to_publish = []
+    for lock_id, lock_acquired in zip(new_lock_ids, acquired):
+        i, _, job_id = new_jobs[lock_id]
+        if lock_acquired:
+            to_publish.append((i, lock_id, job_id))
+        else:
+            jobs[i] = QueryTask(job_id=redis_connection.get(lock_id))
+
+    pipe = redis_connection.pipeline(transaction=False)
+    dispatched_queues = set()
+    with celery.producer_or_acquire() as producer:
+        for n, (i, lock_id, job_id) in enumerate(to_publish):
+            query, data_source, user_id, scheduled_query, metadata = queries[i]
+
+            priority = default_priority(scheduled_query)
+            try:
+                queue_name = _send_job(job_id, query, data_source, user_id, scheduled_query, metadata, priority, pipe,
+                                       producer)
+            except Exception:
+                logging.exception("[Manager] Failed adding jobs for queries.")
+                redis_connection.delete(*[lock_id for _, lock_id, _ in to_publish[n:]])
+                break
+
+            dispatched_queues.add(queue_name)
+            jobs[i] = QueryTask(job_id=job_id)
+            tracker = QueryTaskTracker.create(
+                job_id, 'created', gen_query_hash(query), data_source.id,
+                scheduled_query is not None, metadata, queue_name, priority)
+            tracker.save(connection=pipe)
+    pipe.execute()
+
+    for dispatcher in QueryDispatcher.all():
+        if dispatched_queues.intersection(dispatcher.queue_names):
+            dispatcher.dispatch()
+
+    for i, lock_id in enumerate(lock_ids):
+        if jobs[i] is None and lock_id in new_jobs:
+            jobs[i] = jobs[new_jobs[lock_id][0]]
+
+    logging.info("Created %d new jobs for %d queries.", len(to_publish), len(queries))
+
+    return jobs
+
+
+def enqueue_query(query, data_source, user_id, scheduled_query=None, metadata={}, priority=None):
     query_hash = gen_query_hash(query)
+    priority = priority or default_priority(scheduled_query)
     logging.info("Inserting job for %s with metadata=%s", query_hash, metadata)
     try_count = 0
     job = None
@@ -253,28 +692,20 @@ def enqueue_query(query, data_source, user_id, scheduled_query=None, metadata={}
             if not job:
                 pipe.multi()
 
-                time_limit = None
-
-                if scheduled_query:
-                    queue_name = data_source.scheduled_queue_name
-                    scheduled_query_id = scheduled_query.id
-                else:
-                    queue_name = data_source.queue_name
-                    scheduled_query_id = None
-                    time_limit = settings.ADHOC_QUERY_TIME_LIMIT
-
-                result = execute_query.apply_async(args=(query, data_source.id, metadata, user_id, scheduled_query_id),
-                                                   queue=queue_name,
-                                                   time_limit=time_limit)
-                job = QueryTask(async_result=result)
+                job = QueryTask(job_id=uuid())
+                queue_name = _send_job(job.id, query, data_source, user_id, scheduled_query, metadata, priority, pipe)
                 tracker = QueryTaskTracker.create(
-                    result.id, 'created', query_hash, data_source.id,
-                    scheduled_query is not None, metadata)
+                    job.id, 'created', query_hash, data_source.id,
+                    scheduled_query is not None, metadata, queue_name, priority)
                 tracker.save(connection=pipe)
 
                 logging.info("[%s] Created new job: %s", query_hash, job.id)
                 pipe.set(_job_lock_id(query_hash, data_source.id), job.id, settings.JOB_EXPIRY_TIME)
                 pipe.execute()
+
+                dispatcher = QueryDispatcher.for_queue(queue_name)
+                if dispatcher:
+                    dispatcher.dispatch()
             break
 
         except redis.WatchError:
@@ -286,15 +717,54 @@ def enqueue_query(query, data_source, user_id, scheduled_query=None, metadata={}
     return job
 
 
+class QueryWaitTimeout(Exception):
+    def __init__(self, job_id):
+        super(QueryWaitTimeout, self).__init__("Timed out waiting for query job {}.".format(job_id))
+        self.job_id = job_id
+
+
+def run_query_once(query, data_source, user_id, metadata={}, timeout=None):
+    """
+    Execute a query through a query job and wait for its result, for requests that need it right away. Concurrent
+    requests for the same query (by query hash) on the data source share one execution, as enqueue_query() reuses the
+    job already executing it.
+
+    Returns the QueryResult. Raises QueryExecutionError when the execution failed, and QueryWaitTimeout (with the job to
+    poll instead) when it didn't finish within `timeout` seconds (settings.QUERY_RESULT_WAIT_TIMEOUT by default).
+    """
+    job = enqueue_query(query, data_source, user_id, metadata=metadata)
+    if job is None:
+        raise QueryExecutionError("Failed adding a job for the query.")
+
+    return _wait_for_job(job.id, timeout or settings.QUERY_RESULT_WAIT_TIMEOUT)
+
+
+def _wait_for_job(job_id, timeout):
+    try:
+        result = AsyncResult(job_id).get(timeout=timeout, interval=0.2, propagate=False)
+    except CeleryTimeoutError:
+        raise QueryWaitTimeout(job_id)
+
+    if isinstance(result, Exception):
+        raise QueryExecutionError(result.message)
+
+    return models.QueryResult.query.get(result)
+
+
 @celery.task(name="redash.tasks.refresh_queries")
 def refresh_queries():
     logger.info("Refreshing queries...")
 
     outdated_queries_count = 0
+    deferred_queries_count = 0
     query_ids = []
+    queries = []
+    data_source_queries_count = Counter()
 
     with statsd_client.timer('manager.outdated_queries_lookup'):
-        for query in models.Query.outdated_queries():
+        # The most overdue queries first, when only some of a data source's queries are enqueued:
+        outdated_queries = sorted(models.Query.outdated_queries(), key=lambda q: q.next_run_at)
+        for query in outdated_queries:
             if settings.FEATURE_DISABLE_REFRESH_QUERIES:
                 logging.info("Disabled refresh queries.")
             elif query.org.is_disabled:
@@ -303,7 +773,12 @@ def refresh_queries():
                 logging.info("Skipping refresh of %s because the datasource is none.", query.id)
             elif query.data_source.paused:
                 logging.info("Skipping refresh of %s because datasource - %s is paused (%s).", query.id, query.data_source.name, query.data_source.pause_reason)
+            elif (settings.SCHEDULED_QUERIES_PER_DATA_SOURCE and
+                    data_source_queries_count[query.data_source_id] >= settings.SCHEDULED_QUERIES_PER_DATA_SOURCE):
+                # Still due, so it's enqueued on one of the next refreshes.
+                deferred_queries_count += 1
             else:
+                data_source_queries_count[query.data_source_id] += 1
                 if query.options and len(query.options.get('parameters', [])) > 0:
                     query_params = {p['name']: p['value']
                                     for p in query.options['parameters']}
@@ -311,16 +786,25 @@ def refresh_queries():
                 else:
                     query_text = query.query_text
 
-                enqueue_query(query_text, query.data_source, query.user_id,
-                              scheduled_query=query,
-                              metadata={'Query ID': query.id, 'Username': 'Scheduled'})
+                queries.append((query_text, query.data_source, query.user_id, query,
+                                {'Query ID': query.id, 'Username': 'Scheduled'}))
 
                 query_ids.append(query.id)
                 outdated_queries_count += 1
 
+        # Saves the next run times outdated_queries() updated.
+        models.db.session.commit()
+
+    with statsd_client.timer('manager.enqueue_outdated_queries'):
+        enqueue_queries(queries)
+
     statsd_client.gauge('manager.outdated_queries', outdated_queries_count)
+    statsd_client.gauge('manager.deferred_queries', deferred_queries_count)
 
     logger.info("Done refreshing queries. Found %d outdated queries: %s" % (outdated_queries_count, query_ids))
+    if deferred_queries_count:
+        logger.info("Deferred %d outdated queries of data sources with more than %d outdated queries.",
+                    deferred_queries_count, settings.SCHEDULED_QUERIES_PER_DATA_SOURCE)
 
     status = redis_connection.hgetall('redash:status')
     now = time.time()
@@ -334,6 +818,12 @@ def refresh_queries():
     statsd_client.gauge('manager.seconds_since_refresh', now - float(status.get('last_refresh_at', now)))
 
 
+def _release_dispatcher_job(tracker):
+    dispatcher = QueryDispatcher.for_queue(tracker.data.get('queue_name'))
+    if dispatcher:
+        dispatcher.release(tracker.task_id)
+
+
 @celery.task(name="redash.tasks.cleanup_tasks")
 def cleanup_tasks():
     in_progress = QueryTaskTracker.all(QueryTaskTracker.IN_PROGRESS_LIST)
@@ -343,6 +833,8 @@ def cleanup_tasks():
         if result.ready():
             logging.info("in progress tracker %s finished", tracker.query_hash)
             _unlock(tracker.query_hash, tracker.data_source_id)
+            DataSourceSemaphore(tracker.data_source_id).release(tracker.task_id)
+            _release_dispatcher_job(tracker)
             tracker.update(state='finished')
 
     waiting = QueryTaskTracker.all(QueryTaskTracker.WAITING_LIST)
@@ -352,33 +844,107 @@ def cleanup_tasks():
         if result.ready():
             logging.info("waiting tracker %s finished", tracker.query_hash)
             _unlock(tracker.query_hash, tracker.data_source_id)
+            _release_dispatcher_job(tracker)
             tracker.update(state='finished')
 
+    for dispatcher in QueryDispatcher.all():
+        dispatcher.dispatch()
+
     # Maintain constant size of the finished tasks list:
     removed = 1000
     while removed > 0:
         removed = QueryTaskTracker.prune(QueryTaskTracker.DONE_LIST, 1000)
 
 
+class QueryResultsCleanup(object):
+    """
+    State of the query results cleanup, kept in Redis between runs: where the last run stopped (the (retrieved_at, id)
+    key of the last result it went through, cleared once it went through all of them) and the batch size it ended with.
+    """
+    KEY_NAME = 'query_results_cleanup'
+
+    def __init__(self):
+        state = redis_connection.hgetall(self.KEY_NAME)
+        if state.get('after_retrieved_at'):
+            self.after = (parse_date(state['after_retrieved_at']), int(state['after_id']))
+        else:
+            self.after = None
+        self.batch_size = int(state.get('batch_size') or settings.QUERY_RESULTS_CLEANUP_COUNT)
+
+    def save(self, **stats):
+        state = dict(stats, batch_size=self.batch_size, after_retrieved_at='', after_id='')
+        if self.after is not None:
+            state['after_retrieved_at'] = self.after[0].isoformat()
+            state['after_id'] = self.after[1]
+        redis_connection.hmset(self.KEY_NAME, state)
+
+    def adapt_batch_size(self, latency):
+        if latency > settings.QUERY_RESULTS_CLEANUP_BATCH_LATENCY:
+            self.batch_size = max(self.batch_size / 2, settings.QUERY_RESULTS_CLEANUP_COUNT)
+        elif latency < settings.QUERY_RESULTS_CLEANUP_BATCH_LATENCY / 2:
+            self.batch_size = min(self.batch_size * 2, settings.QUERY_RESULTS_CLEANUP_MAX_BATCH)
+
+
 @celery.task(name="redash.tasks.cleanup_query_results")
 def cleanup_query_results():
     """
     Job to cleanup unused query results -- such that no query links to them anymore, and older than
     settings.QUERY_RESULTS_MAX_AGE (a week by default, so it's less likely to be open in someone's browser and be used).
 
-    Each time the job deletes only settings.QUERY_RESULTS_CLEANUP_COUNT (100 by default) query results so it won't choke
-    the database in case of many such results.
+    The job goes through the old results in (retrieved_at, id) order, a batch at a time, continuing from where its
+    previous run stopped. Batch sizes adapt to how long deleting them takes (see QUERY_RESULTS_CLEANUP_BATCH_LATENCY),
+    so it won't choke the database, and it runs until it went through all the old results or for
+    settings.QUERY_RESULTS_CLEANUP_TIME_BUDGET seconds.
     """
+    started_at = time.time()
+    retrieved_before = utils.utcnow() - datetime.timedelta(days=settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
+    cleanup = QueryResultsCleanup()
+
+    logging.info("Running query results clean up (removing unused results that are %d days old or more, from %s)",
+                 settings.QUERY_RESULTS_CLEANUP_MAX_AGE, cleanup.after)
+
+    batches = deleted_count = storage_deleted_count = 0
+    caught_up = False
+    while time.time() - started_at < settings.QUERY_RESULTS_CLEANUP_TIME_BUDGET:
+        batch_started_at = time.time()
+        last_key, storage_keys = models.QueryResult.delete_unused(retrieved_before, cleanup.after, cleanup.batch_size)
+        models.db.session.commit()
+        latency = time.time() - batch_started_at
+
+        cleanup.after = last_key
+        if last_key is None:
+            # Went through all the old results, the next run starts over.
+            caught_up = True
+            break
 
-    logging.info("Running query results clean up (removing maximum of %d unused results, that are %d days old or more)",
-                 settings.QUERY_RESULTS_CLEANUP_COUNT, settings.QUERY_RESULTS_CLEANUP_MAX_AGE)
+        batches += 1
+        deleted_count += len(storage_keys)
+        statsd_client.timing('cleanup_query_results.batch', latency * 1000)
+        cleanup.adapt_batch_size(latency)
 
-    unused_query_results = models.QueryResult.unused(settings.QUERY_RESULTS_CLEANUP_MAX_AGE).limit(settings.QUERY_RESULTS_CLEANUP_COUNT)
-    deleted_count = models.QueryResult.query.filter(
-        models.QueryResult.id.in_(unused_query_results.subquery())
-    ).delete(synchronize_session=False)
+        storage_keys = [key for key in storage_keys if key]
+        if storage_keys:
+            storage_deleted_count += models.QueryResult.delete_unreferenced_data(storage_keys)
+            models.db.session.commit()
+
+    # Data of results that were never committed (written over an hour ago, so they're long done):
+    storage_deleted_count += models.QueryResult.sweep_stored_data(time.time() - 3600)
     models.db.session.commit()
-    logger.info("Deleted %d unused query results.", deleted_count)
+
+    run_time = time.time() - started_at
+    cleanup.save(last_run_at=time.time(), last_run_time=run_time, last_deleted_count=deleted_count,
+                 last_batches=batches, caught_up=int(caught_up))
+
+    statsd_client.gauge('cleanup_query_results.deleted', deleted_count)
+    statsd_client.gauge('cleanup_query_results.storage_deleted', storage_deleted_count)
+    statsd_client.gauge('cleanup_query_results.batches', batches)
+    statsd_client.gauge('cleanup_query_results.batch_size', cleanup.batch_size)
+    statsd_client.gauge('cleanup_query_results.caught_up', int(caught_up))
+    statsd_client.timing('cleanup_query_results.run_time', run_time * 1000)
+
+    logger.info("Deleted %d unused query results (%d from the query results storage) in %d batches, %.2f seconds "
+                "(%s).", deleted_count, storage_deleted_count, batches, run_time,
+                "caught up" if caught_up else "continuing on the next run")
 
 
 @celery.task(name="redash.tasks.refresh_schema", time_limit=90, soft_time_limit=60)
@@ -456,6 +1022,46 @@ class QueryExecutor(object):
             models.scheduled_queries_executions.update(self.tracker.query_id)
 
     def run(self):
+        dispatcher = QueryDispatcher.for_queue(self.tracker.data.get('queue_name'))
+        if dispatcher is None:
+            return self._run_in_data_source_slot()
+
+        try:
+            result = self._run_in_data_source_slot()
+        except Retry:
+            # Waiting for a data source slot keeps the job's place in its queue.
+            raise
+        except Exception:
+            self._release_dispatcher(dispatcher)
+            raise
+
+        self._release_dispatcher(dispatcher)
+        return result
+
+    def _release_dispatcher(self, dispatcher):
+        try:
+            dispatcher.release(self.task.request.id)
+            dispatcher.dispatch()
+        except Exception:
+            logger.exception("task=execute_query state=dispatch_failed dispatcher=%s", dispatcher.name)
+
+    def _run_in_data_source_slot(self):
+        max_concurrent_queries = self.data_source.query_runner.max_concurrent_queries
+        if not max_concurrent_queries:
+            return self._run()
+
+        semaphore = DataSourceSemaphore(self.data_source.id, max_concurrent_queries)
+        if not semaphore.acquire(self.task.request.id, self.tracker.created_at):
+            logger.info("task=execute_query state=waiting_for_slot ds_id=%s task_id=%s", self.data_source.id,
+                        self.task.request.id)
+            raise self.task.retry(countdown=settings.DATA_SOURCE_SLOT_RETRY_INTERVAL, max_retries=None)
+
+        try:
+            return self._run()
+        finally:
+            semaphore.release(self.task.request.id)
+
+    def _run(self):
         signal.signal(signal.SIGINT, signal_handler)
         self.tracker.update(started_at=time.time(), state='started')
 
@@ -466,7 +1072,7 @@ class QueryExecutor(object):
         annotated_query = self._annotate_query(query_runner)
 
         try:
-            data, error = query_runner.run_query(annotated_query, self.user)
+            data, error = self._fetch_result(query_runner, annotated_query)
         except Exception as e:
             error = unicode(e)
             data = None
@@ -519,6 +1125,32 @@ class QueryExecutor(object):
         models.db.session.commit()
         return result
 
+    def _fetch_result(self, query_runner, annotated_query):
+        # Rows are encoded (and compressed) batch by batch as the query runner fetches them, so the complete result
+        # is never held in memory as Python objects or as JSON text.
+        # Reading stops at the data source's (or global) result size limits, which closes the runner's iterator so it
+        # can stop fetching too.
+        results = query_runner.run_query_iter(annotated_query, self.user)
+        try:
+            writer = result_codec.ResultWriter(next(results))
+            for part in limit_result(results, query_runner.max_result_rows, query_runner.max_result_bytes):
+                if isinstance(part, dict):
+                    writer.meta.update(part)
+                else:
+                    writer.write_rows(part)
+
+            if writer.meta.get('truncated'):
+                writer.meta['row_count'] = writer.row_count
+                logger.warning("task=execute_query state=truncated query_hash=%s ds_id=%d row_count=%d",
+                               self.query_hash, self.data_source.id, writer.row_count)
+            return writer.getvalue(), None
+        except QueryRunnerError as e:
+            return None, e.message
+        except InterruptException:
+            return None, "Query cancelled by user."
+        finally:
+            results.close()
+
     def _annotate_query(self, query_runner):
         if query_runner.annotate_query():
             self.metadata['Task ID'] = self.task.request.id
@@ -106,11 +106,16 @@ class UnicodeWriter:
     """
 
     def __init__(self, f, dialect=csv.excel, encoding=WRITER_ENCODING, **kwds):
-        # Redirect output to a queue
-        self.queue = cStringIO.StringIO()
-        self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
         self.stream = f
-        self.encoder = codecs.getincrementalencoder(encoding)()
+        if codecs.lookup(encoding).name == codecs.lookup(WRITER_ENCODING).name:
+            # Values are already encoded in the target encoding, so rows can be written straight to the stream
+            self.queue = None
+            self.writer = csv.writer(f, dialect=dialect, **kwds)
+        else:
+            # Redirect output to a queue
+            self.queue = cStringIO.StringIO()
+            self.writer = csv.writer(self.queue, dialect=dialect, **kwds)
+            self.encoder = codecs.getincrementalencoder(encoding)()
 
     def _encode_utf8(self, val):
         if isinstance(val, (unicode, str)):
@@ -120,6 +125,9 @@ class UnicodeWriter:
 
     def writerow(self, row):
         self.writer.writerow([self._encode_utf8(s) for s in row])
+        if self.queue is None:
+            return
+
         # Fetch UTF-8 output from the queue ...
         data = self.queue.getvalue()
         data = data.decode(WRITER_ENCODING)
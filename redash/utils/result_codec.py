@@ -0,0 +1,347 @@
+"""
+Storage format of query results (`QueryResult.data`).
+
+Results are stored column-oriented and compressed, in chunks of rows:
+
+    MAGIC | version | compression | header length | header | chunk | chunk | ...
+
+The header is (uncompressed) JSON holding everything the query runner returned except the rows (`columns` and any
+other keys), the names of the row keys, the total row count and the row count & byte length of every chunk. Each
+chunk is a compressed JSON list of column arrays for its range of rows, so readers that need only some of the rows
+(the first row for alerts, a page of rows for the API) decompress only the chunks they touch.
+
+Payloads that don't start with MAGIC are results stored before this format existed (JSON text of row dicts), and are
+still readable.
+
+Readers accept payloads as strings, or as objects that support len() and slicing (like the memory-mapped files and S3
+objects of redash.utils.result_storage), of which they read only the byte ranges they need.
+"""
+import json
+import struct
+import zlib
+
+from redash import settings
+from redash.utils import JSONEncoder
+
+try:
+    import lz4.frame
+    lz4_enabled = True
+except ImportError:
+    lz4_enabled = False
+
+MAGIC = '\x00RDQ'
+FORMAT_VERSION = 1
+
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZ4 = 2
+
+COMPRESSION_TYPES = {
+    'none': COMPRESSION_NONE,
+    'zlib': COMPRESSION_ZLIB,
+    'lz4': COMPRESSION_LZ4
+}
+
+_prefix = struct.Struct('>4sBBI')
+
+
+class ResultFormatError(Exception):
+    pass
+
+
+def _compression_type(name=None):
+    name = name or settings.QUERY_RESULTS_COMPRESSION
+    if name not in COMPRESSION_TYPES:
+        raise ResultFormatError("Unknown query results compression: {}".format(name))
+
+    # lz4 is an optional dependency, fall back to zlib when it's not installed:
+    if name == 'lz4' and not lz4_enabled:
+        return COMPRESSION_ZLIB
+
+    return COMPRESSION_TYPES[name]
+
+
+def _compress(compression, data):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.compress(data, 6)
+    if compression == COMPRESSION_LZ4:
+        return lz4.frame.compress(data)
+    return data
+
+
+def _decompress(compression, data):
+    if compression == COMPRESSION_ZLIB:
+        return zlib.decompress(data)
+    if compression == COMPRESSION_LZ4:
+        if not lz4_enabled:
+            raise ResultFormatError("Query result is lz4 compressed, but lz4 is not installed.")
+        return lz4.frame.decompress(data)
+    return data
+
+
+def _to_bytes(payload):
+    if isinstance(payload, unicode):
+        return payload.encode('utf-8')
+
+    # psycopg2 returns bytea values as buffer objects
+    if isinstance(payload, buffer):
+        return bytes(payload)
+
+    return payload
+
+
+def _is_encoded(payload):
+    return payload[:len(MAGIC)] == MAGIC
+
+
+def _column_names(columns):
+    if not isinstance(columns, list):
+        return []
+
+    return [c['name'] for c in columns if isinstance(c, dict) and 'name' in c]
+
+
+class ResultWriter(object):
+    """
+    Incrementally encodes a query result: rows are buffered until a chunk is full and then compressed, so only the
+    compressed chunks (and at most one chunk of raw rows) are kept in memory.
+    """
+
+    def __init__(self, meta, compression=None, chunk_size=None):
+        self.meta = dict(meta)
+        self.meta.pop('rows', None)
+        self.compression = _compression_type(compression)
+        self.chunk_size = chunk_size or settings.QUERY_RESULTS_CHUNK_SIZE
+        self.keys = _column_names(self.meta.get('columns'))
+        self._known_keys = set(self.keys)
+        self.row_count = 0
+        self.chunks = []
+        self._pending = []
+        self._size = 0
+
+    @property
+    def size(self):
+        """Number of bytes written so far (compressed chunks only)."""
+        return self._size
+
+    def write_rows(self, rows):
+        for row in rows:
+            self.row_count += 1
+            self._pending.append(row)
+            if len(self._pending) >= self.chunk_size:
+                self._flush()
+
+    def _flush(self):
+        if not self._pending:
+            return
+
+        for row in self._pending:
+            for key in row:
+                if key not in self._known_keys:
+                    self._known_keys.add(key)
+                    self.keys.append(key)
+
+        arrays = [[row.get(key) for row in self._pending] for key in self.keys]
+        chunk = _compress(self.compression, json.dumps(arrays, cls=JSONEncoder))
+
+        self.chunks.append((len(self._pending), chunk))
+        self._size += len(chunk)
+        self._pending = []
+
+    def getvalue(self):
+        self._flush()
+
+        header = json.dumps({
+            'meta': self.meta,
+            'keys': self.keys,
+            'row_count': self.row_count,
+            'chunks': [[count, len(chunk)] for count, chunk in self.chunks]
+        }, cls=JSONEncoder)
+
+        parts = [_prefix.pack(MAGIC, FORMAT_VERSION, self.compression, len(header)), header]
+        parts.extend(chunk for _, chunk in self.chunks)
+        return ''.join(parts)
+
+
+class ResultReader(object):
+    """
+    Read access to a stored query result, in either the chunked format or the legacy JSON text.
+
+    Legacy JSON results are decoded only once their meta or rows are read: iter_json() copies a complete one as is.
+    """
+
+    def __init__(self, payload):
+        if payload is None:
+            raise ResultFormatError("Query result has no data.")
+
+        self.payload = _to_bytes(payload)
+        self.legacy = not _is_encoded(self.payload)
+        self._legacy_result = None
+
+        if not self.legacy:
+            self._read_header()
+
+    @property
+    def _legacy_data(self):
+        if self._legacy_result is None:
+            data = json.loads(self.payload[:])
+            if not isinstance(data, dict) or not isinstance(data.get('rows'), list):
+                raise ResultFormatError("Query result isn't a columns & rows result.")
+            self._legacy_result = data
+
+        return self._legacy_result
+
+    @property
+    def meta(self):
+        if self.legacy:
+            return {k: v for k, v in self._legacy_data.iteritems() if k != 'rows'}
+
+        return self._meta
+
+    @property
+    def row_count(self):
+        if self.legacy:
+            return len(self._legacy_data['rows'])
+
+        return self._row_count
+
+    def _read_header(self):
+        if len(self.payload) < _prefix.size:
+            raise ResultFormatError("Query result payload is truncated.")
+
+        _, version, self.compression, header_length = _prefix.unpack(self.payload[:_prefix.size])
+        if version != FORMAT_VERSION:
+            raise ResultFormatError("Unsupported query result format version: {}".format(version))
+
+        offset = _prefix.size + header_length
+        header = json.loads(self.payload[_prefix.size:offset])
+
+        self._meta = header['meta']
+        self.keys = header['keys']
+        self._row_count = header['row_count']
+        self.chunks = []
+        first_row = 0
+        for count, length in header['chunks']:
+            self.chunks.append((first_row, count, offset, length))
+            first_row += count
+            offset += length
+
+    @property
+    def columns(self):
+        return self.meta.get('columns', [])
+
+    def _chunk_rows(self, count, offset, length, keys=None):
+        arrays = json.loads(_decompress(self.compression, self.payload[offset:offset + length]))
+        names = self.keys[:len(arrays)]
+
+        if keys is not None:
+            selected = [(name, values) for name, values in zip(names, arrays) if name in keys]
+            names = [name for name, _ in selected]
+            arrays = [values for _, values in selected]
+
+        if not arrays:
+            return [{} for _ in range(count)]
+
+        return (dict(zip(names, values)) for values in zip(*arrays))
+
+    def iter_rows(self, offset=0, limit=None, keys=None):
+        """
+        Yield the rows in [offset, offset + limit), decoding only the chunks that hold them. When `keys` is given, rows
+        only have these keys.
+        """
+        end = self.row_count if limit is None else min(offset + limit, self.row_count)
+        if offset >= end:
+            return
+
+        if keys is not None:
+            keys = set(keys)
+
+        if self.legacy:
+            for row in self._legacy_data['rows'][offset:end]:
+                if keys is not None:
+                    row = {k: v for k, v in row.iteritems() if k in keys}
+                yield row
+            return
+
+        for first_row, count, chunk_offset, length in self.chunks:
+            if first_row + count <= offset:
+                continue
+            if first_row >= end:
+                break
+
+            for i, row in enumerate(self._chunk_rows(count, chunk_offset, length, keys), first_row):
+                if i >= end:
+                    break
+                if i >= offset:
+                    yield row
+
+    def iter_json(self, meta=None, offset=0, limit=None, keys=None, batch_size=1000):
+        """
+        Yield the JSON text of the result (with `meta` instead of its keys other than rows, and the rows iter_rows()
+        returns for offset/limit/keys) in pieces. A complete legacy result is returned as stored, without decoding it.
+        """
+        if self.legacy and meta is None and offset == 0 and limit is None and keys is None:
+            yield self.payload[:]
+            return
+
+        meta = self.meta if meta is None else meta
+        if meta:
+            yield json.dumps(meta, cls=JSONEncoder)[:-1] + ', "rows": ['
+        else:
+            yield '{"rows": ['
+
+        separator = ''
+        rows = []
+        for row in self.iter_rows(offset, limit, keys):
+            rows.append(row)
+            if len(rows) >= batch_size:
+                yield separator + json.dumps(rows, cls=JSONEncoder)[1:-1]
+                separator = ', '
+                rows = []
+
+        if rows:
+            yield separator + json.dumps(rows, cls=JSONEncoder)[1:-1]
+
+        yield ']}'
+
+    def to_dict(self):
+        if self.legacy:
+            return self._legacy_data
+
+        data = dict(self.meta)
+        data['rows'] = list(self.iter_rows())
+        return data
+
+
+def serialize(data, compression=None, chunk_size=None):
+    """
+    Encode a query result for storage. Accepts the result as returned by query runners (JSON text) or as a dictionary.
+    Values that aren't a `{'columns': ..., 'rows': [...]}` result are stored as plain JSON, and payloads that are
+    already encoded (by a ResultWriter) are stored as is.
+    """
+    if data is None:
+        return None
+
+    if isinstance(data, str) and data.startswith(MAGIC):
+        return data
+
+    if isinstance(data, basestring):
+        data = json.loads(data)
+
+    if not isinstance(data, dict) or not isinstance(data.get('rows'), list):
+        return json.dumps(data, cls=JSONEncoder)
+
+    writer = ResultWriter(data, compression=compression, chunk_size=chunk_size)
+    writer.write_rows(data['rows'])
+    return writer.getvalue()
+
+
+def deserialize(payload):
+    if payload is None:
+        return None
+
+    payload = _to_bytes(payload)
+    if not _is_encoded(payload):
+        return json.loads(payload[:])
+
+    return ResultReader(payload).to_dict()
@@ -0,0 +1,167 @@
+"""
+Storage of large query results outside of the database.
+
+When settings.QUERY_RESULTS_STORAGE is set, query results larger than settings.QUERY_RESULTS_STORAGE_THRESHOLD bytes
+are written to the configured storage, and `QueryResult` keeps only their key (and size & checksum). Stored results
+are opened as objects that support len() and slicing, so readers fetch only the byte ranges they need: the file
+system storage memory-maps the file, and the S3 storage reads ranges of the object.
+"""
+import errno
+import mmap
+import os
+import tempfile
+
+from redash import settings
+
+try:
+    import boto3
+    s3_enabled = True
+except ImportError:
+    s3_enabled = False
+
+
+class ResultStorageError(Exception):
+    pass
+
+
+class BaseResultStorage(object):
+    def put(self, key, payload):
+        raise NotImplementedError()
+
+    def open(self, key):
+        """Opens the stored data, as an object to close() once done reading it."""
+        raise NotImplementedError()
+
+    def delete(self, key):
+        raise NotImplementedError()
+
+
+class FileSystemResultStorage(BaseResultStorage):
+    def __init__(self, path):
+        self.path = path
+
+    def _filename(self, key):
+        return os.path.join(self.path, key)
+
+    def put(self, key, payload):
+        filename = self._filename(key)
+        directory = os.path.dirname(filename)
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        # Readers never see a partially written file, as it's only renamed into place once complete:
+        fd, temp_filename = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(payload)
+            os.rename(temp_filename, filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+
+    def open(self, key):
+        try:
+            with open(self._filename(key), 'rb') as f:
+                return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError, ValueError) as e:
+            raise ResultStorageError("Failed reading query result {}: {}".format(key, e))
+
+    def delete(self, key):
+        try:
+            os.remove(self._filename(key))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+
+
+class S3Object(object):
+    """
+    Read access to an S3 object by byte ranges. Its beginning (which holds the result's header, and all of small
+    results) is read once when it's opened.
+    """
+    head_size = 64 * 1024
+
+    def __init__(self, client, bucket, key):
+        self.client = client
+        self.bucket = bucket
+        self.key = key
+        self.size = client.head_object(Bucket=bucket, Key=key)['ContentLength']
+        self._head = self._read(0, min(self.head_size, self.size))
+
+    def _read(self, start, stop):
+        if start >= stop:
+            return ''
+
+        response = self.client.get_object(Bucket=self.bucket, Key=self.key,
+                                          Range='bytes={}-{}'.format(start, stop - 1))
+        return response['Body'].read()
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, item):
+        if not isinstance(item, slice) or item.step not in (None, 1):
+            raise TypeError("S3 objects support only contiguous slices.")
+
+        start, stop, _ = item.indices(self.size)
+        if stop <= len(self._head):
+            return self._head[start:stop]
+
+        return self._read(start, stop)
+
+    def close(self):
+        self._head = None
+
+
+class S3ResultStorage(BaseResultStorage):
+    def __init__(self, bucket, prefix='', endpoint_url=None, client=None):
+        if client is None:
+            if not s3_enabled:
+                raise ResultStorageError("S3 query results storage requires boto3.")
+            # endpoint_url is used for S3 compatible stores (MinIO, Ceph, ...)
+            client = boto3.client('s3', endpoint_url=endpoint_url or None)
+
+        self.client = client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def put(self, key, payload):
+        self.client.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=payload)
+
+    def open(self, key):
+        try:
+            return S3Object(self.client, self.bucket, self.prefix + key)
+        except Exception as e:
+            raise ResultStorageError("Failed reading query result {}: {}".format(key, e))
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+_storages = {}
+
+
+def get_result_storage():
+    """The configured result storage, or None when results are kept in the database."""
+    storage_type = settings.QUERY_RESULTS_STORAGE
+    if not storage_type:
+        return None
+
+    if storage_type == 'file':
+        config = (storage_type, settings.QUERY_RESULTS_STORAGE_PATH)
+    elif storage_type == 's3':
+        config = (storage_type, settings.QUERY_RESULTS_S3_BUCKET, settings.QUERY_RESULTS_S3_PREFIX,
+                  settings.QUERY_RESULTS_S3_ENDPOINT_URL)
+    else:
+        raise ResultStorageError("Unknown query results storage: {}".format(storage_type))
+
+    if config not in _storages:
+        if storage_type == 'file':
+            _storages[config] = FileSystemResultStorage(*config[1:])
+        else:
+            _storages[config] = S3ResultStorage(*config[1:])
+
+    return _storages[config]
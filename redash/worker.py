@@ -27,6 +27,14 @@ celery_schedule = {
     'refresh_schemas': {
         'task': 'redash.tasks.refresh_schemas',
         'schedule': timedelta(minutes=settings.SCHEMAS_REFRESH_SCHEDULE)
+    },
+    'drain_events': {
+        'task': 'redash.tasks.drain_events',
+        'schedule': timedelta(seconds=settings.EVENTS_DRAIN_INTERVAL)
+    },
+    'manage_event_partitions': {
+        'task': 'redash.tasks.manage_event_partitions',
+        'schedule': timedelta(days=1)
     }
 }
 
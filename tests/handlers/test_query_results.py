@@ -1,6 +1,14 @@
 import json
+import uuid
+
+import mock
+
 from tests import BaseTestCase
+from redash import models, settings
 from redash.models import db
+from redash.tasks.queries import QueryExecutionError, QueryWaitTimeout
+from redash.utils import gen_query_hash
+from redash.worker import celery
 
 
 class TestQueryResultsCacheHeaders(BaseTestCase):
@@ -11,6 +19,18 @@ class TestQueryResultsCacheHeaders(BaseTestCase):
         rv = self.make_request('get', '/api/queries/{}/results/{}.json'.format(query.id, query_result.id))
         self.assertIn('Cache-Control', rv.headers)
 
+    def test_returns_not_modified_for_current_etag(self):
+        query_result = self.factory.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+        path = '/api/queries/{}/results/{}.json'.format(query.id, query_result.id)
+
+        rv = self.make_request('get', path)
+        self.assertEquals(rv.status_code, 200)
+
+        rv = self.client.get('/{}{}'.format(self.factory.org.slug, path),
+                             headers={'If-None-Match': rv.headers['ETag']})
+        self.assertEquals(rv.status_code, 304)
+
     def test_doesnt_use_cache_headers_for_non_specific_result(self):
         query_result = self.factory.create_query_result()
         query = self.factory.create_query(latest_query_data=query_result)
@@ -49,6 +69,24 @@ class TestQueryResultListAPI(BaseTestCase):
         self.assertNotIn('query_result', rv.json)
         self.assertIn('job', rv.json)
 
+    def test_execute_new_query_with_priority(self):
+        rv = self.make_request('post', '/api/query_results',
+                               data={'data_source_id': self.factory.data_source.id,
+                                     'query': 'SELECT 1',
+                                     'max_age': 0,
+                                     'priority': 'dashboard'})
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals('dashboard', rv.json['job']['priority'])
+
+        rv = self.make_request('post', '/api/query_results',
+                               data={'data_source_id': self.factory.data_source.id,
+                                     'query': 'SELECT 2',
+                                     'max_age': 0,
+                                     'priority': 'urgent'})
+
+        self.assertEquals(rv.status_code, 400)
+
     def test_execute_query_without_access(self):
         group = self.factory.create_group()
         db.session.commit()
@@ -118,6 +156,104 @@ class TestQueryResultAPI(BaseTestCase):
         rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
         self.assertEquals(rv.status_code, 200)
 
+    def test_parameterized_query_result(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}")
+        query_result = self.factory.create_query_result()
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once', return_value=query_result) as run_query_once:
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1'.format(query.id))
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(query_result.id, rv.json['query_result']['id'])
+        self.assertEquals('SELECT 1', run_query_once.call_args[0][0])
+
+    def test_parameterized_query_result_is_cached(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}", options={'parameters_cache_max_age': 600})
+        query_result = self.factory.create_query_result()
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once', return_value=query_result) as run_query_once:
+            self.make_request('get', '/api/queries/{}/results.json?p_param=1'.format(query.id))
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1'.format(query.id))
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(query_result.id, rv.json['query_result']['id'])
+        self.assertEquals(1, run_query_once.call_count)
+
+    def test_parameterized_query_result_returns_job_when_waiting_times_out(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}")
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once', side_effect=QueryWaitTimeout('job-id')):
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1'.format(query.id))
+
+        self.assertEquals(rv.status_code, 202)
+        self.assertEquals('job-id', rv.json['job']['id'])
+
+    def test_parameterized_query_result_with_zero_max_age_is_executed(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}", options={'parameters_cache_max_age': 600})
+        cached_result = self.factory.create_query_result()
+        query_result = self.factory.create_query_result()
+        models.parameterized_results_cache.set(query, {'param': '1'}, cached_result)
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once', return_value=query_result):
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1'.format(query.id))
+            self.assertEquals(cached_result.id, rv.json['query_result']['id'])
+
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1&maxAge=0'.format(query.id))
+            self.assertEquals(query_result.id, rv.json['query_result']['id'])
+
+    def test_parameterized_query_result_job_polled_until_it_finishes(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}")
+        job_id = str(uuid.uuid4())
+        query_result = self.factory.create_query_result(query_text=u"SELECT 1", data_source=query.data_source)
+        path = '/api/queries/{}/results.json?p_param=1'.format(query.id)
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once',
+                           side_effect=QueryWaitTimeout(job_id)) as run_query_once:
+            rv = self.make_request('get', path)
+            self.assertEquals(rv.status_code, 202)
+
+            # Polling doesn't wait for the job, nor execute the query again:
+            rv = self.make_request('get', path + '&job=' + job_id)
+            self.assertEquals(rv.status_code, 202)
+            self.assertEquals(job_id, rv.json['job']['id'])
+
+            celery.backend.store_result(job_id, query_result.id, 'SUCCESS')
+            rv = self.make_request('get', path + '&job=' + job_id)
+
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(query_result.id, rv.json['query_result']['id'])
+        self.assertEquals(1, run_query_once.call_count)
+
+    def test_parameterized_query_result_job_polled_after_it_failed(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}")
+        job_id = str(uuid.uuid4())
+        celery.backend.store_result(job_id, QueryExecutionError("Bad query"), 'FAILURE')
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True), \
+                mock.patch('redash.handlers.query_results.run_query_once') as run_query_once:
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1&job={}'.format(query.id, job_id))
+
+        self.assertEquals(rv.status_code, 400)
+        self.assertEquals("Bad query", rv.json['job']['error'])
+        self.assertFalse(run_query_once.called)
+
+    def test_parameterized_query_result_job_of_another_query(self):
+        query = self.factory.create_query(query_text=u"SELECT {{param}}")
+        job_id = str(uuid.uuid4())
+        query_result = self.factory.create_query_result(query_text=u"SELECT 2", query_hash=gen_query_hash(u"SELECT 2"),
+                                                         data_source=query.data_source)
+        celery.backend.store_result(job_id, query_result.id, 'SUCCESS')
+
+        with mock.patch.object(settings, 'ALLOW_PARAMETERS_IN_EMBEDS', True):
+            rv = self.make_request('get', '/api/queries/{}/results.json?p_param=1&job={}'.format(query.id, job_id))
+
+        self.assertEquals(rv.status_code, 404)
+
     def test_access_with_query_api_key(self):
         ds = self.factory.create_data_source(group=self.factory.org.default_group, view_only=False)
         query = self.factory.create_query()
@@ -152,6 +288,55 @@ class TestQueryResultAPI(BaseTestCase):
         self.assertEquals(rv.status_code, 403)
 
 
+class TestQueryResultSlicing(BaseTestCase):
+    def create_query_result(self):
+        data = {'columns': [{'name': 'id'}, {'name': 'name'}],
+                'rows': [{'id': i, 'name': 'row {}'.format(i)} for i in range(50)]}
+        return self.factory.create_query_result(data=json.dumps(data))
+
+    def test_returns_all_rows_by_default(self):
+        query_result = self.create_query_result()
+
+        rv = self.make_request('get', '/api/query_results/{}'.format(query_result.id))
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals(50, len(rv.json['query_result']['data']['rows']))
+
+    def test_returns_range_of_rows(self):
+        query_result = self.create_query_result()
+
+        rv = self.make_request('get', '/api/query_results/{}?offset=10&limit=5'.format(query_result.id))
+        data = rv.json['query_result']['data']
+        self.assertEquals(range(10, 15), [row['id'] for row in data['rows']])
+        self.assertEquals(50, data['row_count'])
+        self.assertEquals(2, len(data['columns']))
+
+    def test_returns_selected_columns(self):
+        query_result = self.create_query_result()
+        query = self.factory.create_query(latest_query_data=query_result)
+
+        rv = self.make_request('get', '/api/queries/{}/results.json?columns=name&limit=1'.format(query.id))
+        data = rv.json['query_result']['data']
+        self.assertEquals([{'name': 'name'}], data['columns'])
+        self.assertEquals([{'name': 'row 0'}], data['rows'])
+
+    def test_rejects_negative_offset(self):
+        query_result = self.create_query_result()
+
+        rv = self.make_request('get', '/api/query_results/{}?offset=-1'.format(query_result.id))
+        self.assertEquals(rv.status_code, 400)
+
+
+class TestQueryResultCsvResponse(BaseTestCase):
+    def test_renders_csv_file(self):
+        data = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': 1, 'b': 'x'}, {'a': 2}]}
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+        query = self.factory.create_query(latest_query_data=query_result)
+
+        rv = self.make_request('get', '/api/queries/{}/results.csv'.format(query.id), is_json=False)
+        self.assertEquals(rv.status_code, 200)
+        self.assertEquals('a,b\r\n1,x\r\n2,\r\n', rv.data)
+
+
 class TestQueryResultExcelResponse(BaseTestCase):
     def test_renders_excel_file(self):
         query = self.factory.create_query()
@@ -0,0 +1,122 @@
+import json
+from unittest import TestCase
+
+from redash.query_runner import (BaseQueryRunner, QueryRunnerError, get_configuration_schema_for_query_runner_type,
+                                 limit_result)
+
+
+class LegacyQueryRunner(BaseQueryRunner):
+    def __init__(self, result):
+        super(LegacyQueryRunner, self).__init__({})
+        self.result = result
+
+    def run_query(self, query, user):
+        return self.result
+
+
+class StreamingQueryRunner(BaseQueryRunner):
+    def __init__(self, batches, error=None, meta=None):
+        super(StreamingQueryRunner, self).__init__({})
+        self.batches = batches
+        self.error = error
+        self.meta = meta
+
+    def run_query(self, query, user):
+        return self._run_query_from_iter(query, user)
+
+    def run_query_iter(self, query, user):
+        yield {'columns': [{'name': 'a'}]}
+        for rows in self.batches:
+            yield rows
+        if self.meta:
+            yield self.meta
+        if self.error:
+            raise QueryRunnerError(self.error)
+
+
+class TestRunQueryIter(TestCase):
+    def test_adapts_run_query(self):
+        data = {'columns': [{'name': 'a'}], 'rows': [{'a': 1}, {'a': 2}]}
+        results = list(LegacyQueryRunner((json.dumps(data), None)).run_query_iter("SELECT 1", None))
+
+        self.assertEqual([{'columns': [{'name': 'a'}]}, [{'a': 1}, {'a': 2}]], results)
+
+    def test_raises_run_query_error(self):
+        results = LegacyQueryRunner((None, "failed")).run_query_iter("SELECT 1", None)
+
+        with self.assertRaises(QueryRunnerError) as e:
+            list(results)
+        self.assertEqual("failed", e.exception.message)
+
+
+class TestRunQueryFromIter(TestCase):
+    def test_collects_batches(self):
+        runner = StreamingQueryRunner([[{'a': 1}], [{'a': 2}, {'a': 3}]])
+        json_data, error = runner.run_query("SELECT 1", None)
+
+        self.assertIsNone(error)
+        self.assertEqual([{'a': 1}, {'a': 2}, {'a': 3}], json.loads(json_data)['rows'])
+
+    def test_returns_error(self):
+        runner = StreamingQueryRunner([[{'a': 1}]], error="failed")
+
+        self.assertEqual((None, "failed"), runner.run_query("SELECT 1", None))
+
+    def test_updates_keys_from_trailing_dict(self):
+        runner = StreamingQueryRunner([[{'a': 1}]], meta={'truncated': True})
+        json_data, error = runner.run_query("SELECT 1", None)
+
+        self.assertTrue(json.loads(json_data)['truncated'])
+
+
+class TestLimitResult(TestCase):
+    def batches(self):
+        for i in range(0, 10, 3):
+            yield [{'a': 'x' * 10} for _ in range(i, min(i + 3, 10))]
+
+    def test_no_limits(self):
+        self.assertEqual([3, 3, 3, 1], [len(rows) for rows in limit_result(self.batches())])
+
+    def test_row_limit(self):
+        parts = list(limit_result(self.batches(), max_rows=5))
+
+        self.assertEqual([3, 2], [len(rows) for rows in parts[:-1]])
+        self.assertEqual({'truncated': True}, parts[-1])
+
+    def test_row_limit_at_batch_boundary(self):
+        parts = list(limit_result(self.batches(), max_rows=6))
+
+        self.assertEqual([3, 3], [len(rows) for rows in parts[:-1]])
+        self.assertEqual({'truncated': True}, parts[-1])
+
+    def test_byte_limit(self):
+        parts = list(limit_result(self.batches(), max_bytes=45))
+
+        self.assertEqual([3, 1], [len(rows) for rows in parts[:-1]])
+        self.assertEqual({'truncated': True}, parts[-1])
+
+    def test_passes_through_result_keys(self):
+        parts = list(limit_result(iter([[{'a': 1}], {'log': []}]), max_rows=5))
+
+        self.assertEqual([[{'a': 1}], {'log': []}], parts)
+
+    def test_stops_consuming_batches(self):
+        batches = self.batches()
+        list(limit_result(batches, max_rows=2))
+
+        self.assertEqual(3, len(next(batches)))
+
+
+class TestResultLimitsOptions(TestCase):
+    def test_added_to_configuration_schema(self):
+        schema = get_configuration_schema_for_query_runner_type('pg')
+
+        self.assertIn('max_result_rows', schema['properties'])
+        self.assertIn('max_result_bytes', schema['properties'])
+        self.assertIn('max_concurrent_queries', schema['properties'])
+
+    def test_data_source_limit_overrides_global_limit(self):
+        runner = StreamingQueryRunner([])
+        runner.configuration = {'max_result_rows': 10}
+
+        self.assertEqual(10, runner.max_result_rows)
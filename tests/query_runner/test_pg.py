@@ -0,0 +1,81 @@
+from unittest import TestCase
+
+import psycopg2
+from sqlalchemy.engine.url import make_url
+
+from redash import settings
+from redash.query_runner import QueryRunnerError
+from redash.query_runner.pg import PostgreSQL
+
+
+def pg_configuration(**kwargs):
+    url = make_url(settings.SQLALCHEMY_DATABASE_URI)
+    configuration = {'user': url.username, 'password': url.password, 'host': url.host, 'port': url.port,
+                     'dbname': url.database}
+    configuration.update(kwargs)
+    return configuration
+
+
+class TestPostgreSQLRunQueryIter(TestCase):
+    query = "SELECT i, 'row ' || i AS name FROM generate_series(1, 5) AS i"
+
+    def run_query_iter(self, query, **configuration):
+        runner = PostgreSQL(pg_configuration(**configuration))
+        return list(runner.run_query_iter(query, None))
+
+    def test_client_side_cursor_fetches_in_batches(self):
+        results = self.run_query_iter(self.query, fetch_size=2)
+
+        self.assertEqual(['i', 'name'], [c['name'] for c in results[0]['columns']])
+        self.assertEqual([2, 2, 1], [len(rows) for rows in results[1:]])
+        self.assertEqual({'i': 5, 'name': 'row 5'}, results[-1][-1])
+
+    def test_server_side_cursor_fetches_in_batches(self):
+        results = self.run_query_iter(self.query + ';', server_side_cursor=True, fetch_size=2)
+
+        self.assertEqual(['i', 'name'], [c['name'] for c in results[0]['columns']])
+        self.assertEqual([2, 2, 1], [len(rows) for rows in results[1:]])
+        self.assertEqual([{'i': i, 'name': 'row {}'.format(i)} for i in range(1, 6)],
+                         [row for rows in results[1:] for row in rows])
+
+    def test_server_side_cursor_with_empty_result(self):
+        results = self.run_query_iter("SELECT 1 AS a WHERE false", server_side_cursor=True)
+
+        self.assertEqual([{'columns': [{'name': 'a', 'friendly_name': 'a', 'type': 'integer'}]}], results)
+
+    def test_server_side_cursor_runs_other_statements_as_is(self):
+        results = self.run_query_iter("SHOW client_encoding", server_side_cursor=True)
+
+        self.assertEqual([{'client_encoding': 'UTF8'}], results[1])
+
+    def test_server_side_cursor_with_trailing_comment(self):
+        results = self.run_query_iter("SELECT 1 AS a; -- the answer", server_side_cursor=True)
+
+        self.assertEqual([{'a': 1}], results[1])
+
+    def test_server_side_cursor_runs_multiple_statements_as_is(self):
+        results = self.run_query_iter("SELECT 1 AS a; SELECT 2 AS b", server_side_cursor=True)
+
+        self.assertEqual([{'b': 2}], results[1])
+
+    def test_server_side_cursor_runs_data_modifying_statements_as_is(self):
+        connection = psycopg2.connect(**pg_configuration())
+        connection.autocommit = True
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE test_server_side_cursor (i integer)")
+        try:
+            results = self.run_query_iter("WITH inserted AS (INSERT INTO test_server_side_cursor VALUES (1), (2) "
+                                          "RETURNING i) SELECT i FROM inserted", server_side_cursor=True)
+            self.assertEqual([{'i': 1}, {'i': 2}], results[1])
+
+            cursor.execute("SELECT count(*) FROM test_server_side_cursor")
+            self.assertEqual(2, cursor.fetchone()[0])
+        finally:
+            cursor.execute("DROP TABLE test_server_side_cursor")
+            connection.close()
+
+    def test_server_side_cursor_reports_query_errors(self):
+        with self.assertRaises(QueryRunnerError) as e:
+            self.run_query_iter("SELECT FROM WHERE", server_side_cursor=True)
+
+        self.assertIn('syntax error', e.exception.message)
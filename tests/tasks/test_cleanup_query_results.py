@@ -0,0 +1,65 @@
+import datetime
+
+import mock
+from tests import BaseTestCase
+
+from redash import models, redis_connection, settings
+from redash.tasks import cleanup_query_results
+from redash.tasks.queries import QueryResultsCleanup
+from redash.utils import utcnow
+
+
+class TestCleanupQueryResults(BaseTestCase):
+    def setUp(self):
+        super(TestCleanupQueryResults, self).setUp()
+        two_weeks_ago = utcnow() - datetime.timedelta(days=14)
+        self.unused = [self.factory.create_query_result(retrieved_at=two_weeks_ago) for _ in range(5)]
+        self.used = self.factory.create_query_result(retrieved_at=two_weeks_ago)
+        self.factory.create_query(latest_query_data=self.used)
+        self.recent = self.factory.create_query_result()
+        models.db.session.commit()
+
+    def remaining_ids(self):
+        return set(result_id for result_id, in models.db.session.query(models.QueryResult.id))
+
+    def test_deletes_unused_results_in_batches(self):
+        with mock.patch.object(settings, 'QUERY_RESULTS_CLEANUP_COUNT', 2):
+            cleanup_query_results()
+
+        self.assertEqual(set([self.used.id, self.recent.id]), self.remaining_ids())
+        state = redis_connection.hgetall(QueryResultsCleanup.KEY_NAME)
+        self.assertEqual('5', state['last_deleted_count'])
+        self.assertEqual('1', state['caught_up'])
+        self.assertIsNone(QueryResultsCleanup().after)
+
+    def test_continues_from_where_the_time_budget_ran_out(self):
+        delete_unused = models.QueryResult.delete_unused
+
+        def delete_unused_once(*args, **kwargs):
+            # The time budget runs out after the first batch:
+            settings.QUERY_RESULTS_CLEANUP_TIME_BUDGET = -1
+            return delete_unused(*args, **kwargs)
+
+        with mock.patch.object(settings, 'QUERY_RESULTS_CLEANUP_COUNT', 2), \
+                mock.patch.object(settings, 'QUERY_RESULTS_CLEANUP_TIME_BUDGET', 60), \
+                mock.patch.object(models.QueryResult, 'delete_unused', side_effect=delete_unused_once):
+            cleanup_query_results()
+
+        remaining = set(r.id for r in self.unused[2:] + [self.used, self.recent])
+        self.assertEqual(remaining, self.remaining_ids())
+        cleanup = QueryResultsCleanup()
+        self.assertEqual((self.unused[1].retrieved_at, self.unused[1].id), cleanup.after)
+
+        cleanup_query_results()
+        self.assertEqual(set([self.used.id, self.recent.id]), self.remaining_ids())
+
+    def test_adapts_batch_size_to_latency(self):
+        cleanup = QueryResultsCleanup()
+        initial = cleanup.batch_size
+
+        cleanup.adapt_batch_size(0)
+        self.assertEqual(initial * 2, cleanup.batch_size)
+
+        cleanup.adapt_batch_size(settings.QUERY_RESULTS_CLEANUP_BATCH_LATENCY + 1)
+        cleanup.adapt_batch_size(settings.QUERY_RESULTS_CLEANUP_BATCH_LATENCY + 1)
+        self.assertEqual(initial, cleanup.batch_size)
@@ -0,0 +1,122 @@
+import json
+
+import mock
+from sqlalchemy.exc import OperationalError
+from tests import BaseTestCase
+
+from redash import models, redis_connection, settings
+from redash.tasks import buffer_event, drain_events
+from redash.tasks.general import (EVENTS_BUFFER_KEY, EVENTS_DEAD_LETTER_KEY, EVENTS_PROCESSING_KEY, forward_events,
+                                  take_buffered_events)
+
+
+class TestDrainEvents(BaseTestCase):
+    def event(self, object_id, **kwargs):
+        event = {'org_id': self.factory.org.id, 'user_id': self.factory.user.id, 'action': 'view',
+                 'object_type': 'dashboard', 'object_id': object_id, 'timestamp': 1411778709, 'ip': '127.0.0.1'}
+        event.update(kwargs)
+        return event
+
+    def buffer(self, *events):
+        for event in events:
+            buffer_event(event)
+        models.db.session.commit()
+
+    def buffer_events(self, count):
+        self.buffer(*[self.event(i) for i in range(count)])
+
+    def recorded_object_ids(self):
+        return [event.object_id for event in models.Event.query.order_by(models.Event.id)]
+
+    def test_records_buffered_events_in_batches(self):
+        self.buffer_events(5)
+
+        with mock.patch.object(settings, 'EVENTS_DRAIN_BATCH_SIZE', 2), \
+                mock.patch.object(models.Event, 'record_many', wraps=models.Event.record_many) as record_many:
+            drain_events()
+
+        self.assertEqual([2, 2, 1], [len(args[0]) for args, _ in record_many.call_args_list])
+        events = models.Event.query.order_by(models.Event.id).all()
+        self.assertEqual(['0', '1', '2', '3', '4'], [event.object_id for event in events])
+        self.assertEqual({'ip': '127.0.0.1'}, events[0].additional_properties)
+        self.assertEqual(0, redis_connection.llen(EVENTS_BUFFER_KEY))
+
+    def test_keeps_events_when_the_database_is_down(self):
+        self.buffer_events(3)
+
+        error = OperationalError("INSERT", {}, Exception("database is down"))
+        with mock.patch.object(models.Event, 'record_many', side_effect=error):
+            self.assertRaises(OperationalError, drain_events)
+
+        self.assertEqual(3, redis_connection.llen(EVENTS_PROCESSING_KEY))
+        drain_events()
+        self.assertEqual(['0', '1', '2'], self.recorded_object_ids())
+        self.assertEqual(0, redis_connection.llen(EVENTS_PROCESSING_KEY))
+
+    def test_records_the_batch_of_an_unfinished_drain_first(self):
+        self.buffer_events(3)
+        take_buffered_events(2)
+
+        with mock.patch.object(settings, 'EVENTS_DRAIN_BATCH_SIZE', 2):
+            drain_events()
+            drain_events()
+
+        self.assertEqual(['0', '1', '2'], self.recorded_object_ids())
+
+    def test_puts_unparseable_events_aside(self):
+        self.buffer(self.event(0))
+        redis_connection.rpush(EVENTS_BUFFER_KEY, '{"org_id": ')
+        self.buffer(self.event(2))
+
+        drain_events()
+
+        self.assertEqual(['0', '2'], self.recorded_object_ids())
+        self.assertEqual(['{"org_id": '], redis_connection.lrange(EVENTS_DEAD_LETTER_KEY, 0, -1))
+        self.assertEqual(0, redis_connection.llen(EVENTS_PROCESSING_KEY))
+
+    def test_puts_events_that_fail_to_insert_aside(self):
+        # The second isn't in any of the events table's partitions:
+        self.buffer(self.event(0), self.event(1, timestamp=7258118400), self.event(2, action=None), self.event(3))
+        later_event = self.event(4)
+
+        drain_events()
+
+        self.assertEqual(['0', '3'], self.recorded_object_ids())
+        self.assertEqual([1, 2], [json.loads(raw_event)['object_id']
+                                  for raw_event in redis_connection.lrange(EVENTS_DEAD_LETTER_KEY, 0, -1)])
+
+        # And they don't hold back the next ones:
+        self.buffer(later_event)
+        drain_events()
+        self.assertEqual(['0', '3', '4'], self.recorded_object_ids())
+
+    def test_forwards_each_batch_with_a_single_task(self):
+        self.buffer_events(3)
+
+        with mock.patch.object(settings, 'EVENT_REPORTING_WEBHOOKS', ['http://example.com/hook']), \
+                mock.patch.object(forward_events, 'delay') as delay:
+            drain_events()
+
+        self.assertEqual(1, delay.call_count)
+        self.assertEqual([0, 1, 2], [event['object_id'] for event in delay.call_args[0][0]])
+
+
+class TestForwardEvents(BaseTestCase):
+    def post(self, events, batch_size):
+        with mock.patch.object(settings, 'EVENT_REPORTING_WEBHOOKS', ['http://example.com/hook']), \
+                mock.patch.object(settings, 'EVENT_REPORTING_WEBHOOKS_BATCH_SIZE', batch_size), \
+                mock.patch('redash.tasks.general.webhooks_session') as session:
+            session.post.return_value.status_code = 200
+            forward_events(events)
+        return [kwargs['json'] for _, kwargs in session.post.call_args_list]
+
+    def test_posts_each_event_by_default(self):
+        posted = self.post([{'action': 'view'}, {'action': 'edit'}], 1)
+
+        self.assertEqual([{'action': 'view'}, {'action': 'edit'}], [data['data'] for data in posted])
+
+    def test_posts_batches_of_events(self):
+        posted = self.post([{'action': 'view'}, {'action': 'edit'}, {'action': 'view'}], 2)
+
+        self.assertEqual([2, 1], [len(batch) for batch in posted])
+        self.assertEqual({'action': 'edit'}, posted[0][1]['data'])
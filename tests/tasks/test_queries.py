@@ -1,13 +1,21 @@
 from unittest import TestCase
 from collections import namedtuple
+import threading
+import time
 import uuid
 
 import mock
+from celery.exceptions import Retry
 
 from tests import BaseTestCase
-from redash import redis_connection, models
+from redash import redis_connection, models, settings
+from redash.query_runner import QueryRunnerError
 from redash.query_runner.pg import PostgreSQL
-from redash.tasks.queries import QueryTaskTracker, enqueue_query, execute_query
+from redash.tasks.queries import (DataSourceSemaphore, QueryDispatcher, QueryExecutionError, QueryTask,
+                                  QueryTaskTracker, QueryWaitTimeout, _job_lock_id, enqueue_queries, enqueue_query,
+                                  execute_query, run_query_once)
+from redash.utils.configuration import ConfigurationContainer
+from redash.worker import celery
 
 
 class TestPrune(TestCase):
@@ -73,6 +81,281 @@ class TestEnqueueTask(BaseTestCase):
         self.assertEqual(0, redis_connection.zcard(QueryTaskTracker.DONE_LIST))
 
 
+class TestEnqueueQueries(BaseTestCase):
+    def setUp(self):
+        super(TestEnqueueQueries, self).setUp()
+        self.apply_async = mock.patch.object(execute_query, 'apply_async',
+                                             side_effect=lambda *args, **kwargs: FakeResult(kwargs['task_id']))
+        self.apply_async.start()
+
+    def tearDown(self):
+        self.apply_async.stop()
+        super(TestEnqueueQueries, self).tearDown()
+
+    def scheduled(self, query, query_text=None):
+        return (query_text or query.query_text, query.data_source, query.user_id, query,
+                {'Username': 'Scheduled', 'Query ID': query.id})
+
+    def test_enqueues_each_query(self):
+        query = self.factory.create_query()
+        jobs = enqueue_queries([self.scheduled(query), self.scheduled(query, query.query_text + '2')])
+
+        self.assertEqual(2, execute_query.apply_async.call_count)
+        self.assertEqual(2, len(set(job.id for job in jobs)))
+        self.assertEqual(2, redis_connection.zcard(QueryTaskTracker.WAITING_LIST))
+        self.assertEqual(jobs[0].id, redis_connection.get(_job_lock_id(query.query_hash, query.data_source.id)))
+
+    def test_enqueues_same_query_once(self):
+        query = self.factory.create_query()
+        jobs = enqueue_queries([self.scheduled(query), self.scheduled(query)])
+        more_jobs = enqueue_queries([self.scheduled(query)])
+
+        self.assertEqual(1, execute_query.apply_async.call_count)
+        self.assertEqual(jobs[0].id, jobs[1].id)
+        self.assertEqual(jobs[0].id, more_jobs[0].id)
+
+    def test_replaces_finished_job(self):
+        query = self.factory.create_query()
+        job = enqueue_queries([self.scheduled(query)])[0]
+        celery.backend.store_result(job.id, 1, 'SUCCESS')
+
+        new_job = enqueue_queries([self.scheduled(query)])[0]
+
+        self.assertNotEqual(job.id, new_job.id)
+        self.assertEqual(new_job.id, redis_connection.get(_job_lock_id(query.query_hash, query.data_source.id)))
+
+    def test_releases_locks_when_publishing_fails(self):
+        query = self.factory.create_query()
+        execute_query.apply_async.side_effect = Exception("Broker is down")
+
+        jobs = enqueue_queries([self.scheduled(query)])
+
+        self.assertEqual([None], jobs)
+        self.assertIsNone(redis_connection.get(_job_lock_id(query.query_hash, query.data_source.id)))
+
+
+class TestDataSourceSemaphore(BaseTestCase):
+    def setUp(self):
+        super(TestDataSourceSemaphore, self).setUp()
+        self.semaphore = DataSourceSemaphore(1, 2)
+
+    def test_limits_slots(self):
+        self.assertTrue(self.semaphore.acquire('job1', 1))
+        self.assertTrue(self.semaphore.acquire('job2', 2))
+        self.assertFalse(self.semaphore.acquire('job3', 3))
+
+        self.semaphore.release('job1')
+        self.assertTrue(self.semaphore.acquire('job3', 3))
+
+    def test_slots_go_to_jobs_in_the_order_they_were_enqueued(self):
+        self.semaphore.acquire('job1', 1)
+        self.semaphore.acquire('job2', 2)
+        self.assertFalse(self.semaphore.acquire('job4', 4))
+        self.assertFalse(self.semaphore.acquire('job3', 3))
+        self.assertEqual(1, self.semaphore.waiting_position('job4'))
+
+        self.semaphore.release('job1')
+        self.assertFalse(self.semaphore.acquire('job4', 4))
+        self.assertTrue(self.semaphore.acquire('job3', 3))
+        self.assertEqual(0, self.semaphore.waiting_position('job4'))
+        self.assertIsNone(self.semaphore.waiting_position('job3'))
+
+    def test_stale_waiters_lose_their_turn(self):
+        self.semaphore.acquire('job1', 1)
+        self.semaphore.acquire('job2', 2)
+        self.semaphore.acquire('job3', 3)
+        self.semaphore.release('job1')
+
+        with mock.patch('time.time', return_value=time.time() + DataSourceSemaphore.stale_timeout + 1):
+            self.assertTrue(self.semaphore.acquire('job4', 4))
+
+    def test_unreleased_slots_expire(self):
+        self.semaphore.acquire('job1', 1)
+        self.semaphore.acquire('job2', 2)
+
+        with mock.patch('time.time', return_value=time.time() + settings.DATA_SOURCE_SLOT_TIMEOUT + 1):
+            self.assertTrue(self.semaphore.acquire('job3', 3))
+
+    def test_data_sources_have_separate_slots(self):
+        self.semaphore.acquire('job1', 1)
+        self.semaphore.acquire('job2', 2)
+
+        self.assertTrue(DataSourceSemaphore(2, 2).acquire('job3', 3))
+
+
+class TestQueryDispatcher(BaseTestCase):
+    def setUp(self):
+        super(TestQueryDispatcher, self).setUp()
+        self.dispatcher = QueryDispatcher('queries', 2)
+        self.apply_async = mock.patch.object(execute_query, 'apply_async',
+                                             side_effect=lambda *args, **kwargs: FakeResult(kwargs['task_id']))
+        self.apply_async.start()
+
+    def tearDown(self):
+        self.apply_async.stop()
+        super(TestQueryDispatcher, self).tearDown()
+
+    def add(self, job_id, shares, priority='interactive'):
+        self.dispatcher.add(job_id, 'queries', ['select 1', 1, {}, None, None], 60,
+                            [(share, settings.QUERY_DISPATCH_SHARE_QUANTUM) for share in shares], priority)
+
+    def order(self):
+        return redis_connection.zrange(self.dispatcher._key('pending'), 0, -1)
+
+    def sent(self):
+        return [c[1]['task_id'] for c in execute_query.apply_async.call_args_list]
+
+    def test_sends_jobs_up_to_capacity(self):
+        for job_id in ('job1', 'job2', 'job3'):
+            self.add(job_id, ['org:1', 'user:1'])
+
+        self.assertEqual(2, self.dispatcher.dispatch())
+        self.assertEqual(['job1', 'job2'], self.sent())
+        self.assertEqual(0, self.dispatcher.dispatch())
+
+        self.dispatcher.release('job1')
+        self.assertEqual(1, self.dispatcher.dispatch())
+        self.assertEqual(['job1', 'job2', 'job3'], self.sent())
+
+    def test_interleaves_organizations_jobs(self):
+        for job_id in ('a1', 'a2', 'a3'):
+            self.add(job_id, ['org:1', 'user:1'])
+        self.add('b1', ['org:2', 'user:2'])
+        self.add('c1', ['org:1', 'user:3'])
+
+        self.assertEqual(0, self.dispatcher.waiting_position('a1'))
+        self.assertEqual(1, self.dispatcher.waiting_position('b1'))
+        # Ahead of the other jobs of its organization's user:
+        self.assertEqual(2, self.dispatcher.waiting_position('c1'))
+        self.assertEqual(4, self.dispatcher.waiting_position('a3'))
+
+    def test_interleaves_users_jobs_within_an_organization(self):
+        for job_id in ('a1', 'a2', 'a3'):
+            self.add(job_id, ['org:1', 'user:1'])
+        for job_id in ('b1', 'b2', 'b3'):
+            self.add(job_id, ['org:1', 'user:2'])
+        self.add('c1', ['org:2', 'user:3'])
+
+        self.assertEqual(['a1', 'c1', 'b1', 'a2', 'b2', 'a3', 'b3'], self.order())
+
+    def test_forgets_released_and_dispatched_jobs_of_organizations(self):
+        for job_id in ('a1', 'a2'):
+            self.add(job_id, ['org:1', 'user:1'])
+        self.dispatcher.release('a2')
+        self.dispatcher.dispatch()
+        self.add('b1', ['org:1', 'user:2'])
+
+        self.assertEqual(['b1'], self.order())
+        self.assertEqual(['b1'], redis_connection.zrange(self.dispatcher._key('org_jobs:interactive:org:1'), 0, -1))
+
+    def test_sends_higher_priority_jobs_first(self):
+        self.add('scheduled', ['org:1', 'scheduled:1'], 'scheduled')
+        self.add('dashboard', ['org:2', 'user:2'], 'dashboard')
+        self.add('interactive', ['org:3', 'user:3'])
+
+        self.dispatcher.dispatch()
+        self.assertEqual(['interactive', 'dashboard'], self.sent())
+
+    def test_scheduled_jobs_dont_hold_back_interactive_jobs_of_their_organization(self):
+        for i in range(20):
+            self.add('scheduled{}'.format(i), ['org:1', 'scheduled:1'], 'scheduled')
+        self.add('interactive', ['org:1', 'user:1'])
+
+        self.assertEqual(0, self.dispatcher.waiting_position('interactive'))
+        self.assertEqual(1, self.dispatcher.waiting_position('scheduled0'))
+
+    def test_lower_priority_jobs_age(self):
+        self.add('scheduled', ['org:1', 'scheduled:1'], 'scheduled')
+
+        later = time.time() + 2 * settings.QUERY_PRIORITY_AGING + 1
+        with mock.patch('time.time', return_value=later):
+            self.add('interactive', ['org:2', 'user:2'])
+
+        self.assertEqual(0, self.dispatcher.waiting_position('scheduled'))
+
+    def test_queues_can_share_a_dispatcher(self):
+        with mock.patch.object(settings, 'QUERY_DISPATCH_CAPACITY', {'queries+scheduled_queries': 2}):
+            self.assertEqual('queries+scheduled_queries', QueryDispatcher.for_queue('scheduled_queries').name)
+            self.assertIsNone(QueryDispatcher.for_queue('celery'))
+
+    def test_forgets_dispatched_jobs_after_timeout(self):
+        for job_id in ('job1', 'job2', 'job3'):
+            self.add(job_id, ['org:1', 'user:1'])
+        self.dispatcher.dispatch()
+
+        with mock.patch('time.time', return_value=time.time() + settings.QUERY_DISPATCH_TIMEOUT + 1):
+            self.assertEqual(1, self.dispatcher.dispatch())
+
+    def test_puts_jobs_back_when_sending_fails(self):
+        self.add('job1', ['org:1', 'user:1'])
+        execute_query.apply_async.side_effect = Exception("Broker is down")
+
+        self.assertEqual(0, self.dispatcher.dispatch())
+        self.assertEqual(0, self.dispatcher.waiting_position('job1'))
+
+    def test_enqueue_query_holds_jobs_of_dispatched_queues(self):
+        query = self.factory.create_query()
+        with mock.patch.object(settings, 'QUERY_DISPATCH_CAPACITY', {'queries': 1}):
+            job = enqueue_query(query.query_text, query.data_source, query.user_id)
+            other_job = enqueue_query(query.query_text + '2', query.data_source, query.user_id)
+
+            self.assertEqual([job.id], self.sent())
+            self.assertEqual(0, QueryTask(job_id=other_job.id).to_dict()['waiting_position'])
+            self.assertEqual('interactive', QueryTask(job_id=other_job.id).to_dict()['priority'])
+
+
+class TestRunQueryOnce(BaseTestCase):
+    def lock(self, query_result, job_id):
+        redis_connection.set(_job_lock_id(query_result.query_hash, query_result.data_source.id), job_id)
+
+    def test_executes_query_in_a_job(self):
+        query_result = self.factory.create_query_result()
+
+        def apply_async(*args, **kwargs):
+            # As a worker would:
+            celery.backend.store_result(kwargs['task_id'], query_result.id, 'SUCCESS')
+            return FakeResult(kwargs['task_id'])
+
+        with mock.patch.object(execute_query, 'apply_async', side_effect=apply_async):
+            self.assertEqual(query_result, run_query_once(query_result.query_text, query_result.data_source, None))
+
+    def test_waits_for_executing_job(self):
+        query_result = self.factory.create_query_result()
+        job_id = str(uuid.uuid4())
+        self.lock(query_result, job_id)
+        finish = threading.Timer(0.3, celery.backend.store_result, (job_id, query_result.id, 'SUCCESS'))
+        finish.start()
+
+        with mock.patch.object(execute_query, 'apply_async') as apply_async:
+            self.assertEqual(query_result, run_query_once(query_result.query_text, query_result.data_source, None))
+            self.assertFalse(apply_async.called)
+
+    def test_waits_for_executing_job_failure(self):
+        query_result = self.factory.create_query_result()
+        job_id = str(uuid.uuid4())
+        self.lock(query_result, job_id)
+        finish = threading.Timer(0.3, celery.backend.store_result,
+                                 (job_id, QueryExecutionError("Bad query"), 'FAILURE'))
+        finish.start()
+
+        self.assertRaises(QueryExecutionError, run_query_once, query_result.query_text, query_result.data_source, None)
+
+    def test_times_out_with_the_job(self):
+        query_result = self.factory.create_query_result()
+        job_id = str(uuid.uuid4())
+        self.lock(query_result, job_id)
+
+        with self.assertRaises(QueryWaitTimeout) as cm:
+            run_query_once(query_result.query_text, query_result.data_source, None, timeout=0.3)
+
+        self.assertEqual(job_id, cm.exception.job_id)
+
+
+def iter_result(*parts):
+    for part in parts:
+        yield part
+
+
 class QueryExecutorTests(BaseTestCase):
 
     def test_success(self):
@@ -80,12 +363,88 @@ class QueryExecutorTests(BaseTestCase):
         ``execute_query`` invokes the query runner and stores a query result.
         """
         cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
-        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
-            qr.return_value = ([1, 2], None)
+        data = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': 1, 'b': 2}]}
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': data['columns']}, data['rows'])
             result_id = execute_query("SELECT 1, 2", self.factory.data_source.id, {})
             self.assertEqual(1, qr.call_count)
             result = models.QueryResult.query.get(result_id)
-            self.assertEqual(result.data, '{1,2}')
+            self.assertEqual(result.data, data)
+
+    def test_stores_rows_of_all_batches(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        batches = [[{'a': i} for i in range(j, j + 3)] for j in (0, 3, 6)]
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': [{'name': 'a'}]}, *batches)
+            result_id = execute_query("SELECT 1", self.factory.data_source.id, {})
+            result = models.QueryResult.query.get(result_id)
+            self.assertEqual([{'a': i} for i in range(9)], result.data['rows'])
+
+    def test_stores_trailing_result_keys(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': [{'name': 'a'}]}, [{'a': 1}], {'truncated': True})
+            result_id = execute_query("SELECT 1", self.factory.data_source.id, {})
+            result = models.QueryResult.query.get(result_id)
+            self.assertTrue(result.data['truncated'])
+            self.assertEqual([{'a': 1}], result.data['rows'])
+
+    def test_truncates_result_at_data_source_row_limit(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        data_source = self.factory.create_data_source(
+            options=ConfigurationContainer.from_json('{"dbname": "test", "max_result_rows": 4}'))
+        batches = [[{'a': i} for i in range(j, j + 3)] for j in (0, 3, 6)]
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': [{'name': 'a'}]}, *batches)
+            result_id = execute_query("SELECT 1", data_source.id, {})
+            result = models.QueryResult.query.get(result_id)
+            self.assertEqual([{'a': i} for i in range(4)], result.data['rows'])
+            self.assertTrue(result.data['truncated'])
+            self.assertEqual(4, result.data['row_count'])
+
+    def test_truncates_result_at_global_byte_limit(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        batches = [[{'a': 'x' * 10} for _ in range(3)] for _ in range(3)]
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr, \
+                mock.patch.object(settings, 'QUERY_RESULTS_MAX_BYTES', 50):
+            qr.return_value = iter_result({'columns': [{'name': 'a'}]}, *batches)
+            result_id = execute_query("SELECT 1", self.factory.data_source.id, {})
+            result = models.QueryResult.query.get(result_id)
+            self.assertEqual(5, len(result.data['rows']))
+            self.assertTrue(result.data['truncated'])
+
+    def test_waits_for_a_data_source_slot(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+        data_source = self.factory.create_data_source(
+            options=ConfigurationContainer.from_json('{"dbname": "test", "max_concurrent_queries": 1}'))
+        DataSourceSemaphore(data_source.id, 1).acquire('other-job', time.time())
+
+        with cm, mock.patch("celery.app.task.Context.id", "job"), \
+                mock.patch.object(execute_query, "retry", side_effect=Retry) as retry, \
+                mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            self.assertRaises(Retry, execute_query, "SELECT 1", data_source.id, {})
+            retry.assert_called_once_with(countdown=settings.DATA_SOURCE_SLOT_RETRY_INTERVAL, max_retries=None)
+            qr.assert_not_called()
+
+            DataSourceSemaphore(data_source.id).release('other-job')
+            qr.return_value = iter_result({'columns': [{'name': 'a'}]}, [{'a': 1}])
+            result_id = execute_query("SELECT 1", data_source.id, {})
+
+        self.assertEqual([{'a': 1}], models.QueryResult.query.get(result_id).data['rows'])
+        self.assertTrue(DataSourceSemaphore(data_source.id, 1).acquire('other-job', time.time()))
+
+    def test_query_runner_error(self):
+        cm = mock.patch("celery.app.task.Context.delivery_info", {'routing_key': 'test'})
+
+        def failing_results(query, user):
+            yield {'columns': [{'name': 'a'}]}
+            yield [{'a': 1}]
+            raise QueryRunnerError("connection lost")
+
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter", side_effect=failing_results):
+            result = execute_query("SELECT 1", self.factory.data_source.id, {})
+            self.assertEqual("connection lost", result.message)
+            self.assertEqual(0, models.QueryResult.query.count())
 
     def test_success_scheduled(self):
         """
@@ -94,8 +453,8 @@ class QueryExecutorTests(BaseTestCase):
         cm = mock.patch("celery.app.task.Context.delivery_info",
                         {'routing_key': 'test'})
         q = self.factory.create_query(query_text="SELECT 1, 2", schedule=300)
-        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
-            qr.return_value = ([1, 2], None)
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': []}, [])
             result_id = execute_query(
                 "SELECT 1, 2",
                 self.factory.data_source.id, {},
@@ -112,8 +471,8 @@ class QueryExecutorTests(BaseTestCase):
         cm = mock.patch("celery.app.task.Context.delivery_info",
                         {'routing_key': 'test'})
         q = self.factory.create_query(query_text="SELECT 1, 2", schedule=300)
-        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
-            qr.exception = ValueError("broken")
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.side_effect = ValueError("broken")
             execute_query("SELECT 1, 2", self.factory.data_source.id, {}, scheduled_query_id=q.id)
             self.assertEqual(q.schedule_failures, 1)
             execute_query("SELECT 1, 2", self.factory.data_source.id, {}, scheduled_query_id=q.id)
@@ -127,16 +486,16 @@ class QueryExecutorTests(BaseTestCase):
         cm = mock.patch("celery.app.task.Context.delivery_info",
                         {'routing_key': 'test'})
         q = self.factory.create_query(query_text="SELECT 1, 2", schedule=300)
-        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
-            qr.exception = ValueError("broken")
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.side_effect = ValueError("broken")
             execute_query("SELECT 1, 2",
                           self.factory.data_source.id, {},
                           scheduled_query_id=q.id)
             q = models.Query.get_by_id(q.id)
             self.assertEqual(q.schedule_failures, 1)
 
-        with cm, mock.patch.object(PostgreSQL, "run_query") as qr:
-            qr.return_value = ([1, 2], None)
+        with cm, mock.patch.object(PostgreSQL, "run_query_iter") as qr:
+            qr.return_value = iter_result({'columns': []}, [])
             execute_query("SELECT 1, 2",
                           self.factory.data_source.id, {},
                           scheduled_query_id=q.id)
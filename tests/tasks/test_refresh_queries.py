@@ -1,7 +1,10 @@
-from mock import patch, call, ANY
+from datetime import timedelta
+
+from mock import patch, ANY
 from tests import BaseTestCase
 from redash.tasks import refresh_queries
 from redash.models import Query
+from redash.utils import utcnow
 
 
 class TestRefreshQuery(BaseTestCase):
@@ -15,15 +18,12 @@ class TestRefreshQuery(BaseTestCase):
             query_text="select 42;",
             data_source=self.factory.create_data_source())
         oq = staticmethod(lambda: [query1, query2])
-        with patch('redash.tasks.queries.enqueue_query') as add_job_mock, \
+        with patch('redash.tasks.queries.enqueue_queries') as add_jobs_mock, \
                 patch.object(Query, 'outdated_queries', oq):
             refresh_queries()
-            self.assertEqual(add_job_mock.call_count, 2)
-            add_job_mock.assert_has_calls([
-                call(query1.query_text, query1.data_source, query1.user_id,
-                     scheduled_query=query1, metadata=ANY),
-                call(query2.query_text, query2.data_source, query2.user_id,
-                     scheduled_query=query2, metadata=ANY)], any_order=True)
+            add_jobs_mock.assert_called_once_with([
+                (query1.query_text, query1.data_source, query1.user_id, query1, ANY),
+                (query2.query_text, query2.data_source, query2.user_id, query2, ANY)])
 
     def test_doesnt_enqueue_outdated_queries_for_paused_data_source(self):
         """
@@ -34,14 +34,33 @@ class TestRefreshQuery(BaseTestCase):
         oq = staticmethod(lambda: [query])
         query.data_source.pause()
         with patch.object(Query, 'outdated_queries', oq):
-            with patch('redash.tasks.queries.enqueue_query') as add_job_mock:
+            with patch('redash.tasks.queries.enqueue_queries') as add_jobs_mock:
                 refresh_queries()
-                add_job_mock.assert_not_called()
+                add_jobs_mock.assert_called_with([])
 
             query.data_source.resume()
 
-            with patch('redash.tasks.queries.enqueue_query') as add_job_mock:
+            with patch('redash.tasks.queries.enqueue_queries') as add_jobs_mock:
                 refresh_queries()
-                add_job_mock.assert_called_with(
-                    query.query_text, query.data_source, query.user_id,
-                    scheduled_query=query, metadata=ANY)
+                add_jobs_mock.assert_called_with([
+                    (query.query_text, query.data_source, query.user_id, query, ANY)])
+
+    def test_limits_enqueued_queries_per_data_source(self):
+        """
+        refresh_queries() enqueues at most settings.SCHEDULED_QUERIES_PER_DATA_SOURCE
+        queries of each data source, the most overdue first.
+        """
+        now = utcnow()
+        other_data_source = self.factory.create_data_source()
+        query1 = self.factory.create_query(query_text="select 1", next_run_at=now - timedelta(minutes=1))
+        query2 = self.factory.create_query(query_text="select 2", next_run_at=now - timedelta(minutes=5))
+        query3 = self.factory.create_query(query_text="select 3", data_source=other_data_source,
+                                           next_run_at=now - timedelta(minutes=1))
+        oq = staticmethod(lambda: [query1, query2, query3])
+        with patch('redash.tasks.queries.enqueue_queries') as add_jobs_mock, \
+                patch.object(Query, 'outdated_queries', oq), \
+                patch('redash.settings.SCHEDULED_QUERIES_PER_DATA_SOURCE', 1):
+            refresh_queries()
+            add_jobs_mock.assert_called_once_with([
+                (query2.query_text, query2.data_source, query2.user_id, query2, ANY),
+                (query3.query_text, query3.data_source, query3.user_id, query3, ANY)])
@@ -16,7 +16,7 @@ class DataSourceCommandTests(BaseTestCase):
         result = runner.invoke(
             manager,
             ['ds', 'new'],
-            input="test\n%s\n\n\nexample.com\n\n\ntestdb\n" % (pg_i,))
+            input="test\n%s\nexample.com\n\n\n\n\n\n\ntestdb\n" % (pg_i,))
         self.assertFalse(result.exception)
         self.assertEqual(result.exit_code, 0)
         self.assertEqual(DataSource.query.count(), 1)
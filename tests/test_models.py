@@ -1,15 +1,22 @@
 #encoding: utf8
+import cStringIO
 import datetime
 import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
 from unittest import TestCase
 
 import mock
 from dateutil.parser import parse as date_parse
+from sqlalchemy.event import listen, remove
 from tests import BaseTestCase
 
-from redash import models
+from redash import models, redis_connection, settings
 from redash.models import db
-from redash.utils import gen_query_hash, utcnow
+from redash.utils import gen_query_hash, json_dumps, result_storage, utcnow
 
 
 class DashboardTest(BaseTestCase):
@@ -73,6 +80,59 @@ class ShouldScheduleNextTest(TestCase):
                                                      "3600", 10))
 
 
+class ScheduleJitterTest(TestCase):
+    def setUp(self):
+        self.now = utcnow()
+        self.seeds = [gen_query_hash('SELECT {}'.format(i)) for i in range(20)]
+        self.patch = mock.patch('redash.settings.SCHEDULE_JITTER_WINDOW', 600)
+        self.patch.start()
+
+    def tearDown(self):
+        self.patch.stop()
+
+    def test_spreads_interval_schedules_within_the_interval(self):
+        runs = [models.next_scheduled_run(self.now, "3600", 0, seed) for seed in self.seeds]
+
+        self.assertGreater(len(set(runs)), 10)
+        for run in runs:
+            self.assertGreater(run, self.now + datetime.timedelta(minutes=30))
+            self.assertLessEqual(run, self.now + datetime.timedelta(minutes=90))
+
+    def test_keeps_the_interval_on_average(self):
+        # However late each run happens, the query runs once per interval:
+        for seed in self.seeds:
+            first = run = models.next_scheduled_run(self.now, "60", 0, seed)
+            for i in range(100):
+                run = models.next_scheduled_run(run + datetime.timedelta(seconds=i % 29), "60", 0, seed)
+
+            self.assertEqual(datetime.timedelta(seconds=60 * 100), run - first)
+
+    def test_runs_again_after_an_early_run(self):
+        for seed in self.seeds:
+            run = models.next_scheduled_run(self.now, "60", 0, seed)
+            self.assertEqual(run + datetime.timedelta(seconds=60),
+                             models.next_scheduled_run(run - datetime.timedelta(seconds=5), "60", 0, seed))
+
+    def test_delays_time_of_day_schedules(self):
+        yesterday = self.now - datetime.timedelta(days=1)
+        schedule = self.now.strftime('%H:%M')
+        # Runs are at the time of day of the schedule, on the previous run's second:
+        scheduled_at = self.now
+        runs = [models.next_scheduled_run(yesterday, schedule, 0, seed) for seed in self.seeds]
+
+        self.assertGreater(len(set(runs)), 10)
+        for run in runs:
+            self.assertGreaterEqual(run, scheduled_at)
+            self.assertLess(run, scheduled_at + datetime.timedelta(minutes=10))
+
+    def test_is_the_same_for_each_run(self):
+        later = self.now + datetime.timedelta(days=3)
+
+        for seed in self.seeds:
+            self.assertEqual(models.next_scheduled_run(self.now, "3600", 0, seed) - self.now,
+                             models.next_scheduled_run(later, "3600", 0, seed) - later)
+
+
 class QueryOutdatedQueriesTest(BaseTestCase):
     # TODO: this test can be refactored to use mock version of should_schedule_next to simplify it.
     def test_outdated_queries_skips_unscheduled_queries(self):
@@ -190,9 +250,48 @@ class QueryOutdatedQueriesTest(BaseTestCase):
         self.assertEqual(list(models.Query.outdated_queries()), [])
 
         query_result.retrieved_at = utcnow() - datetime.timedelta(minutes=17)
+        query.latest_query_data = query_result
         self.assertEqual(list(models.Query.outdated_queries()), [query])
 
 
+class QueryNextRunAtTest(BaseTestCase):
+    def test_not_set_for_queries_without_results(self):
+        query = self.factory.create_query(schedule="3600")
+
+        self.assertIsNone(query.next_run_at)
+
+    def test_follows_schedule_and_latest_result(self):
+        retrieved_at = utcnow() - datetime.timedelta(minutes=10)
+        query = self.factory.create_query(schedule="3600")
+        query.latest_query_data = self.factory.create_query_result(retrieved_at=retrieved_at)
+        self.assertEqual(retrieved_at + datetime.timedelta(hours=1), query.next_run_at)
+
+        query.schedule = "60"
+        self.assertEqual(retrieved_at + datetime.timedelta(minutes=1), query.next_run_at)
+
+        query.schedule_failures = 2
+        self.assertEqual(retrieved_at + datetime.timedelta(minutes=5), query.next_run_at)
+
+        query.schedule = None
+        self.assertIsNone(query.next_run_at)
+
+    def test_outdated_queries_skips_queries_not_due(self):
+        query = self.factory.create_query(schedule="60")
+        query.latest_query_data = self.factory.create_query_result(
+            retrieved_at=utcnow() - datetime.timedelta(minutes=10))
+        query.next_run_at = utcnow() + datetime.timedelta(minutes=1)
+
+        self.assertEqual([], list(models.Query.outdated_queries()))
+
+    def test_outdated_queries_reschedules_executing_queries(self):
+        query = self.factory.create_query(schedule="3600")
+        query.latest_query_data = self.factory.create_query_result(retrieved_at=utcnow() - datetime.timedelta(hours=2))
+        models.scheduled_queries_executions.update(query.id)
+
+        self.assertEqual([], list(models.Query.outdated_queries()))
+        self.assertGreater(query.next_run_at, utcnow() + datetime.timedelta(minutes=59))
+
+
 class QueryArchiveTest(BaseTestCase):
     def setUp(self):
         super(QueryArchiveTest, self).setUp()
@@ -303,6 +402,76 @@ class QueryResultTest(BaseTestCase):
         self.assertEqual(found_query_result.id, qr.id)
 
 
+class TestQueryResultGetLatestPlan(BaseTestCase):
+    """
+    Benchmarks QueryResult.get_latest by the work its query plan does: it reads the same number of index & table
+    blocks however many results the query has, as it's a single index lookup (O(log n)) rather than a sort.
+    """
+    def add_results(self, query_result, count):
+        db.session.execute("""
+            INSERT INTO query_results (org_id, data_source_id, query_hash, query, data, data_hash, runtime,
+                                       retrieved_at)
+            SELECT org_id, data_source_id, query_hash, query, data, data_hash, runtime,
+                   retrieved_at - i * interval '1 minute'
+            FROM query_results, generate_series(1, :count) AS i
+            WHERE id = :id
+        """, dict(id=query_result.id, count=count))
+        # As many results of other queries, each only run a few times, as there are of this one:
+        db.session.execute("""
+            INSERT INTO query_results (org_id, data_source_id, query_hash, query, data, data_hash, runtime,
+                                       retrieved_at)
+            SELECT org_id, data_source_id, md5(query_hash || i / 5), query, data, data_hash, runtime,
+                   retrieved_at - i * interval '1 second'
+            FROM query_results, generate_series(1, :count) AS i
+            WHERE id = :id
+        """, dict(id=query_result.id, count=count))
+        db.session.execute("ANALYZE query_results")
+
+    def plan(self, query_result, max_age):
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        engine = db.session.get_bind()
+        listen(engine, 'before_cursor_execute', capture)
+        try:
+            models.QueryResult.get_latest(query_result.data_source, query_result.query_text, max_age)
+        finally:
+            remove(engine, 'before_cursor_execute', capture)
+
+        statement, parameters = statements[-1]
+        plan = db.session.connection().execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + statement,
+                                               parameters).scalar()
+        return plan[0]['Plan']
+
+    def node_types(self, plan):
+        types = [plan['Node Type']]
+        for child in plan.get('Plans', []):
+            types.extend(self.node_types(child))
+        return types
+
+    def assert_plan_doesnt_grow(self, max_age):
+        query_result = self.factory.create_query_result()
+        self.add_results(query_result, 1000)
+        small = self.plan(query_result, max_age)
+
+        self.add_results(query_result, 20000)
+        large = self.plan(query_result, max_age)
+
+        self.assertNotIn('Sort', self.node_types(large))
+        self.assertIn('query_results_data_source_id_query_hash_retrieved_at', json.dumps(large))
+        blocks = lambda plan: plan['Shared Hit Blocks'] + plan['Shared Read Blocks']
+        # At most one more level of the index to go through:
+        self.assertLessEqual(blocks(large), blocks(small) + 1)
+
+    def test_lookup_with_max_age(self):
+        self.assert_plan_doesnt_grow(3600)
+
+    def test_lookup_of_latest_result(self):
+        self.assert_plan_doesnt_grow(-1)
+
+
 class TestUnusedQueryResults(BaseTestCase):
     def test_returns_only_unused_query_results(self):
         two_weeks_ago = utcnow() - datetime.timedelta(days=14)
@@ -323,6 +492,41 @@ class TestUnusedQueryResults(BaseTestCase):
         self.assertNotIn((new_unused_qr.id,), models.QueryResult.unused())
 
 
+class TestDeleteUnusedQueryResults(BaseTestCase):
+    def setUp(self):
+        super(TestDeleteUnusedQueryResults, self).setUp()
+        self.now = utcnow()
+        self.results = [self.factory.create_query_result(retrieved_at=self.now - datetime.timedelta(days=10 - i))
+                        for i in range(5)]
+        self.factory.create_query(latest_query_data=self.results[1])
+        db.session.flush()
+
+    def remaining_ids(self):
+        return set(result_id for result_id, in db.session.query(models.QueryResult.id))
+
+    def test_deletes_unused_results_of_a_batch(self):
+        last_key, storage_keys = models.QueryResult.delete_unused(self.now, limit=3)
+
+        self.assertEqual((self.results[2].retrieved_at, self.results[2].id), last_key)
+        self.assertEqual([None, None], storage_keys)
+        self.assertEqual(set(r.id for r in self.results[1:2] + self.results[3:]), self.remaining_ids())
+
+    def test_continues_after_the_given_key(self):
+        last_key, _ = models.QueryResult.delete_unused(self.now, limit=2)
+        last_key, _ = models.QueryResult.delete_unused(self.now, after=last_key, limit=2)
+        self.assertEqual((self.results[3].retrieved_at, self.results[3].id), last_key)
+
+        last_key, _ = models.QueryResult.delete_unused(self.now, after=last_key, limit=2)
+        self.assertEqual((self.results[4].retrieved_at, self.results[4].id), last_key)
+        self.assertEqual(set([self.results[1].id]), self.remaining_ids())
+
+        self.assertEqual((None, []), models.QueryResult.delete_unused(self.now, after=last_key, limit=2))
+
+    def test_keeps_recent_results(self):
+        models.QueryResult.delete_unused(self.now - datetime.timedelta(days=7), limit=10)
+        self.assertEqual(set(r.id for r in self.results[1:2] + self.results[3:]), self.remaining_ids())
+
+
 class TestQueryAll(BaseTestCase):
     def test_returns_only_queries_in_given_groups(self):
         ds1 = self.factory.create_data_source()
@@ -378,6 +582,81 @@ class TestGroup(BaseTestCase):
         self.assertEqual([], models.Group.find_by_name(org1, ["non-existing"]))
 
 
+class TestQueryResultIterJson(BaseTestCase):
+    def assert_same_json(self, query_result, **kwargs):
+        expected = json.loads(json_dumps(query_result.to_dict(**kwargs)))
+        self.assertEqual(expected, json.loads(''.join(query_result.iter_json(**kwargs))))
+
+    def test_encoded_result(self):
+        data = {'columns': [{'name': 'a'}], 'rows': [{'a': i} for i in range(10)]}
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+
+        self.assert_same_json(query_result)
+        self.assert_same_json(query_result, offset=2, limit=3, columns=['a'])
+
+    def test_legacy_json_result(self):
+        query_result = self.factory.create_query_result()
+        query_result._data = '{"columns": [{"name": "a"}], "rows": [{"a": 1}]}'
+
+        self.assert_same_json(query_result)
+        self.assert_same_json(query_result, limit=1)
+
+    def test_copies_legacy_json_result_without_decoding_it(self):
+        query_result = self.factory.create_query_result()
+        query_result._data = '{"columns": [{"name": "a"}], "rows": [{"a": 1}]}'
+
+        with mock.patch('redash.utils.result_codec.json.loads') as loads:
+            pieces = list(query_result.iter_json())
+
+        self.assertFalse(loads.called)
+        self.assertIn(query_result._data, pieces)
+
+    def test_non_tabular_result(self):
+        query_result = self.factory.create_query_result(data='[1, 2]')
+
+        self.assert_same_json(query_result)
+
+
+class TestQueryResultCsvContent(BaseTestCase):
+    def test_yields_batches_of_rows(self):
+        data = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': i, 'b': u'\u3042'} for i in range(5)]}
+        data['rows'].append({'a': 5})
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+
+        pieces = list(query_result.iter_csv_content(batch_size=2))
+        self.assertEqual(3, len(pieces))
+        self.assertEqual('a,b\r\n0,\xe3\x81\x82\r\n1,\xe3\x81\x82\r\n', pieces[0])
+        self.assertEqual('4,\xe3\x81\x82\r\n5,\r\n', pieces[-1])
+        self.assertEqual(''.join(pieces), query_result.make_csv_content())
+
+
+class TestQueryResultExcelContent(BaseTestCase):
+    def sheet_names(self, content):
+        with zipfile.ZipFile(cStringIO.StringIO(content)) as f:
+            return sorted(name for name in f.namelist() if name.startswith('xl/worksheets/sheet'))
+
+    def test_writes_single_sheet(self):
+        data = {'columns': [{'name': 'a'}, {'name': 'b'}], 'rows': [{'a': 1, 'b': [1, 2]}, {'a': 2, 'b': {'c': 1}}]}
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+
+        self.assertEqual(['xl/worksheets/sheet1.xml'], self.sheet_names(query_result.make_excel_content()))
+
+    def test_splits_rows_across_sheets_at_row_limit(self):
+        data = {'columns': [{'name': 'a'}], 'rows': [{'a': i} for i in range(7)]}
+        query_result = self.factory.create_query_result(data=json.dumps(data))
+
+        with mock.patch.object(models.QueryResult, 'EXCEL_MAX_ROWS', 4):
+            content = query_result.make_excel_content()
+
+        self.assertEqual(['xl/worksheets/sheet1.xml', 'xl/worksheets/sheet2.xml', 'xl/worksheets/sheet3.xml'],
+                         self.sheet_names(content))
+
+    def test_empty_result(self):
+        query_result = self.factory.create_query_result()
+
+        self.assertEqual(['xl/worksheets/sheet1.xml'], self.sheet_names(query_result.make_excel_content()))
+
+
 class TestQueryResultStoreResult(BaseTestCase):
     def setUp(self):
         super(TestQueryResultStoreResult, self).setUp()
@@ -386,20 +665,66 @@ class TestQueryResultStoreResult(BaseTestCase):
         self.query_hash = gen_query_hash(self.query)
         self.runtime = 123
         self.utcnow = utcnow()
-        self.data = "data"
+        self.data = '{"columns": [{"name": "a"}], "rows": [{"a": 1}]}'
 
     def test_stores_the_result(self):
         query_result, _ = models.QueryResult.store_result(
             self.data_source.org, self.data_source, self.query_hash,
             self.query, self.data, self.runtime, self.utcnow)
 
-        self.assertEqual(query_result.data, self.data)
+        self.assertEqual(query_result.data, json.loads(self.data))
         self.assertEqual(query_result.runtime, self.runtime)
         self.assertEqual(query_result.retrieved_at, self.utcnow)
         self.assertEqual(query_result.query_text, self.query)
         self.assertEqual(query_result.query_hash, self.query_hash)
         self.assertEqual(query_result.data_source, self.data_source)
 
+    def test_reuses_result_with_same_data(self):
+        query = self.factory.create_query(query_text=self.query)
+        query_result, _ = models.QueryResult.store_result(
+            self.data_source.org, self.data_source, self.query_hash,
+            self.query, self.data, self.runtime, self.utcnow)
+        db.session.flush()
+
+        later = self.utcnow + datetime.timedelta(hours=1)
+        new_query_result, query_ids = models.QueryResult.store_result(
+            self.data_source.org, self.data_source, self.query_hash,
+            self.query, self.data, 456, later)
+
+        self.assertEqual(query_result.id, new_query_result.id)
+        self.assertEqual(later, new_query_result.retrieved_at)
+        self.assertEqual(456, new_query_result.runtime)
+        self.assertEqual([query.id], query_ids)
+        self.assertEqual(1, models.QueryResult.query.count())
+
+    def test_stores_new_result_for_different_data(self):
+        query_result, _ = models.QueryResult.store_result(
+            self.data_source.org, self.data_source, self.query_hash,
+            self.query, self.data, self.runtime, self.utcnow)
+        db.session.flush()
+
+        new_query_result, _ = models.QueryResult.store_result(
+            self.data_source.org, self.data_source, self.query_hash,
+            self.query, '{"columns": [{"name": "a"}], "rows": [{"a": 2}]}', self.runtime, self.utcnow)
+        db.session.flush()
+
+        self.assertNotEqual(query_result.id, new_query_result.id)
+        self.assertNotEqual(query_result.data_hash, new_query_result.data_hash)
+
+    def test_doesnt_reuse_result_of_different_data_source(self):
+        query_result, _ = models.QueryResult.store_result(
+            self.data_source.org, self.data_source, self.query_hash,
+            self.query, self.data, self.runtime, self.utcnow)
+        db.session.flush()
+
+        data_source = self.factory.create_data_source()
+        new_query_result, _ = models.QueryResult.store_result(
+            data_source.org, data_source, self.query_hash,
+            self.query, self.data, self.runtime, self.utcnow)
+        db.session.flush()
+
+        self.assertNotEqual(query_result.id, new_query_result.id)
+
     def test_updates_existing_queries(self):
         query1 = self.factory.create_query(query_text=self.query)
         query2 = self.factory.create_query(query_text=self.query)
@@ -413,6 +738,31 @@ class TestQueryResultStoreResult(BaseTestCase):
         self.assertEqual(query2.latest_query_data, query_result)
         self.assertEqual(query3.latest_query_data, query_result)
 
+    def test_updates_queries_without_loading_them(self):
+        query = self.factory.create_query(query_text=self.query, schedule="3600")
+        version = query.version
+        db.session.flush()
+        db.session.expire_all()
+        statements = []
+
+        def capture(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        listen(db.session.get_bind(), 'before_cursor_execute', capture)
+        try:
+            query_result, query_ids = models.QueryResult.store_result(
+                self.data_source.org, self.data_source, self.query_hash,
+                self.query, self.data, self.runtime, self.utcnow)
+        finally:
+            remove(db.session.get_bind(), 'before_cursor_execute', capture)
+
+        self.assertEqual([query.id], query_ids)
+        self.assertFalse([statement for statement in statements if 'FROM queries' in statement])
+        query = models.Query.query.get(query.id)
+        self.assertEqual(query_result, query.latest_query_data)
+        self.assertEqual(version, query.version)
+        self.assertEqual(self.utcnow + datetime.timedelta(seconds=3600), query.next_run_at)
+
     def test_doesnt_update_queries_with_different_hash(self):
         query1 = self.factory.create_query(query_text=self.query)
         query2 = self.factory.create_query(query_text=self.query)
@@ -440,6 +790,176 @@ class TestQueryResultStoreResult(BaseTestCase):
         self.assertNotEqual(query3.latest_query_data, query_result)
 
 
+class TestQueryResultStorage(BaseTestCase):
+    def setUp(self):
+        super(TestQueryResultStorage, self).setUp()
+        self.path = tempfile.mkdtemp()
+        self.patches = [mock.patch('redash.settings.QUERY_RESULTS_STORAGE', 'file'),
+                        mock.patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', self.path),
+                        mock.patch('redash.settings.QUERY_RESULTS_STORAGE_THRESHOLD', 200)]
+        for patch in self.patches:
+            patch.start()
+
+    def tearDown(self):
+        for patch in self.patches:
+            patch.stop()
+        shutil.rmtree(self.path)
+        super(TestQueryResultStorage, self).tearDown()
+
+    def make_data(self, row_count):
+        return {'columns': [{'name': 'a'}], 'rows': [{'a': i} for i in range(row_count)]}
+
+    def test_stores_large_results_in_storage(self):
+        data = self.make_data(1000)
+        qr = self.factory.create_query_result(data=data)
+        db.session.flush()
+        db.session.expire(qr)
+
+        self.assertIsNone(qr._data)
+        self.assertEqual('{}/{}'.format(qr.data_hash[:2], qr.data_hash), qr.storage_key)
+        self.assertTrue(os.path.exists(os.path.join(self.path, qr.storage_key)))
+        self.assertEqual(data, qr.data)
+        self.assertEqual(data['rows'][500:502], qr.data_slice(500, 2)['rows'])
+
+    def test_keeps_small_results_in_database(self):
+        qr = self.factory.create_query_result(data=self.make_data(1))
+
+        self.assertIsNone(qr.storage_key)
+        self.assertEqual(len(qr._data), qr.data_size)
+
+    def test_delete_unreferenced_data_keeps_shared_data(self):
+        data = self.make_data(1000)
+        qr1 = self.factory.create_query_result(data=data)
+        qr2 = self.factory.create_query_result(data=data)
+        db.session.flush()
+        self.assertEqual(qr1.storage_key, qr2.storage_key)
+
+        db.session.delete(qr1)
+        db.session.flush()
+        self.assertEqual(0, models.QueryResult.delete_unreferenced_data([qr2.storage_key]))
+
+        db.session.delete(qr2)
+        db.session.flush()
+        self.assertEqual(1, models.QueryResult.delete_unreferenced_data([qr2.storage_key]))
+        self.assertFalse(os.path.exists(os.path.join(self.path, qr2.storage_key)))
+
+    def is_locked(self, storage_key):
+        # From another connection, as the session's own lock can be taken again:
+        with db.engine.connect() as connection:
+            return not connection.execute("SELECT pg_try_advisory_xact_lock(hashtext(%s))", storage_key).scalar()
+
+    def new_result(self, data):
+        # Not committed, unlike the factory's:
+        return models.QueryResult(org=self.factory.org, data_source=self.factory.data_source, query_hash='abc',
+                                  query_text='SELECT 1', data=data, runtime=1, retrieved_at=utcnow())
+
+    def test_storing_and_deleting_data_locks_it_until_commit(self):
+        qr = self.new_result(self.make_data(1000))
+        db.session.add(qr)
+        self.assertTrue(self.is_locked(qr.storage_key))
+        db.session.commit()
+        self.assertFalse(self.is_locked(qr.storage_key))
+
+        models.QueryResult.delete_unreferenced_data([qr.storage_key])
+        self.assertTrue(self.is_locked(qr.storage_key))
+        db.session.commit()
+        self.assertFalse(self.is_locked(qr.storage_key))
+
+    def test_sweeps_data_of_results_that_were_rolled_back(self):
+        kept = self.factory.create_query_result(data=self.make_data(1000))
+        db.session.commit()
+        rolled_back = self.new_result(self.make_data(2000))
+        storage_key = rolled_back.storage_key
+        db.session.rollback()
+
+        self.assertEqual(1, models.QueryResult.sweep_stored_data(time.time() + 1))
+        self.assertFalse(os.path.exists(os.path.join(self.path, storage_key)))
+        self.assertTrue(os.path.exists(os.path.join(self.path, kept.storage_key)))
+        self.assertEqual(0, redis_connection.zcard(models.QueryResult.STORAGE_WRITES_KEY))
+
+    def test_closes_stored_data_after_reading_it(self):
+        qr = self.factory.create_query_result(data=self.make_data(1000))
+        storage = result_storage.get_result_storage()
+        opened = []
+
+        def open_payload(key):
+            opened.append(result_storage.FileSystemResultStorage.open(storage, key))
+            return opened[-1]
+
+        with mock.patch.object(storage, 'open', side_effect=open_payload):
+            qr.data
+            ''.join(qr.iter_json())
+            ''.join(qr.iter_csv_content())
+
+        self.assertEqual(3, len(opened))
+        for payload in opened:
+            self.assertRaises(ValueError, payload.__getitem__, slice(0, 1))
+
+
+class TestParameterizedResultsCache(BaseTestCase):
+    def setUp(self):
+        super(TestParameterizedResultsCache, self).setUp()
+        self.cache = models.ParameterizedResultsCache()
+        self.query = self.factory.create_query(query_text=u"SELECT {{a}}, {{b}}",
+                                               options={'parameters_cache_max_age': 600})
+        self.query_result = self.factory.create_query_result(retrieved_at=utcnow())
+
+    def test_finds_results_by_parameter_values(self):
+        self.cache.set(self.query, {'a': 1, 'b': 2}, self.query_result)
+
+        self.assertEqual(self.query_result, self.cache.get(self.query, {'b': '2', 'a': '1', 'unused': 3}))
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 3}))
+        self.assertEqual({'size': 1, 'hits': 1, 'misses': 1, 'evictions': 0}, self.cache.stats())
+
+    def test_disabled_without_max_age(self):
+        self.query.options = {}
+        self.cache.set(self.query, {'a': 1, 'b': 2}, self.query_result)
+
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 2}))
+        self.assertEqual(0, self.cache.stats()['size'])
+
+    def test_skips_results_older_than_max_age(self):
+        old_result = self.factory.create_query_result(retrieved_at=utcnow() - datetime.timedelta(seconds=601))
+        self.cache.set(self.query, {'a': 1, 'b': 2}, old_result)
+
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 2}))
+
+    def test_evicts_least_recently_used_entries(self):
+        with mock.patch('redash.settings.PARAMETERIZED_RESULTS_CACHE_SIZE', 2):
+            self.cache.set(self.query, {'a': 1, 'b': 1}, self.query_result)
+            self.cache.set(self.query, {'a': 1, 'b': 2}, self.query_result)
+            self.cache.get(self.query, {'a': 1, 'b': 1})
+            self.cache.set(self.query, {'a': 1, 'b': 3}, self.query_result)
+
+        self.assertIsNotNone(self.cache.get(self.query, {'a': 1, 'b': 1}))
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 2}))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_forgets_expired_entries(self):
+        self.cache.set(self.query, {'a': 1, 'b': 1}, self.query_result)
+        self.cache.set(self.query, {'a': 1, 'b': 2}, self.query_result)
+        redis_connection.delete(self.cache._key(self.query, {'a': 1, 'b': 1}))
+
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 1}))
+        self.assertEqual(1, self.cache.stats()['size'])
+
+        # Entries expired without being asked for are forgotten when others are added, instead of being evicted:
+        with mock.patch('redash.settings.PARAMETERIZED_RESULTS_CACHE_SIZE', 2), \
+                mock.patch('time.time', return_value=time.time() + 601):
+            self.cache.set(self.query, {'a': 1, 'b': 3}, self.factory.create_query_result(retrieved_at=utcnow()))
+
+        self.assertEqual({'size': 1, 'evictions': 0}, {k: self.cache.stats()[k] for k in ('size', 'evictions')})
+
+    def test_limits_results_to_the_given_max_age(self):
+        self.query_result.retrieved_at = utcnow() - datetime.timedelta(seconds=60)
+        self.cache.set(self.query, {'a': 1, 'b': 2}, self.query_result)
+
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 2}, max_age=0))
+        self.assertIsNone(self.cache.get(self.query, {'a': 1, 'b': 2}, max_age=30))
+        self.assertEqual(self.query_result, self.cache.get(self.query, {'a': 1, 'b': 2}, max_age=120))
+        self.assertEqual(1, self.cache.stats()['size'])
+
+
 class TestEvents(BaseTestCase):
     def raw_event(self):
         timestamp = 1411778709.791
@@ -476,6 +996,34 @@ class TestEvents(BaseTestCase):
         self.assertDictEqual(event.additional_properties, additional_properties)
 
 
+class TestEventPartitions(BaseTestCase):
+    def partition_names(self):
+        return [name for name, _, _ in models.Event.partitions()]
+
+    def test_has_partitions_for_the_coming_months(self):
+        this_month = models.month_start(utcnow())
+        expected = ['events_history'] + [models.month_start(this_month, months).strftime('events_%Y_%m')
+                                         for months in range(settings.EVENTS_PARTITIONS_AHEAD + 1)]
+        self.assertEqual(expected, self.partition_names())
+
+        created = models.Event.create_partitions(settings.EVENTS_PARTITIONS_AHEAD + 2)
+        self.assertEqual(expected[-1:] + created, self.partition_names()[-3:])
+        self.assertEqual([], models.Event.create_partitions())
+
+    def test_drops_partitions_of_old_events(self):
+        old_event = models.Event(org=self.factory.org, action="view", object_type="dashboard",
+                                 created_at=utcnow() - datetime.timedelta(days=400))
+        new_event = models.Event(org=self.factory.org, action="view", object_type="dashboard")
+        db.session.add_all([old_event, new_event])
+        db.session.flush()
+
+        dropped = models.Event.drop_partitions(models.month_start(utcnow()))
+
+        self.assertEqual(['events_history'], dropped)
+        self.assertNotIn('events_history', self.partition_names())
+        self.assertEqual([new_event.id], [event_id for event_id, in db.session.query(models.Event.id)])
+
+
 class TestWidgetDeleteInstance(BaseTestCase):
     def test_delete_removes_from_layout(self):
         widget = self.factory.create_widget()
@@ -0,0 +1,141 @@
+import datetime
+import json
+from unittest import TestCase
+
+import mock
+
+from redash.utils import result_codec
+
+
+def make_result(row_count):
+    return {
+        'columns': [{'name': 'id', 'friendly_name': 'id', 'type': 'integer'},
+                    {'name': 'name', 'friendly_name': 'name', 'type': 'string'}],
+        'rows': [{'id': i, 'name': u'row {}'.format(i)} for i in range(row_count)]
+    }
+
+
+class TestSerialize(TestCase):
+    def test_round_trip(self):
+        data = make_result(25)
+        payload = result_codec.serialize(data, chunk_size=10)
+
+        self.assertTrue(payload.startswith(result_codec.MAGIC))
+        self.assertEqual(data, result_codec.deserialize(payload))
+
+    def test_accepts_json_text(self):
+        data = make_result(3)
+        payload = result_codec.serialize(json.dumps(data))
+
+        self.assertEqual(data, result_codec.deserialize(payload))
+
+    def test_keeps_additional_keys(self):
+        data = make_result(1)
+        data['log'] = ['some output']
+
+        self.assertEqual(data, result_codec.deserialize(result_codec.serialize(data)))
+
+    def test_encodes_values_like_json_encoder(self):
+        data = {'columns': [{'name': 'day'}], 'rows': [{'day': datetime.date(2017, 1, 1)}]}
+        decoded = result_codec.deserialize(result_codec.serialize(data))
+
+        self.assertEqual('2017-01-01', decoded['rows'][0]['day'])
+
+    def test_keeps_keys_missing_from_columns(self):
+        data = {'columns': [{'name': 'a'}], 'rows': [{'a': 1}, {'a': 2, 'b': 3}]}
+        decoded = result_codec.deserialize(result_codec.serialize(data, chunk_size=1))
+
+        self.assertEqual(3, decoded['rows'][1]['b'])
+
+    def test_compresses_repetitive_results(self):
+        data = make_result(1000)
+
+        self.assertLess(len(result_codec.serialize(data)), len(json.dumps(data)) / 4)
+
+    def test_stores_non_tabular_data_as_json(self):
+        self.assertEqual([1, 2], result_codec.deserialize(result_codec.serialize([1, 2])))
+
+    def test_stores_encoded_payload_as_is(self):
+        payload = result_codec.serialize(make_result(3))
+
+        self.assertIs(payload, result_codec.serialize(payload))
+
+    def test_none(self):
+        self.assertIsNone(result_codec.serialize(None))
+        self.assertIsNone(result_codec.deserialize(None))
+
+
+class TestResultReader(TestCase):
+    def test_reads_legacy_json(self):
+        data = make_result(5)
+        reader = result_codec.ResultReader(json.dumps(data))
+
+        self.assertTrue(reader.legacy)
+        self.assertEqual(5, reader.row_count)
+        self.assertEqual(data['columns'], reader.columns)
+        self.assertEqual(data['rows'][1:3], list(reader.iter_rows(1, 2)))
+
+    def test_iter_rows_range_across_chunks(self):
+        data = make_result(25)
+        reader = result_codec.ResultReader(result_codec.serialize(data, chunk_size=10))
+
+        self.assertEqual(25, reader.row_count)
+        self.assertEqual(data['rows'][8:13], list(reader.iter_rows(8, 5)))
+        self.assertEqual(data['rows'][20:], list(reader.iter_rows(20)))
+        self.assertEqual([], list(reader.iter_rows(30)))
+
+    def test_iter_rows_with_keys(self):
+        reader = result_codec.ResultReader(result_codec.serialize(make_result(5), chunk_size=2))
+
+        self.assertEqual([{'name': u'row 3'}, {'name': u'row 4'}], list(reader.iter_rows(3, keys=['name'])))
+        self.assertEqual([{}], list(reader.iter_rows(0, 1, keys=['missing'])))
+
+    def test_iter_rows_with_keys_from_legacy_json(self):
+        reader = result_codec.ResultReader(json.dumps(make_result(5)))
+
+        self.assertEqual([{'id': 0}], list(reader.iter_rows(0, 1, keys=['id'])))
+
+    def test_iter_rows_reads_only_needed_chunks(self):
+        payload = result_codec.serialize(make_result(30), chunk_size=10)
+        reader = result_codec.ResultReader(payload)
+        first_row, count, offset, length = reader.chunks[2]
+        # Corrupting the last chunk doesn't affect reading rows from the first one:
+        reader.payload = reader.payload[:offset] + 'x' * length
+
+        self.assertEqual(10, len(list(reader.iter_rows(0, 10))))
+
+    def test_iter_json(self):
+        data = make_result(25)
+        reader = result_codec.ResultReader(result_codec.serialize(data, chunk_size=10))
+
+        self.assertEqual(data, json.loads(''.join(reader.iter_json(batch_size=7))))
+
+    def test_iter_json_with_meta_and_range(self):
+        data = make_result(25)
+        reader = result_codec.ResultReader(result_codec.serialize(data, chunk_size=10))
+        decoded = json.loads(''.join(reader.iter_json({'row_count': 25}, 5, 3, ['id'])))
+
+        self.assertEqual({'row_count': 25, 'rows': [{'id': 5}, {'id': 6}, {'id': 7}]}, decoded)
+
+    def test_iter_json_copies_legacy_json(self):
+        payload = json.dumps(make_result(5))
+
+        self.assertEqual([payload], list(result_codec.ResultReader(payload).iter_json()))
+
+    def test_decodes_legacy_json_only_when_read(self):
+        payload = json.dumps(make_result(5))
+
+        with mock.patch('json.loads', wraps=json.loads) as loads:
+            reader = result_codec.ResultReader(payload)
+            list(reader.iter_json())
+            self.assertFalse(loads.called)
+
+            self.assertEqual(5, reader.row_count)
+            self.assertEqual(make_result(5)['rows'][:1], list(reader.iter_rows(0, 1)))
+            self.assertEqual(1, loads.call_count)
+
+    def test_rejects_unknown_version(self):
+        payload = result_codec.serialize(make_result(1))
+        payload = payload[:4] + chr(99) + payload[5:]
+
+        self.assertRaises(result_codec.ResultFormatError, result_codec.ResultReader, payload)
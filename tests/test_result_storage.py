@@ -0,0 +1,114 @@
+import shutil
+import tempfile
+from unittest import TestCase
+
+import mock
+
+from redash.utils import result_codec, result_storage
+from tests.test_result_codec import make_result
+
+
+class FakeS3Body(object):
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeS3Client(object):
+    """Stands in for a boto3 S3 client, with the objects in a dict."""
+    def __init__(self):
+        self.objects = {}
+        self.ranges = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[(Bucket, Key)] = Body
+
+    def head_object(self, Bucket, Key):
+        return {'ContentLength': len(self.objects[(Bucket, Key)])}
+
+    def get_object(self, Bucket, Key, Range):
+        self.ranges.append(Range)
+        start, end = map(int, Range[len('bytes='):].split('-'))
+        return {'Body': FakeS3Body(self.objects[(Bucket, Key)][start:end + 1])}
+
+    def delete_object(self, Bucket, Key):
+        self.objects.pop((Bucket, Key), None)
+
+
+class TestFileSystemResultStorage(TestCase):
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.storage = result_storage.FileSystemResultStorage(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def test_put_and_open(self):
+        payload = result_codec.serialize(make_result(25), chunk_size=10)
+        self.storage.put('ab/abc', payload)
+        stored = self.storage.open('ab/abc')
+
+        self.assertEqual(len(payload), len(stored))
+        self.assertEqual(make_result(25), result_codec.deserialize(stored))
+        self.assertEqual(make_result(25)['rows'][12:14], list(result_codec.ResultReader(stored).iter_rows(12, 2)))
+
+    def test_open_missing_key(self):
+        self.assertRaises(result_storage.ResultStorageError, self.storage.open, 'ab/missing')
+
+    def test_delete(self):
+        self.storage.put('ab/abc', 'payload')
+        self.storage.delete('ab/abc')
+        self.storage.delete('ab/abc')
+
+        self.assertRaises(result_storage.ResultStorageError, self.storage.open, 'ab/abc')
+
+
+class TestS3ResultStorage(TestCase):
+    def setUp(self):
+        self.client = FakeS3Client()
+        self.storage = result_storage.S3ResultStorage('bucket', 'results/', client=self.client)
+
+    def test_put_and_open(self):
+        payload = result_codec.serialize(make_result(25))
+        self.storage.put('ab/abc', payload)
+
+        self.assertIn(('bucket', 'results/ab/abc'), self.client.objects)
+        self.assertEqual(make_result(25), result_codec.deserialize(self.storage.open('ab/abc')))
+
+    def test_reads_ranges_past_the_head(self):
+        payload = result_codec.serialize(make_result(30), compression='none', chunk_size=10)
+        self.storage.put('ab/abc', payload)
+
+        with mock.patch.object(result_storage.S3Object, 'head_size', 100):
+            stored = self.storage.open('ab/abc')
+            reader = result_codec.ResultReader(stored)
+            first_row, count, offset, length = reader.chunks[1]
+            del self.client.ranges[:]
+
+            self.assertEqual(make_result(30)['rows'][10:12], list(reader.iter_rows(10, 2)))
+
+        self.assertEqual(['bytes={}-{}'.format(offset, offset + length - 1)], self.client.ranges)
+
+    def test_open_missing_key(self):
+        self.assertRaises(result_storage.ResultStorageError, self.storage.open, 'ab/missing')
+
+
+class TestGetResultStorage(TestCase):
+    def test_disabled(self):
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE', ''):
+            self.assertIsNone(result_storage.get_result_storage())
+
+    def test_file(self):
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE', 'file'), \
+                mock.patch('redash.settings.QUERY_RESULTS_STORAGE_PATH', '/tmp/results'):
+            storage = result_storage.get_result_storage()
+
+            self.assertIsInstance(storage, result_storage.FileSystemResultStorage)
+            self.assertEqual('/tmp/results', storage.path)
+            self.assertIs(storage, result_storage.get_result_storage())
+
+    def test_unknown(self):
+        with mock.patch('redash.settings.QUERY_RESULTS_STORAGE', 'tape'):
+            self.assertRaises(result_storage.ResultStorageError, result_storage.get_result_storage)
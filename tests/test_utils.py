@@ -1,7 +1,9 @@
+#encoding: utf8
+import cStringIO
 from collections import namedtuple
 from unittest import TestCase
 
-from redash.utils import (build_url, collect_parameters_from_request,
+from redash.utils import (UnicodeWriter, build_url, collect_parameters_from_request,
                           collect_query_parameters, filter_none)
 
 DummyRequest = namedtuple('DummyRequest', ['host', 'scheme'])
@@ -61,3 +63,19 @@ class TestSkipNones(TestCase):
         }
 
         self.assertDictEqual(filter_none(d), {'a': 1})
+
+
+class TestUnicodeWriter(TestCase):
+    def test_writes_utf8(self):
+        s = cStringIO.StringIO()
+        writer = UnicodeWriter(s)
+        writer.writerows([[u'\u3042', 1, None], ['a,b', 2.5, u'c']])
+
+        self.assertEqual(u'\u3042,1,\r\n"a,b",2.5,c\r\n'.encode('utf-8'), s.getvalue())
+
+    def test_reencodes_to_other_encoding(self):
+        s = cStringIO.StringIO()
+        writer = UnicodeWriter(s, encoding='utf-16-le')
+        writer.writerows([[u'\u3042', 1], [u'b', 2]])
+
+        self.assertEqual(u'\u3042,1\r\nb,2\r\n', s.getvalue().decode('utf-16-le'))